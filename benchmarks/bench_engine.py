@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import gc
+import tracemalloc
+
+from common import workspace, Probe, print_report, quiet
+from shapes import SHAPES, variables
+from stub import StubService
+
+# Runs instances of a synthetic model straight on BpmnModel/BpmnInstance,
+# e.g. python benchmarks/bench_engine.py --shape parallel --size 20 --instances 500
+
+
+async def run_instances(model, args, count, offset=0):
+    instances = [
+        await model.create_instance(
+            str(offset + n), variables(args.shape, args.size, offset + n)
+        )
+        for n in range(count)
+    ]
+    await asyncio.gather(*(i.run() for i in instances))
+    return instances
+
+
+async def main(args):
+    stub = StubService(port=args.port, delay=args.delay)
+    directory, model_path = workspace(args.shape, args.size, args.task, stub.url)
+    probe = Probe()
+    probe.install()
+
+    from bpmn_model import BpmnModel
+    from event_sink import default_event_sink
+    from http_connector import default_http_connector
+
+    if args.task == "service":
+        await stub.start()
+    model = BpmnModel(model_path)
+    with quiet(not args.verbose):
+        probe.start()
+        await run_instances(model, args, args.instances)
+        # Buffered events are part of the cost of the run
+        await default_event_sink.flush()
+        probe.stop()
+    result = probe.report(args.instances)
+    result["workspace"] = directory
+
+    if args.memory_instances:
+        # Finished instances stay resident in model.instances
+        with quiet(not args.verbose):
+            gc.collect()
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            await run_instances(
+                model, args, args.memory_instances, offset=args.instances
+            )
+            await default_event_sink.flush()
+            gc.collect()
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        result["memory_per_instance_kb"] = round(
+            (after - before) / args.memory_instances / 1024, 2
+        )
+
+    await default_event_sink.close()
+    await default_http_connector.close()
+    await stub.stop()
+    print_report(result, args.json)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Engine throughput and latency")
+    parser.add_argument("--shape", choices=sorted(SHAPES), default="linear")
+    parser.add_argument("--size", type=int, default=10)
+    parser.add_argument("--instances", type=int, default=1000)
+    parser.add_argument("--memory-instances", type=int, default=200)
+    parser.add_argument("--task", choices=["manual", "service"], default="manual")
+    parser.add_argument("--delay", type=float, default=0.0, help="stub delay")
+    parser.add_argument("--port", type=int, default=18780)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    asyncio.run(main(parser.parse_args()))
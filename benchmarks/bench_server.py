@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+
+from common import workspace, Probe, percentile, print_report, quiet
+from shapes import SHAPES, TASKS
+from stub import StubService
+
+# Drives the aiohttp routes in process: creates instances, submits the
+# forms of user tasks until they finish, then reads instances, searches
+# and pages through /events, e.g.
+# python benchmarks/bench_server.py --shape linear --size 5 --task user
+
+
+class Client:
+    def __init__(self, client, concurrency):
+        self.client = client
+        self.limit = asyncio.Semaphore(concurrency)
+        self.latencies = defaultdict(list)
+
+    async def request(self, route, method, path, **kwargs):
+        async with self.limit:
+            started = time.perf_counter()
+            async with self.client.request(method, path, **kwargs) as response:
+                body = await response.json()
+            self.latencies[route].append(time.perf_counter() - started)
+        if response.status != 200:
+            raise Exception(f"{method} {path} returned {response.status}: {body}")
+        return body
+
+    def report(self):
+        result = {}
+        for route, values in self.latencies.items():
+            result[f"{route}_requests"] = len(values)
+            result[f"{route}_p50_ms"] = round(percentile(values, 50) * 1000, 3)
+            result[f"{route}_p99_ms"] = round(percentile(values, 99) * 1000, 3)
+        return result
+
+
+async def complete_user_tasks(client, instance_id, rounds=1000):
+    for _ in range(rounds):
+        instance = await client.request(
+            "instance",
+            "GET",
+            f"/instance/{instance_id}",
+            params={"fields": "state,pending"},
+        )
+        if instance["state"] != "running" or not instance["pending"]:
+            return
+        await asyncio.gather(
+            *(
+                client.request(
+                    "form",
+                    "POST",
+                    f"/instance/{instance_id}/task/{task_id}/form",
+                    json={f"{task_id}_value": f"{instance_id} {task_id}"},
+                )
+                for task_id in instance["pending"]
+            )
+        )
+        # Forms are processed by the scheduler after the response
+        await asyncio.sleep(0.01)
+
+
+async def main(args):
+    stub = StubService(port=args.port, delay=args.delay)
+    directory, model_path = workspace(args.shape, args.size, args.task, stub.url)
+    probe = Probe()
+    probe.install()
+
+    from aiohttp.test_utils import TestClient, TestServer
+    from event_sink import default_event_sink
+
+    # Logs that the database is bound already, the workspace bound it
+    import server
+
+    if args.task == "service":
+        await stub.start()
+    app = server.run()
+    result = {}
+    with quiet(not args.verbose):
+        async with TestClient(TestServer(app)) as test_client:
+            client = Client(test_client, args.concurrency)
+            probe.start()
+            created = await asyncio.gather(
+                *(
+                    client.request("create", "POST", f"/model/{model_path}/instance")
+                    for _ in range(args.instances)
+                )
+            )
+            ids = [c["id"] for c in created]
+            if args.task == "user":
+                await asyncio.gather(*(complete_user_tasks(client, _id) for _id in ids))
+            else:
+                # Instances run on after the create response
+                instances = server.models[model_path].instances
+                while any(i.state == "running" for i in instances.values()):
+                    await asyncio.sleep(0.01)
+            await default_event_sink.flush()
+            probe.stop()
+            result.update(probe.report(args.instances))
+
+            reads = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    client.request(
+                        "read", "GET", f"/instance/{_id}", params={"view": "compact"}
+                    )
+                    for _id in ids
+                )
+            )
+            for n in range(args.searches):
+                await client.request(
+                    "search", "GET", "/instance", params={"q": ids[n % len(ids)][:8]}
+                )
+            page = {"limit": 1000}
+            while True:
+                # One round trip per page of /events
+                events = await client.request("events", "GET", "/events", params=page)
+                if not events.get("next"):
+                    break
+                page["after"] = events["next"]
+            result["read_seconds"] = round(time.perf_counter() - reads, 3)
+            result.update(client.report())
+    result["workspace"] = directory
+    await stub.stop()
+    print_report(result, args.json)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server route throughput")
+    parser.add_argument("--shape", choices=sorted(SHAPES), default="linear")
+    parser.add_argument("--size", type=int, default=5)
+    parser.add_argument("--task", choices=TASKS, default="user")
+    parser.add_argument("--instances", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--searches", type=int, default=20)
+    parser.add_argument("--delay", type=float, default=0.0, help="stub delay")
+    parser.add_argument("--port", type=int, default=18780)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import contextlib
+from functools import wraps
+
+from shapes import SHAPES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Runs the engine in a scratch directory holding the generated model and a
+# fresh sqlite database, engine modules must be imported after this
+def workspace(shape, size, task="manual", stub_url=""):
+    directory = tempfile.mkdtemp(prefix="bpmn-benchmark-")
+    os.makedirs(os.path.join(directory, "models"))
+    os.makedirs(os.path.join(directory, "database"))
+    model_path = f"{shape}_{size}.bpmn"
+    with open(os.path.join(directory, "models", model_path), "w") as f:
+        f.write(SHAPES[shape](size, task))
+    os.environ["BASEROW_CONNECTOR_URL"] = stub_url
+    os.chdir(directory)
+    sys.path.insert(0, ROOT)
+    import db_connector
+
+    # Bound by absolute path, setup_db() would use the repository database
+    db_connector.DB.bind(
+        provider="sqlite",
+        filename=os.path.join(directory, "database", "database.sqlite"),
+        create_db=True,
+    )
+    db_connector.DB.generate_mapping(create_tables=True)
+    return directory, model_path
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Probe:
+    # Wraps the engine hot paths to count steps, their latency and the
+    # database writes they cause
+    def __init__(self):
+        self.latencies = []
+        self.started = None
+        self.elapsed = 0.0
+
+    def install(self):
+        from bpmn_model import BpmnInstance
+
+        step = BpmnInstance.step
+
+        @wraps(step)
+        async def timed_step(instance, node, message=None):
+            started = time.perf_counter()
+            try:
+                return await step(instance, node, message)
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+
+        BpmnInstance.step = timed_step
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def report(self, instances):
+        from event_sink import default_event_sink
+
+        steps = len(self.latencies)
+        sink = default_event_sink.stats()
+        result = {
+            "instances": instances,
+            "steps": steps,
+            "seconds": round(self.elapsed, 3),
+            "steps_per_sec": round(steps / self.elapsed, 1) if self.elapsed else 0,
+            "step_p50_ms": round(percentile(self.latencies, 50) * 1000, 3),
+            "step_p99_ms": round(percentile(self.latencies, 99) * 1000, 3),
+            "events_written": sink["written"],
+            "event_batches": sink["batches"],
+            "db_writes_per_step": round(sink["batches"] / steps, 4) if steps else 0,
+            "event_write_seconds": round(sink["write_time"], 3),
+        }
+        return result
+
+
+def print_report(result, as_json=False):
+    if as_json:
+        print(json.dumps(result))
+        return
+    width = max(len(k) for k in result)
+    for k, v in result.items():
+        print(f"{k:<{width}}  {v}")
+
+
+# Engine log records are still formatted at the configured level but
+# written to devnull
+@contextlib.contextmanager
+def quiet(enabled=True):
+    if not enabled:
+        yield
+        return
+    import logging
+
+    handlers = logging.getLogger("bpmn").handlers
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        streams = [h.setStream(devnull) for h in handlers]
+        try:
+            yield
+        finally:
+            for handler, stream in zip(handlers, streams):
+                handler.setStream(stream)
@@ -0,0 +1,173 @@
+from xml.sax.saxutils import escape
+
+# Synthetic BPMN models for the benchmarks, every shape takes a size and
+# a task kind and returns the model XML. Tasks are manual tasks, service
+# tasks calling the stub endpoint or user tasks with one form field.
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<bpmn:definitions xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL" xmlns:camunda="http://camunda.org/schema/1.0/bpmn" id="benchmark">
+"""
+FOOTER = "</bpmn:definitions>\n"
+
+SERVICE = """    <bpmn:serviceTask id="{id}" name="{id}">
+      <bpmn:extensionElements>
+        <camunda:connector>
+          <camunda:inputOutput>
+            <camunda:inputParameter name="url">/task</camunda:inputParameter>
+            <camunda:inputParameter name="method">POST</camunda:inputParameter>
+          </camunda:inputOutput>
+          <camunda:connectorId>baserow</camunda:connectorId>
+        </camunda:connector>
+        <camunda:inputOutput>
+          <camunda:inputParameter name="task">{id}</camunda:inputParameter>
+          <camunda:outputParameter name="{id}">x</camunda:outputParameter>
+        </camunda:inputOutput>
+      </bpmn:extensionElements>
+    </bpmn:serviceTask>
+"""
+
+
+USER = """    <bpmn:userTask id="{id}" name="{id}">
+      <bpmn:extensionElements>
+        <camunda:formData>
+          <camunda:formField id="{id}_value" label="{id}" type="string" />
+        </camunda:formData>
+      </bpmn:extensionElements>
+    </bpmn:userTask>
+"""
+
+TASKS = ("manual", "service", "user")
+
+
+class Process:
+    def __init__(self, _id, task="manual"):
+        self._id = _id
+        self.kind = task
+        self.elements = []
+        self.flows = 0
+
+    def element(self, tag, _id, **attrib):
+        attrib = "".join(f' {k}="{escape(str(v))}"' for k, v in attrib.items())
+        self.elements.append(f'    <bpmn:{tag} id="{_id}"{attrib} />\n')
+        return _id
+
+    def task(self, _id):
+        if self.kind == "service":
+            self.elements.append(SERVICE.format(id=_id))
+        elif self.kind == "user":
+            self.elements.append(USER.format(id=_id))
+        else:
+            self.element("manualTask", _id, name=_id)
+        return _id
+
+    def call(self, _id, called_element):
+        self.elements.append(
+            f'    <bpmn:callActivity id="{_id}" name="{_id}" calledElement="{called_element}">\n'
+            "      <bpmn:extensionElements>\n"
+            '        <camunda:in variables="all" />\n'
+            '        <camunda:out variables="all" />\n'
+            "      </bpmn:extensionElements>\n"
+            "    </bpmn:callActivity>\n"
+        )
+        return _id
+
+    def flow(self, source, target, condition=None):
+        self.flows += 1
+        _id = f"{self._id}_f{self.flows}"
+        if condition is None:
+            return self.element("sequenceFlow", _id, sourceRef=source, targetRef=target)
+        self.elements.append(
+            f'    <bpmn:sequenceFlow id="{_id}" sourceRef="{source}" targetRef="{target}">\n'
+            f"      <bpmn:conditionExpression>{escape(condition)}</bpmn:conditionExpression>\n"
+            "    </bpmn:sequenceFlow>\n"
+        )
+        return _id
+
+    def xml(self):
+        return (
+            f'  <bpmn:process id="{self._id}" name="{self._id}" isExecutable="true">\n'
+            + "".join(self.elements)
+            + "  </bpmn:process>\n"
+        )
+
+
+# start -> size tasks -> end
+def linear(size, task="manual"):
+    p = Process("Linear", task)
+    previous = p.element("startEvent", "start")
+    for i in range(size):
+        task = p.task(f"t{i}")
+        p.flow(previous, task)
+        previous = task
+    p.flow(previous, p.element("endEvent", "end"))
+    return HEADER + p.xml() + FOOTER
+
+
+# start -> fork -> size tasks in parallel -> join -> end
+def parallel(size, task="manual"):
+    p = Process("Parallel", task)
+    start = p.element("startEvent", "start")
+    fork = p.element("parallelGateway", "fork")
+    join = p.element("parallelGateway", "join")
+    p.flow(start, fork)
+    for i in range(size):
+        task = p.task(f"t{i}")
+        p.flow(fork, task)
+        p.flow(task, join)
+    p.flow(join, p.element("endEvent", "end"))
+    return HEADER + p.xml() + FOOTER
+
+
+# Binary tree of exclusive gateways size levels deep, gateway on level i
+# branches on variable b<i>, instances without it take the 0 branches
+def exclusive(size, task="manual"):
+    p = Process("Exclusive", task)
+    start = p.element("startEvent", "start")
+
+    def branch(source, level, path):
+        if level == size:
+            p.flow(source, p.element("endEvent", f"end{path}"))
+            return
+        gateway = p.element("exclusiveGateway", f"g{path}")
+        p.flow(source, gateway)
+        for bit in "01":
+            # Conditions on both branches, one of them holds
+            target = f"{path}{bit}"
+            condition = f"${{b{level}}} == 1" if bit == "1" else f"${{b{level}}} != 1"
+            p.flow(gateway, p.task(f"t{target}"), condition)
+            branch(f"t{target}", level + 1, target)
+
+    branch(start, 0, "")
+    return HEADER + p.xml() + FOOTER
+
+
+# Call activities size levels deep, every process calls the next one and
+# the last one runs a single task
+def call(size, task="manual"):
+    processes = []
+    for level in range(size + 1):
+        p = Process(f"Call{level}", task)
+        start = p.element("startEvent", f"start{level}")
+        if level < size:
+            work = p.call(f"call{level}", f"Call{level + 1}")
+        else:
+            work = p.task(f"t{level}")
+        p.flow(start, work)
+        p.flow(work, p.element("endEvent", f"end{level}"))
+        processes.append(p)
+    return HEADER + "".join(p.xml() for p in processes) + FOOTER
+
+
+SHAPES = {
+    "linear": linear,
+    "parallel": parallel,
+    "exclusive": exclusive,
+    "call": call,
+}
+
+
+# Variables an instance of the shape starts with
+def variables(shape, size, n):
+    if shape == "exclusive":
+        return {f"b{level}": (n >> level) & 1 for level in range(size)}
+    return {}
@@ -0,0 +1,32 @@
+import asyncio
+from aiohttp import web
+
+# Local endpoint for the service tasks of benchmark models, answers every
+# task with its output variable after delay seconds
+
+
+class StubService:
+    def __init__(self, port=18780, delay=0.0):
+        self.port = port
+        self.delay = delay
+        self.url = f"http://127.0.0.1:{port}"
+        self.requests = 0
+        self._runner = None
+
+    async def handle_task(self, request):
+        body = await request.json()
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.json_response({body.get("task", "task"): "done"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/task", self.handle_task)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
@@ -3,17 +3,33 @@ import xml.etree.ElementTree as ET
 from bpmn_types import *
 from pprint import pprint
 from copy import deepcopy
-from collections import defaultdict, deque
-from functools import partial
+from collections import defaultdict
 import asyncio
+import logging
 import db_connector
 from datetime import datetime
 import os
-from uuid import uuid4
+import hashlib
 import env
+from scheduler import default_scheduler
+from cluster import default_cluster
+from instance_cache import default_instance_cache
+from utils.encoding import dumps
+from search_index import default_search_index
+from change_feed import default_change_feed
+from variable_store import StepVariables
+from metrics import default_metrics
+from engine_log import InstanceLog, default_sample
+from timers import Timer, default_timer_service
+from correlation import default_correlator
+from utils.expressions import compile_condition
 
 instance_models = {}
 
+instances_total = default_metrics.counter(
+    "bpmn_instances_total", "Instances started, finished and failed, by state"
+)
+
 
 def get_model_for_instance(iid):
     return instance_models.get(iid, None)
@@ -25,22 +41,124 @@ class UserFormMessage:
         self.form_data = form_data
 
 
+class TimerMessage:
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
+class MessageReceived:
+    def __init__(self, task_id, message):
+        self.task_id = task_id
+        self.message = message
+
+
+class ProcessGraph:
+    # Immutable execution graph of a single process, shared by all instances
+    def __init__(self, process_id, elements, flow):
+        self.process_id = process_id
+        self.nodes = tuple(
+            e for e in elements.values() if not isinstance(e, SequenceFlow)
+        )
+        self.index = {e._id: idx for idx, e in enumerate(self.nodes)}
+
+        outgoing = [[] for _ in self.nodes]
+        default = [None] * len(self.nodes)
+        in_degree = [0] * len(self.nodes)
+        for idx, node in enumerate(self.nodes):
+            default_flow = node.default if isinstance(node, ExclusiveGateway) else None
+            for sequence in flow.get(node._id, []):
+                target = self.index.get(sequence.target)
+                if target is None:
+                    continue
+                in_degree[target] += 1
+                if sequence._id == default_flow:
+                    default[idx] = target
+                else:
+                    outgoing[idx].append((target, sequence.compiled_condition))
+
+        self.outgoing = tuple(tuple(o) for o in outgoing)
+        self.default = tuple(default)
+        self.in_degree = tuple(in_degree)
+        self.start = tuple(
+            idx for idx, e in enumerate(self.nodes) if isinstance(e, StartEvent)
+        )
+        # Timer boundary events attached to each node
+        boundaries = [[] for _ in self.nodes]
+        for idx, node in enumerate(self.nodes):
+            if isinstance(node, BoundaryEvent) and node.timer is not None:
+                if node.attached_to in self.index:
+                    boundaries[self.index[node.attached_to]].append(idx)
+        self.boundaries = tuple(tuple(b) for b in boundaries)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def ids(self, indices):
+        return [self.nodes[idx]._id for idx in indices]
+
+
+class TokenTable:
+    # Per-instance execution state: arrived tokens per node and pending nodes.
+    # Pending is a dict used as an insertion ordered set.
+    def __init__(self, pending=()):
+        self.arrived = {}
+        self.pending = dict.fromkeys(pending)
+
+    def __contains__(self, node):
+        return node in self.pending
+
+    def __iter__(self):
+        return iter(self.pending)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def count(self, node):
+        return self.arrived.get(node, 0)
+
+    def add(self, node):
+        self.arrived[node] = self.arrived.get(node, 0) + 1
+        self.pending[node] = None
+
+    def complete(self, node, consumed=None):
+        # Consumes all tokens of node unless told otherwise (joins inside loops)
+        left = 0 if consumed is None else self.count(node) - consumed
+        if left > 0:
+            self.arrived[node] = left
+        else:
+            self.arrived.pop(node, None)
+        self.pending.pop(node, None)
+
+    def reset(self, pending=()):
+        self.arrived = {}
+        self.pending = dict.fromkeys(pending)
+
+
 class BpmnModel:
     def __init__(self, model_path):
         self.pending = []
         self.elements = {}
         self.flow = defaultdict(list)
         self.instances = {}
+        # Running instances evicted from memory, listed with the resident ones
+        self.evicted = set()
         self.process_elements = {}
         self.process_pending = defaultdict(list)
         self.main_collaboration_process = None
         self.model_path = model_path
         self.subprocesses = {}
+        self.registry = None
+        self._document = None
         self.main_process = SimpleNamespace()
+        self.graphs = {}
 
         model_tree = ET.parse(os.path.join("models", self.model_path))
         model_root = model_tree.getroot()
         processes = model_root.findall("bpmn:process", NS)
+        messages = {
+            m.attrib["id"]: m.attrib.get("name") or m.attrib["id"]
+            for m in model_root.findall("bpmn:message", NS)
+        }
         for process in processes:
             p = BPMN_MAPPINGS["bpmn:process"]()
             p.parse(process)
@@ -68,26 +186,38 @@ class BpmnModel:
                     if isinstance(t, StartEvent):
                         self.pending.append(t)
                         self.process_pending[p._id].append(t)
+                    if getattr(t, "message", None):
+                        t.message.resolve(messages)
                     self.elements[t._id] = t
                     self.process_elements[p._id][t._id] = t
-        # Check if there is single deployement subprocess
-        for k, v in self.subprocesses.items():
-            if v:
-                self.handle_deployment_subprocesses()
-                break
+        # Compile shared execution graphs, instances only keep their own tokens
+        for process_id, elements in self.process_elements.items():
+            self.graphs[process_id] = ProcessGraph(process_id, elements, self.flow)
+
+    # Parts of the model which never change once parsed, cached with an
+    # ETag so clients fetch them once per model version
+    def document(self):
+        if self._document is None:
+            document = {
+                "model_path": self.model_path,
+                "main_process": self.main_process.__dict__,
+                "tasks": [
+                    x.to_json()
+                    for x in self.elements.values()
+                    if isinstance(x, UserTask)
+                ],
+            }
+            body = dumps(document)
+            self._document = (document, body, hashlib.sha1(body.encode()).hexdigest())
+        return self._document
 
     def to_json(self):
         return {
-            "model_path": self.model_path,
-            "main_process": self.main_process.__dict__,
-            "tasks": [
-                x.to_json() for x in self.elements.values() if isinstance(x, UserTask)
-            ],
-            "instances": [i._id for i in self.instances.values()],
+            **self.document()[0],
+            "instances": list(self.instances) + sorted(self.evicted),
         }
 
     async def create_instance(self, _id, variables, process=None):
-        queue = asyncio.Queue()
         if not process:
             if self.main_collaboration_process:
                 # If Collaboration diagram
@@ -96,262 +226,512 @@ class BpmnModel:
                 # If Process diagram
                 process = list(self.process_elements)[0]
         instance = BpmnInstance(
-            _id, model=self, variables=variables, in_queue=queue, process=process
+            _id,
+            model=self,
+            variables=variables,
+            process=process,
+            scheduler=default_scheduler,
         )
         self.instances[_id] = instance
+        self.evicted.discard(_id)
+        default_instance_cache.add(instance)
         return instance
 
-    # Takes model_path needed for deployed subprocess
-    def handle_deployment_subprocesses(self):
-        models_directory = self.model_path.split("/")[:-1]
-        models_directory = "/".join(models_directory) + "/"
-
-        other_models_list = []
-
-        for m in os.listdir(models_directory):
-            if models_directory + m == self.model_path:
-                continue
-            other_model = BpmnModel(models_directory + m)
-            other_models_list.append(other_model)
-        for other_model in other_models_list:
-            for subprocess_key in self.subprocesses.keys():
-                for process_key in other_model.process_elements.keys():
-                    if subprocess_key == process_key:
-                        self.subprocesses[subprocess_key] = other_model.model_path
+    # Resolves model_path of deployed subprocesses through the model registry
+    def handle_deployment_subprocesses(self, registry):
+        self.registry = registry
+        for process_id, deployment in self.subprocesses.items():
+            if deployment:
+                other_model = registry.resolve(process_id, caller=self.model_path)
+                if other_model:
+                    self.subprocesses[process_id] = other_model.model_path
 
 
 class BpmnInstance:
-    def __init__(self, _id, model, variables, in_queue, process):
+    def __init__(self, _id, model, variables, process, scheduler):
         instance_models[_id] = model
         self._id = _id
         self.model = model
         self.variables = deepcopy(variables)
-        self.in_queue = in_queue
+        self.scheduler = scheduler
+        self.parent = None
+        self.children = []
+        self.finished = None
+        self.timed = False
+        self.log = InstanceLog(_id, default_sample)
         self.state = "initialized"
-        self.pending = deepcopy(self.model.process_pending[process])
+        # Continues a run from the database, not a new instance
+        self.restored = False
         self.process = process
-
-    def to_json(self):
-        return {
+        self.graph = model.graphs[process]
+        # Per-instance state, indices into self.graph.nodes
+        self.tokens = TokenTable(self.graph.start)
+
+    @property
+    def pending(self):
+        return list(self.tokens)
+
+    JSON_FIELDS = {
+        "id": lambda i: i._id,
+        "variables": lambda i: i.variables,
+        "state": lambda i: i.state,
+        "model": lambda i: i.model.to_json(),
+        "pending": lambda i: i.graph.ids(i.pending),
+        "parent": lambda i: i.parent,
+        "children": lambda i: i.children,
+        "env": lambda i: env.SYSTEM_VARS,
+    }
+
+    # Compact references the model by model_path instead of embedding it,
+    # fields limits the output to the given keys
+    def to_json(self, fields=None, compact=False):
+        data = {}
+        for field in fields or self.JSON_FIELDS:
+            if field == "model" and compact:
+                data["model"] = self.model.model_path
+            elif field in self.JSON_FIELDS:
+                data[field] = self.JSON_FIELDS[field](self)
+        return data
+
+    # Compact delta of this instance for live subscribers
+    def publish(self, variables=None):
+        if not default_change_feed.subscribers:
+            return
+        delta = {
             "id": self._id,
-            "variables": self.variables,
+            "model": self.model.model_path,
             "state": self.state,
-            "model": self.model.to_json(),
-            "pending": [x._id for x in self.pending],
-            "env": env.SYSTEM_VARS,
+            "pending": self.graph.ids(self.pending),
         }
+        if variables:
+            delta["variables"] = variables
+        default_change_feed.publish(delta)
 
     @classmethod
     def check_condition(cls, state, condition, log):
-        log(f"\t- checking variables={state} with {condition}... ")
-        ok = False
-        if condition:
-            key = condition.partition(":")[0]
-            value = condition.partition(":")[2]
-            if key in state and state[key] == value:
-                ok = True
-        log("\t  DONE: Result is", ok)
+        if isinstance(condition, str):
+            condition = compile_condition(condition)
+        ok = condition(state) if condition else False
+        log.debug("condition %s is %s for variables=%s", condition, ok, state)
         return ok
 
     async def run_from_log(self, log):
+        index = self.graph.index
         for l in log:
             if l.get("activity_id") in self.model.elements:
-                pending_elements_list = []
-                for p in l.get("pending"):
-                    pending_elements_list.append(self.model.elements[p])
-                self.pending = pending_elements_list
+                self.tokens.reset(index[p] for p in l.get("pending") if p in index)
                 self.variables = {**l.get("activity_variables"), **self.variables}
+        self.restored = True
         return self
 
-    async def run_subprocess(self, process_id):
-        new_subproces_instance_id = str(uuid4())
-        if not self.model.subprocesses[process_id]:
-            new_subprocess_instance = await self.model.create_instance(
-                new_subproces_instance_id, {}, process_id
-            )
-            finished_subprocess = await new_subprocess_instance.run()
-        else:
-            subprocess_model = BpmnModel(self.model.subprocesses[process_id])
-            new_subproces_instance = await subprocess_model.create_instance(
-                new_subproces_instance_id, {}, process_id
-            )
-            finished_subprocess = await new_subproces_instance.run()
+    def subprocess_model(self, process_id):
+        deployment = self.model.subprocesses[process_id]
+        if not deployment:
+            return self.model
+        # Deployed subprocess, shared model already loaded by the registry
+        if not self.model.registry or deployment is True:
+            raise Exception(f"Called process {process_id} is not deployed")
+        return self.model.registry.get(deployment)
+
+    def decision_model(self, business_rule):
+        registry = self.model.registry
+        model = registry.decision_model(business_rule.decision_ref) if registry else None
+        if model is None:
+            raise Exception(f"Decision {business_rule.decision_ref} is not deployed")
+        return model
+
+    async def run_subprocess(self, call_activity, variables):
+        process_id = call_activity.called_element
+        subprocess_instance = await self.subprocess_model(process_id).create_instance(
+            default_cluster.new_instance_id(near=self._id),
+            call_activity.input_variables(variables),
+            process_id,
+        )
+        subprocess_instance.parent = self._id
+        self.children.append(subprocess_instance._id)
+        subprocess_variables = await subprocess_instance.run()
+        call_activity.output_variables(subprocess_variables, variables)
         return True
 
-    async def run(self):
-        print("Running instance", self._id)
+    def start(self):
+        if self.restored:
+            self.log.info("resuming instance")
+        else:
+            self.log.info("running instance")
+            if default_metrics.enabled:
+                instances_total.inc(state="started")
         self.state = "running"
-        _id = self._id
-        prefix = f"\t[{_id}]"
-        log = partial(print, prefix)  # if _id == "2" else lambda *x: x
-
-        in_queue = self.in_queue
-        # Take only elements of running process
-        elements = deepcopy(self.model.process_elements[self.process])
-        flow = deepcopy(self.model.flow)
-        queue = deque()
-
-        while len(self.pending) > 0:
-            # process incoming messages
-            if not in_queue.empty():
-                queue.append(in_queue.get_nowait())
-            # print("Check", _id, id(queue), id(in_queue))
-
-            exit = False
-            can_continue = False
-
-            message = queue.pop() if len(queue) else None
-            if message:
-                log("--> msg in:", message and message.task_id)
-
-            # Helper current dictionary
-            current_and_variables_dict = {}
-
-            for idx, current in enumerate(self.pending):
-                # Helper variables dict
-                before_variables = deepcopy(self.variables)
-
-                if isinstance(current, StartEvent):
-                    # Helper variables for DB insert
-                    new_variables = {
-                        k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
-                    }
-                    current_and_variables_dict[current._id] = new_variables
-                    # Create new running instance
-                    db_connector.add_running_instance(instance_id=self._id)
-
-                if isinstance(current, EndEvent):
-                    exit = True
-                    del self.pending[idx]
-                    # Add EndEvent to DB
-                    db_connector.add_event(
-                        model_name=self.model.model_path,
-                        instance_id=self._id,
-                        activity_id=current._id,
-                        timestamp=datetime.now(),
-                        pending=[],
-                        activity_variables={},
-                    )
-                    break
-
-                if isinstance(current, UserTask):
-                    if (
-                        message
-                        and isinstance(message, UserFormMessage)
-                        and message.task_id == current._id
-                    ):
-                        user_action = message.form_data
-
-                        log("DOING:", current)
-                        if user_action:
-                            log("\t- user sent:", user_action)
-                        can_continue = current.run(self.variables, user_action)
-                        # Helper variables for DB insert
-                        new_variables = {
-                            k: self.variables[k]
-                            for k in set(self.variables) - set(before_variables)
-                        }
-                        current_and_variables_dict[current._id] = new_variables
-
-                elif isinstance(current, ServiceTask):
-                    log("DOING:", current)
-                    can_continue = await current.run(self.variables, _id)
-                    # Helper variables for DB insert
-                    new_variables = {
-                        k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
-                    }
-                    current_and_variables_dict[current._id] = new_variables
-
-                elif isinstance(current, SendTask):
-                    log("DOING:", current)
-                    can_continue = current.run(self.variables, _id)
-                    # Helper variables for DB insert
-                    new_variables = {
-                        k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
-                    }
-                    current_and_variables_dict[current._id] = new_variables
-
-                elif isinstance(current, CallActivity):
-                    # TODO implement Variables tab CallActivity
-                    log("DOING:", current)
-                    can_continue = await self.run_subprocess(current.called_element)
-                    # Helper variables for DB insert
-                    new_variables = {
-                        k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
-                    }
-                    current_and_variables_dict[current._id] = new_variables
+        self.finished = asyncio.get_running_loop().create_future()
+        default_search_index.update(self._id, self.variables)
+        self.publish(self.variables)
+        for node in self.tokens:
+            current = self.graph.nodes[node]
+            # Restored timers are persisted, armed again only if missing
+            for boundary in self.graph.boundaries[node]:
+                self.arm(self.graph.nodes[boundary], ensure=True)
+            if isinstance(current, IntermediateCatchEvent) and current.timer:
+                self.arm(current, ensure=True)
+                self.scheduler.wait(self, current._id, node)
+            elif getattr(current, "message", None):
+                message = self.receive(node)
+                if message is not None:
+                    self.scheduler.schedule(self, node, message)
+            elif isinstance(current, UserTask):
+                # Parked right away, a restored instance can take a form at once
+                self.scheduler.wait(self, current._id, node)
+            else:
+                self.scheduler.schedule(self, node)
+        return self.finished
+
+    def arm(self, event, ensure=False):
+        self.timed = True
+        timer = event.timer.timer(self._id, event._id, self.variables)
+        if ensure:
+            default_timer_service.ensure(timer)
+        else:
+            default_timer_service.arm(timer)
+
+    def disarm(self, event):
+        default_timer_service.cancel(Timer.key(self._id, event._id))
+
+    # Subscribes node to its message and parks it, unless a buffered
+    # message is taken right away
+    def receive(self, node):
+        current = self.graph.nodes[node]
+        key = current.message.key(self.variables, self._id)
+        buffered = default_correlator.subscribe(
+            self._id, current._id, current.message.name, key
+        )
+        if buffered is None:
+            self.scheduler.wait(self, current._id, node)
+            return None
+        return MessageReceived(current._id, buffered)
+
+    def timer_fired(self, timer):
+        graph = self.graph
+        node = graph.index.get(timer.element_id)
+        if self.state != "running" or node is None:
+            return
+        event = graph.nodes[node]
+        self.log.debug("timer fired", element=event._id)
+        if not isinstance(event, BoundaryEvent):
+            self.scheduler.deliver(self._id, TimerMessage(event._id))
+            return
+        activity = graph.index[event.attached_to]
+        if activity not in self.tokens:
+            return
+        if event.cancel_activity:
+            self.tokens.complete(activity)
+            self.scheduler.withdraw(self, graph.nodes[activity]._id)
+            default_correlator.unsubscribe(self._id, graph.nodes[activity]._id)
+            for boundary in graph.boundaries[activity]:
+                self.disarm(graph.nodes[boundary])
+        self.tokens.add(node)
+        self.scheduler.schedule(self, node)
 
-                else:
-                    if isinstance(current, Task):
-                        log("DOING:", current)
-                    can_continue = current.run()
-                    # Helper variables for DB insert
-                    new_variables = {
-                        k: self.variables[k]
-                        for k in set(self.variables) - set(before_variables)
-                    }
-                    current_and_variables_dict[current._id] = new_variables
-
-                if can_continue:
-                    del self.pending[idx]
-                    break
-
-            if exit:
-                break
-
-            default = current.default if isinstance(current, ExclusiveGateway) else None
-
-            if can_continue:
-                next_tasks = []
-                if current._id in flow:
-                    default_fallback = None
-                    for sequence in flow[current._id]:
-                        if sequence._id == default:
-                            default_fallback = elements[sequence.target]
-                            continue
-
-                        if sequence.condition:
-                            if self.check_condition(
-                                self.variables, sequence.condition, log
-                            ):
-                                next_tasks.append(elements[sequence.target])
-                        else:
-                            next_tasks.append(elements[sequence.target])
-
-                    if not next_tasks and default_fallback:
-                        log("\t- going down default path...")
-                        next_tasks.append(default_fallback)
-
-                for next_task in next_tasks:
-                    if next_task not in self.pending:
-                        self.pending.append(next_task)
-                        # log("-----> Adding", next_task)
-                    # log("n", next_task)
-                    if isinstance(next_task, ParallelGateway):
-                        next_task.add_token()
+    async def run(self):
+        return await self.start()
+
+    def send(self, message):
+        self.log.debug("message in", element=message.task_id)
+        if not self.scheduler.deliver(self._id, message):
+            self.log.warning("no pending task for message", element=message.task_id)
+            return False
+        return True
+
+    def add_event(self, activity_id, activity_variables, pending=None):
+        timestamp = datetime.now()
+        snapshot = self.snapshot(timestamp)
+        self.scheduler.event_sink.add(
+            {
+                "model_name": self.model.model_path,
+                "instance_id": self._id,
+                "activity_id": activity_id,
+                "timestamp": timestamp,
+                "pending": snapshot["pending"] if pending is None else pending,
+                "activity_variables": activity_variables,
+            },
+            snapshot,
+        )
+
+    def snapshot(self, timestamp=None):
+        nodes = self.graph.nodes
+        return {
+            "instance_id": self._id,
+            "model_name": self.model.model_path,
+            "process": self.process,
+            "timestamp": timestamp or datetime.now(),
+            "pending": self.graph.ids(self.tokens),
+            "tokens": {nodes[n]._id: c for n, c in self.tokens.arrived.items()},
+            "variables": dict(self.variables),
+            "state": self.state,
+        }
+
+    def restore(self, snapshot):
+        index = self.graph.index
+        self.tokens.reset(index[p] for p in snapshot["pending"] if p in index)
+        self.tokens.arrived = {
+            index[k]: c for k, c in snapshot["tokens"].items() if k in index
+        }
+        self.variables = {**snapshot["variables"], **self.variables}
+        self.restored = True
+        return self
+
+    def next_nodes(self, node):
+        graph = self.graph
+        next_tasks = []
+        for target, condition in graph.outgoing[node]:
+            if condition:
+                if self.check_condition(self.variables, condition, self.log):
+                    next_tasks.append(target)
             else:
-                log("Waiting for user...", self.pending)
-                queue.append(await in_queue.get())
-
-            # Insert finished events into DB
-            for c in current_and_variables_dict:
-                # Add each current into DB
-                db_connector.add_event(
-                    model_name=self.model.model_path,
-                    instance_id=self._id,
-                    activity_id=c,
-                    timestamp=datetime.now(),
-                    pending=[pending._id for pending in self.pending],
-                    activity_variables=current_and_variables_dict[c],
-                )
-
-        log("DONE")
+                next_tasks.append(target)
+
+        if not next_tasks and graph.default[node] is not None:
+            self.log.debug("going down default path", element=graph.nodes[node]._id)
+            next_tasks.append(graph.default[node])
+        return next_tasks
+
+    # Executes a single pending node and returns nodes which became ready
+    async def step(self, node, message=None):
+        graph = self.graph
+        tokens = self.tokens
+        current = graph.nodes[node]
+        log = self.log
+
+        # Stale work item, e.g. join already fired or instance ended
+        if self.state != "running" or node not in tokens:
+            return []
+        default_instance_cache.touch(self)
+
+        # Records what this step writes
+        variables = StepVariables(self.variables)
+
+        if isinstance(current, EndEvent):
+            tokens.complete(node)
+            # Add EndEvent to DB
+            self.add_event(current._id, {}, pending=[])
+            self.finish()
+            return []
+
+        if isinstance(current, StartEvent):
+            # Create new running instance
+            self.scheduler.event_sink.set_running(self._id, True)
+
+        if isinstance(current, UserTask):
+            if not isinstance(message, UserFormMessage):
+                if log.enabled(logging.DEBUG):
+                    log.debug(
+                        "waiting for user, pending %s",
+                        graph.ids(tokens),
+                        element=current._id,
+                    )
+                self.scheduler.wait(self, current._id, node)
+                return []
+            user_action = message.form_data
+            log.debug(
+                "doing %s, user sent %s", current, user_action, element=current._id
+            )
+            can_continue = current.run(variables, user_action)
+
+        elif isinstance(current, IntermediateCatchEvent) and current.timer:
+            if not isinstance(message, TimerMessage):
+                self.arm(current)
+                self.scheduler.wait(self, current._id, node)
+                return []
+            if current.timer.kind == "timeCycle":
+                self.disarm(current)
+            can_continue = True
+
+        elif (
+            isinstance(current, (IntermediateCatchEvent, ReceiveTask))
+            and current.message
+        ):
+            if not isinstance(message, MessageReceived):
+                message = self.receive(node)
+                if message is None:
+                    return []
+            # Subscribed again if a restore raced the delivery
+            default_correlator.unsubscribe(self._id, current._id)
+            log.debug("received %s", current.message, element=current._id)
+            variables.update(message.message["variables"])
+            can_continue = True
+
+        elif isinstance(current, ServiceTask):
+            log.debug("doing %s", current, element=current._id)
+            can_continue = await current.run(variables, self._id)
+
+        elif isinstance(current, CallActivity):
+            log.debug("doing %s", current, element=current._id)
+            can_continue = await self.run_subprocess(current, variables)
+
+        elif isinstance(current, BusinessRule):
+            log.debug("doing %s", current, element=current._id)
+            can_continue = await current.run(variables, self.decision_model(current))
+
+        elif isinstance(current, ParallelGateway):
+            can_continue = current.run(tokens.count(node), graph.in_degree[node])
+            if not can_continue:
+                self.add_event(current._id, {})
+                return []
+
+        else:
+            if isinstance(current, Task):
+                log.debug("doing %s", current, element=current._id)
+            can_continue = current.run()
+
+        # Instance could have ended on another branch while awaiting, or
+        # an interrupting timer cancelled the activity
+        if not can_continue or self.state != "running" or node not in tokens:
+            return []
+
+        if isinstance(current, ParallelGateway):
+            # Consume joined tokens only so the join can fire again in loops
+            tokens.complete(node, graph.in_degree[node])
+        else:
+            tokens.complete(node)
+            for boundary in graph.boundaries[node]:
+                self.disarm(graph.nodes[boundary])
+
+        ready = []
+        for next_node in self.next_nodes(node):
+            # Pending UserTasks only collect another token, joins get rechecked
+            if next_node not in tokens or isinstance(
+                graph.nodes[next_node], ParallelGateway
+            ):
+                ready.append(next_node)
+            if next_node not in tokens:
+                for boundary in graph.boundaries[next_node]:
+                    self.arm(graph.nodes[boundary])
+            tokens.add(next_node)
+
+        changes = variables.changes()
+        if variables.before:
+            default_search_index.update(self._id, self.variables)
+        if isinstance(message, MessageReceived) and "id" in message.message:
+            # Buffered message is deleted in the same commit as this step
+            self.scheduler.event_sink.consume(message.message["id"], self._id)
+        self.add_event(current._id, changes)
+        self.publish(changes)
+
+        if len(tokens) == 0:
+            self.finish()
+        return ready
+
+    def finish(self):
+        self.log.info("finished")
         self.state = "finished"
-        self.pending = []
+        if default_metrics.enabled:
+            instances_total.inc(state="finished")
+        self.tokens.reset()
+        self.scheduler.cancel(self)
+        if self.timed:
+            default_timer_service.cancel_instance(self._id)
+        default_correlator.cancel_instance(self._id)
         # Running instance finished
-        db_connector.finish_running_instance(self._id)
-        return self.variables
+        self.scheduler.event_sink.set_running(self._id, False)
+        self.publish()
+        if self.finished and not self.finished.done():
+            self.finished.set_result(self.variables)
+
+    # Partition taken over by another worker, stop running here
+    def release(self):
+        self.state = "released"
+        default_timer_service.forget(self._id)
+        default_correlator.cancel_instance(self._id)
+        default_search_index.remove(self._id)
+        self.unload()
+
+    # Only waiting for a user and persisted, can be restored from the snapshot
+    def idle(self):
+        return (
+            self.state == "running"
+            and self.parent is None
+            and len(self.scheduler.waiting_by_instance.get(self._id, ()))
+            == len(self.tokens)
+            and self.scheduler.event_sink.persisted(self._id)
+        )
+
+    def unload(self):
+        self.scheduler.cancel(self)
+        self.model.instances.pop(self._id, None)
+        instance_models.pop(self._id, None)
+        default_instance_cache.discard(self)
+
+    def fail(self, error):
+        self.log.error("failed: %r", error)
+        self.state = "failed"
+        if default_metrics.enabled:
+            instances_total.inc(state="failed")
+        if self.timed:
+            default_timer_service.cancel_instance(self._id)
+        default_correlator.cancel_instance(self._id)
+        self.settle()
+        self.publish()
+        if self.finished and not self.finished.done():
+            self.finished.set_exception(error)
+
+    # Failed state is persisted so a reload does not run the failed step again
+    def settle(self):
+        sink = self.scheduler.event_sink
+        try:
+            sink.add(None, self.snapshot())
+        except Exception as e:
+            self.log.error("snapshot of failed instance not written: %r", e)
+        sink.set_running(self._id, False)
+
+
+def snapshot_state(snapshot):
+    if snapshot["running"]:
+        return "running"
+    return "failed" if snapshot.get("state") == "failed" else "finished"
+
+
+# Instance JSON from a snapshot, for listings of evicted instances or those
+# of another worker, nothing is loaded or run
+def snapshot_json(model, snapshot, fields=None, compact=False):
+    values = {
+        "id": snapshot["instance_id"],
+        "variables": snapshot["variables"],
+        "state": snapshot_state(snapshot),
+        "model": model.model_path if compact else model.to_json(),
+        "pending": snapshot["pending"],
+        "parent": None,
+        "children": [],
+        "env": env.SYSTEM_VARS,
+    }
+    fields = fields or BpmnInstance.JSON_FIELDS
+    return {f: values[f] for f in fields if f in values}
+
+
+# Resident instances only, the server also loads evicted ones
+async def fire_timer(timer):
+    model = get_model_for_instance(timer.instance_id)
+    if model and timer.instance_id in model.instances:
+        model.instances[timer.instance_id].timer_fired(timer)
+
+
+default_timer_service.handler = fire_timer
+
+
+async def deliver_message(instance_id, element_id, message):
+    model = get_model_for_instance(instance_id)
+    if not model or instance_id not in model.instances:
+        return False
+    return model.instances[instance_id].send(MessageReceived(element_id, message))
+
+
+default_correlator.handler = deliver_message
+
+
+# Writes of the instance were rejected by the database, its log is incomplete
+def event_log_failed(instance_id, error):
+    model = get_model_for_instance(instance_id)
+    if model and instance_id in model.instances:
+        instance = model.instances[instance_id]
+        if instance.state == "running":
+            instance.scheduler.cancel(instance)
+            instance.fail(error)
+
+
+default_scheduler.event_sink.on_error = event_log_failed
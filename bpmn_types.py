@@ -1,7 +1,12 @@
-import requests
 import os
 import env
+from datetime import datetime, timedelta
 from utils.common import parse_expression
+from utils.expressions import compile_expression, compile_condition
+from http_connector import default_http_connector
+from dmn_model import default_decision_batcher
+from engine_log import logger
+from timers import Timer, parse_duration, parse_date, parse_cycle
 
 NS = {
     "bpmn": "http://www.omg.org/spec/BPMN/20100524/MODEL",
@@ -21,6 +26,9 @@ def bpmn_tag(tag):
 
 
 class BpmnObject(object):
+    # Elements that await remote work are stepped outside the scheduler batch
+    blocking = False
+
     def __repr__(self):
         return f"{type(self).__name__}({self.name or self._id})"
 
@@ -62,6 +70,7 @@ class SequenceFlow(BpmnObject):
         self.source = None
         self.target = None
         self.condition = None
+        self.compiled_condition = None
 
     def parse(self, element):
         super(SequenceFlow, self).parse(element)
@@ -69,6 +78,7 @@ class SequenceFlow(BpmnObject):
         self.target = element.attrib["targetRef"]
         for c in element.findall("bpmn:conditionExpression", NS):
             self.condition = c.text
+        self.compiled_condition = compile_condition(self.condition)
 
     def __repr__(self):
         condition = f" w. {len(self.condition)} con. " if self.condition else ""
@@ -139,8 +149,69 @@ class UserTask(Task):
         }
 
 
+class MessageDefinition:
+    # messageRef of a catch event or receive task, named by the bpmn:message
+    # it refers to. Instances subscribe with the value of the element's
+    # correlation_key property, a variable name or expression, or with
+    # their own id without one.
+    def __init__(self, ref, element):
+        self.ref = ref
+        self.name = ref
+        self.correlation_key = None
+        for p in element.findall("bpmn:extensionElements//camunda:property", NS):
+            if p.attrib.get("name") == "correlation_key":
+                self.correlation_key = p.attrib["value"]
+        self.compiled = None
+        # Set when the key is a single variable, which must be set
+        self.variable = None
+        if self.correlation_key:
+            self.compiled = compile_expression(self.correlation_key)
+            variable = self.correlation_key.strip()
+            if variable.startswith("${") and variable.endswith("}"):
+                variable = variable[2:-1]
+            if "${" not in variable and "}" not in variable:
+                self.variable = variable
+
+    def resolve(self, messages):
+        self.name = messages.get(self.ref, self.ref)
+
+    def key(self, variables, instance_id):
+        if not self.compiled:
+            return instance_id
+        if self.variable is not None and self.variable not in variables:
+            raise Exception(
+                f"Correlation key {self.variable} of message {self.name} is not set"
+            )
+        return str(self.compiled(variables))
+
+    def __repr__(self):
+        return f"message({self.name})"
+
+
+def parse_message(element):
+    definition = element.find("bpmn:messageEventDefinition", NS)
+    if definition is not None:
+        ref = definition.attrib.get("messageRef")
+    else:
+        ref = element.attrib.get("messageRef")
+    return MessageDefinition(ref, element) if ref else None
+
+
+# Waits for its message like a catch event
+@bpmn_tag("bpmn:receiveTask")
+class ReceiveTask(Task):
+    def __init__(self):
+        self.message = None
+
+    def parse(self, element):
+        super(ReceiveTask, self).parse(element)
+        self.message = parse_message(element)
+
+
 @bpmn_tag("bpmn:serviceTask")
 class ServiceTask(Task):
+    blocking = True
+
     def __init__(self):
         self.properties_fields = {}
         self.input_variables = {}
@@ -150,6 +221,8 @@ class ServiceTask(Task):
             "input_variables": {},
             "output_variables": {},
         }
+        self.compiled_inputs = {}
+        self.compiled_parameters = {}
 
     def parse(self, element):
         super(ServiceTask, self).parse(element)
@@ -158,7 +231,7 @@ class ServiceTask(Task):
         try:
             datasources = env.DS
         except Exception:
-            print("No DS in env.py")
+            logger.warning("No DS in env.py")
 
         for ee in element.findall(".//bpmn:extensionElements", NS):
             # Find direct children inputOutput, Input/Output tab in Camunda
@@ -176,8 +249,37 @@ class ServiceTask(Task):
                 if connector_id in datasources:
                     ds = datasources[connector_id]
                     self.connector_fields["connector_id"] = ds["type"]
+                    self.connector_fields["datasource"] = connector_id
                     self.connector_fields["input_variables"]["base_url"] = ds["url"]
 
+        # Expressions are compiled once, run_connector only evaluates them
+        self.compiled_inputs = {
+            k: self._compile(v) for k, v in self.input_variables.items()
+        }
+        url_parameter = self.connector_fields["input_variables"].get("url_parameter")
+        if isinstance(url_parameter, dict):
+            self.compiled_parameters = self._compile(url_parameter)
+
+    @classmethod
+    def _compile(cls, value):
+        if isinstance(value, str):
+            return compile_expression(value)
+        if isinstance(value, list):
+            return [cls._compile(v) for v in value]
+        if isinstance(value, dict):
+            return {k: cls._compile(v) for k, v in value.items()}
+        return value
+
+    @classmethod
+    def _evaluate(cls, compiled, variables):
+        if callable(compiled):
+            return compiled(variables)
+        if isinstance(compiled, list):
+            return [cls._evaluate(v, variables) for v in compiled]
+        if isinstance(compiled, dict):
+            return {k: cls._evaluate(v, variables) for k, v in compiled.items()}
+        return compiled
+
     def _parse_input_output_variables(self, element, input_dict, output_dict):
         for io in element.findall(".camunda:inputOutput", NS):
             for inparam in io.findall(".camunda:inputParameter", NS):
@@ -204,30 +306,16 @@ class ServiceTask(Task):
 
     async def run_connector(self, variables, instance_id):
         # Check for URL parameters
-        parameters = {}
-        if self.connector_fields["input_variables"].get("url_parameter"):
-            for key, value in self.connector_fields["input_variables"][
-                "url_parameter"
-            ].items():
-                # Parse expression and add to parameters
-                parameters[key] = parse_expression(value, variables)
+        parameters = self._evaluate(self.compiled_parameters, variables)
 
         # JSON data for API
         data = {}
-        for key, value in self.input_variables.items():
-            # Parse expression if it exists
-            if isinstance(value, str):
-                value = parse_expression(value, variables)
-            elif isinstance(value, list):
-                value = [parse_expression(v, variables) for v in value]
-            elif isinstance(value, dict):
-                for k, v in value.items():
-                    value[k] = parse_expression(v, variables)
+        for key, value in self.compiled_inputs.items():
             # Special case for instance id
             if key == "id_instance":
-                value = instance_id
-            # Add parsed value to data
-            data[key] = value
+                data[key] = instance_id
+            else:
+                data[key] = self._evaluate(value, variables)
         # system vars
         data = {**data, **env.SYSTEM_VARS}
 
@@ -235,20 +323,17 @@ class ServiceTask(Task):
         endpoint = self.connector_fields["input_variables"]["url"].lstrip("/")
         url = f"{base_url}/{endpoint}"
 
-        # Check method and make request
-        if method := self.connector_fields["input_variables"].get("method"):
-            if method == "POST":
-                call_function = requests.post
-            elif method == "PATCH":
-                call_function = requests.patch
-            else:
-                call_function = requests.get
-
-            response = call_function(
-                url,
-                params=parameters,
-                json=data,
-            )
+        # Check method and make request, pooled per datasource
+        method = self.connector_fields["input_variables"].get("method")
+        if method not in ("POST", "PATCH"):
+            method = "GET"
+        response = await default_http_connector.request(
+            method,
+            url,
+            params=parameters,
+            data=data,
+            datasource=self.connector_fields.get("datasource"),
+        )
 
         if response.status_code not in (200, 201):
             raise Exception(response.text)
@@ -274,12 +359,22 @@ class SendTask(ServiceTask):
 
 @bpmn_tag("bpmn:callActivity")
 class CallActivity(Task):
+    blocking = True
+
     def __init__(self):
         self.deployment = False
         self.called_element = ""
+        self.in_mappings = []
+        self.out_mappings = []
 
     def parse(self, element):
         super(CallActivity, self).parse(element)
+        # Variables tab in Camunda, camunda:in and camunda:out mappings
+        for ee in element.findall("bpmn:extensionElements", NS):
+            for i in ee.findall("camunda:in", NS):
+                self.in_mappings.append(self._parse_mapping(i))
+            for o in ee.findall("camunda:out", NS):
+                self.out_mappings.append(self._parse_mapping(o))
         if element.attrib.get("calledElement"):
             self.called_element = element.attrib["calledElement"]
         if (
@@ -289,14 +384,77 @@ class CallActivity(Task):
         ):
             self.deployment = True
 
+    def _parse_mapping(self, element):
+        # (source, target), source None means all variables
+        if element.attrib.get("variables") == "all":
+            return (None, None)
+        source = element.attrib.get("source") or element.attrib.get("sourceExpression")
+        return (source, element.attrib.get("target") or source)
+
+    @staticmethod
+    def _map(mappings, source_variables, target_variables):
+        for source, target in mappings:
+            if source is None:
+                target_variables.update(source_variables)
+            elif source.startswith("${"):
+                target_variables[target] = parse_expression(source, source_variables)
+            elif source in source_variables:
+                target_variables[target] = source_variables[source]
+        return target_variables
+
+    def input_variables(self, variables):
+        return self._map(self.in_mappings, variables, {})
+
+    def output_variables(self, subprocess_variables, variables):
+        return self._map(self.out_mappings, subprocess_variables, variables)
+
+
+@bpmn_tag("bpmn:businessRuleTask")
+class BusinessRule(Task):
+    # Evaluates a decision of a DMN model loaded by the model registry,
+    # in-process and batched with other instances waiting on it
+    blocking = True
 
-@bpmn_tag("bpmn:businessRule")
-class BusinessRule(ServiceTask):
     def __init__(self):
         self.decision_ref = None
+        self.result_variable = None
+        self.map_decision_result = "resultList"
 
     def parse(self, element):
         super(BusinessRule, self).parse(element)
+        self.decision_ref = element.attrib.get(f"{{{NS['camunda']}}}decisionRef")
+        self.result_variable = element.attrib.get(f"{{{NS['camunda']}}}resultVariable")
+        self.map_decision_result = element.attrib.get(
+            f"{{{NS['camunda']}}}mapDecisionResult", "resultList"
+        )
+
+    def map_result(self, output):
+        results = output if isinstance(output, list) else [output]
+        results = [r for r in results if r is not None]
+        if self.map_decision_result in ("singleEntry", "singleResult"):
+            if len(results) > 1:
+                raise Exception(
+                    f"Decision {self.decision_ref} returned {len(results)} results"
+                )
+            if not results:
+                return None
+            if self.map_decision_result == "singleResult":
+                return results[0]
+            return next(iter(results[0].values()), None)
+        if self.map_decision_result == "collectEntries":
+            return [next(iter(r.values()), None) for r in results]
+        return results
+
+    async def run(self, variables, model):
+        output = await default_decision_batcher.decide(
+            model, self.decision_ref, variables
+        )
+        if self.result_variable:
+            variables[self.result_variable] = self.map_result(output)
+        else:
+            # Without a result variable outputs are process variables by name
+            variables.update(model.decisions[self.decision_ref].variables(output))
+        return True
 
 
 @bpmn_tag("bpmn:event")
@@ -314,6 +472,74 @@ class EndEvent(Event):
     pass
 
 
+class TimerDefinition:
+    # bpmn:timerEventDefinition with a timeDuration, timeDate or timeCycle,
+    # the value may be an expression on the instance variables
+    def __init__(self, element):
+        self.kind = None
+        self.value = None
+        for kind in ("timeDuration", "timeDate", "timeCycle"):
+            e = element.find(f"bpmn:{kind}", NS)
+            if e is not None and e.text and e.text.strip():
+                self.kind = kind
+                self.value = e.text.strip()
+        if self.kind is None:
+            raise Exception("Timer event definition without a time")
+        self.compiled = compile_expression(self.value) if "${" in self.value else None
+        if self.compiled is None:
+            # Invalid literal values fail when the model is parsed
+            self.timer("", "", {})
+
+    def timer(self, instance_id, element_id, variables, now=None):
+        now = now or datetime.now()
+        value = str(self.compiled(variables)) if self.compiled else self.value
+        if self.kind == "timeDuration":
+            due = now + timedelta(seconds=parse_duration(value))
+            return Timer(instance_id, element_id, due)
+        if self.kind == "timeDate":
+            return Timer(instance_id, element_id, parse_date(value))
+        due, repeat, interval = parse_cycle(value, now)
+        return Timer(instance_id, element_id, due, repeat, interval)
+
+    def __repr__(self):
+        return f"{self.kind}({self.value})"
+
+
+def parse_timer(element):
+    definition = element.find("bpmn:timerEventDefinition", NS)
+    return TimerDefinition(definition) if definition is not None else None
+
+
+# Waits for its timer or message, other event definitions pass straight
+# through
+@bpmn_tag("bpmn:intermediateCatchEvent")
+class IntermediateCatchEvent(Event):
+    def __init__(self):
+        self.timer = None
+        self.message = None
+
+    def parse(self, element):
+        super(IntermediateCatchEvent, self).parse(element)
+        self.timer = parse_timer(element)
+        self.message = parse_message(element)
+
+
+# Armed while its activity holds a token, interrupting events cancel the
+# activity when they fire
+@bpmn_tag("bpmn:boundaryEvent")
+class BoundaryEvent(Event):
+    def __init__(self):
+        self.timer = None
+        self.attached_to = None
+        self.cancel_activity = True
+
+    def parse(self, element):
+        super(BoundaryEvent, self).parse(element)
+        self.attached_to = element.attrib["attachedToRef"]
+        self.cancel_activity = element.attrib.get("cancelActivity", "true") != "false"
+        self.timer = parse_timer(element)
+
+
 @bpmn_tag("bpmn:gateway")
 class Gateway(BpmnObject):
     def parse(self, element):
@@ -324,11 +550,9 @@ class Gateway(BpmnObject):
 
 @bpmn_tag("bpmn:parallelGateway")
 class ParallelGateway(Gateway):
-    def add_token(self):
-        self.incoming -= 1
-
-    def run(self):
-        return self.incoming == 0
+    # Join state is kept by the instance, element itself stays read-only
+    def run(self, tokens, in_degree):
+        return tokens >= in_degree
 
 
 @bpmn_tag("bpmn:exclusiveGateway")
@@ -0,0 +1,65 @@
+import asyncio
+from metrics import default_metrics
+
+
+class Subscriber:
+    # Deltas waiting for one client, coalesced per instance so a slow
+    # client gets the latest state instead of a growing backlog
+    def __init__(self, instances=None, models=None):
+        self.instances = set(instances) if instances else None
+        self.models = set(models) if models else None
+        self.deltas = {}
+        self.ready = asyncio.Event()
+
+    def wants(self, delta):
+        if self.instances is not None and delta["id"] not in self.instances:
+            return False
+        if self.models is not None and delta["model"] not in self.models:
+            return False
+        return True
+
+    def push(self, delta):
+        current = self.deltas.get(delta["id"])
+        if current is not None:
+            variables = {**current.get("variables", {}), **delta.get("variables", {})}
+            delta = {**current, **delta}
+            if variables:
+                delta["variables"] = variables
+        self.deltas[delta["id"]] = delta
+        self.ready.set()
+
+    async def next(self, interval=0.1):
+        await self.ready.wait()
+        # Changes arriving within the interval go out as one delta
+        await asyncio.sleep(interval)
+        self.ready.clear()
+        deltas, self.deltas = self.deltas, {}
+        return list(deltas.values())
+
+
+class ChangeFeed:
+    # Instance state changes pushed by the engine to live subscribers,
+    # publishing costs nothing while nobody listens
+    def __init__(self):
+        self.subscribers = set()
+
+    def subscribe(self, instances=None, models=None):
+        subscriber = Subscriber(instances, models)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, delta):
+        for subscriber in self.subscribers:
+            if subscriber.wants(delta):
+                subscriber.push(delta)
+
+
+default_change_feed = ChangeFeed()
+default_metrics.gauge(
+    "change_feed_subscribers",
+    "Clients connected to /feed",
+    lambda: len(default_change_feed.subscribers),
+)
@@ -0,0 +1,149 @@
+import asyncio
+import time
+import zlib
+from uuid import uuid4
+import db_connector
+import env
+
+
+class Cluster:
+    # Instance ids are hashed into partitions and every worker process runs
+    # the instances of the partitions it holds a lease on. Leases are
+    # renewed while the worker lives, partitions of a crashed or stopped
+    # worker are taken over by the others once its leases expire. Every
+    # worker also holds a presence lease (partition -1 - worker), partitions
+    # taken over are handed back once their preferred worker is alive again.
+    def __init__(self, workers=1, worker=0, url="", partitions=64, lease_ttl=30):
+        self.enabled = workers > 1
+        self.workers = workers
+        self.owner = self.worker_name(worker)
+        self.presence = -1 - worker
+        self.url = url
+        self.partitions = partitions
+        self.lease_ttl = lease_ttl
+        self.preferred = {p for p in range(partitions) if p % workers == worker}
+        # A single worker owns everything without touching the database
+        self.owned = set() if self.enabled else set(range(partitions))
+        self.owners = {}
+        # Local deadline of every lease acquired, by partition
+        self.expires = {}
+
+    @staticmethod
+    def worker_name(worker):
+        return f"worker-{worker}"
+
+    def partition(self, instance_id):
+        return zlib.crc32(instance_id.encode()) % self.partitions
+
+    def preferred_owner(self, partition):
+        return self.worker_name(partition % self.workers)
+
+    def owns(self, instance_id):
+        return not self.enabled or self.partition(instance_id) in self.owned
+
+    def owner_url(self, instance_id):
+        return self.owners.get(self.partition(instance_id))
+
+    def new_instance_id(self, near=None):
+        # Drawn until it falls into an owned partition, or into the
+        # partition of near so called instances live with their caller
+        if not self.enabled:
+            return str(uuid4())
+        partitions = {self.partition(near)} if near else self.owned
+        if not partitions:
+            raise Exception(f"{self.owner} owns no partitions")
+        while True:
+            _id = str(uuid4())
+            if self.partition(_id) in partitions:
+                return _id
+
+    # Held partitions are read back from the database, a renewal that lost
+    # a race only drops the partitions another worker really took
+    def refresh(self):
+        if not self.enabled:
+            return set(), set()
+        started = time.monotonic()
+        acquired = db_connector.acquire_leases(
+            self.owner,
+            self.url,
+            [self.presence] + sorted(self.owned | self.preferred),
+            self.lease_ttl,
+        )
+        self._renewed(acquired, started)
+        leases = db_connector.get_leases()
+        if leases is None:
+            return self._expire()
+        alive = {
+            lease["owner"]
+            for p, lease in leases.items()
+            if p < 0 and not lease["expired"]
+        }
+        # Partitions of a live worker are left for it to take back
+        expired = [
+            p
+            for p, lease in leases.items()
+            if p >= 0 and lease["expired"] and self.preferred_owner(p) not in alive
+        ]
+        if expired:
+            acquired = db_connector.acquire_leases(
+                self.owner, self.url, expired, self.lease_ttl, only_expired=True
+            )
+            self._renewed(acquired, started)
+            leases = db_connector.get_leases()
+            if leases is None:
+                return self._expire()
+        held = {
+            p
+            for p, lease in leases.items()
+            if p >= 0 and lease["owner"] == self.owner and not lease["expired"]
+        }
+        returned = {
+            p for p in held - self.preferred if self.preferred_owner(p) in alive
+        }
+        if returned:
+            db_connector.release_leases(self.owner, sorted(returned))
+            held -= returned
+        self.owners = {
+            p: lease["url"]
+            for p, lease in leases.items()
+            if p >= 0 and not lease["expired"] and p not in returned
+        }
+        gained, lost = held - self.owned, self.owned - held
+        self.owned = held
+        return gained, lost
+
+    # Deadlines count from before the write, never later than the database's
+    def _renewed(self, acquired, started):
+        for p in acquired or ():
+            self.expires[p] = started + self.lease_ttl
+
+    # Database unreachable, owned partitions are kept until their leases
+    # expire, by then another worker may have taken them
+    def _expire(self):
+        now = time.monotonic()
+        lost = {p for p in self.owned if self.expires.get(p, 0) <= now}
+        self.owned -= lost
+        return set(), lost
+
+    async def maintain(self, on_change):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            gained, lost = self.refresh()
+            if gained or lost:
+                await on_change(gained, lost)
+
+    def release(self):
+        if self.enabled:
+            db_connector.release_leases(self.owner)
+            self.owned = set()
+            self.expires = {}
+
+
+config = getattr(env, "CLUSTER", {})
+default_cluster = Cluster(
+    workers=config.get("workers", 1),
+    worker=config.get("worker", 0),
+    url=config.get("url", ""),
+    partitions=config.get("partitions", 64),
+    lease_ttl=config.get("lease_ttl", 30),
+)
@@ -0,0 +1,229 @@
+import asyncio
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+import db_connector
+import env
+from cluster import default_cluster
+from event_sink import default_event_sink
+from engine_log import logger
+from metrics import default_metrics
+
+messages_total = default_metrics.counter(
+    "bpmn_messages_total",
+    "Messages received, by outcome: correlated, buffered, rejected or expired",
+)
+
+
+def _count(status):
+    if default_metrics.enabled:
+        messages_total.inc(status=status)
+
+
+class MessageCorrelator:
+    # Index of instances waiting for a message by (message name, correlation
+    # key), a message finds its instance without scanning any. Messages
+    # nobody waits for are buffered in the database until an instance
+    # subscribes or they expire after ttl seconds, a full buffer rejects
+    # new messages instead of dropping old ones. A buffered message is
+    # deleted with the event of the step that took it, a crash before that
+    # step is written leaves it buffered. With several workers the buffer
+    # is shared and looked up in the database, sweep() delivers messages
+    # buffered by another worker while an instance here subscribed.
+    def __init__(
+        self,
+        ttl=86400,
+        capacity=10000,
+        sweep_interval=60,
+        shared=False,
+        event_sink=default_event_sink,
+    ):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.sweep_interval = sweep_interval
+        self.shared = shared
+        self.event_sink = event_sink
+        self.subscriptions = defaultdict(dict)
+        self.by_instance = defaultdict(set)
+        # Local buffer, oldest message first per (name, key)
+        self.buffer = defaultdict(deque)
+        self.buffered = 0
+        # Shared buffer: ids taken here whose deletion is not written yet
+        self.taken = set()
+        # Delivers (instance_id, element_id, message), True if the instance
+        # took it, set by the engine
+        self.handler = None
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.by_instance.values())
+
+    def waiting(self, name, key):
+        return bool(self.subscriptions.get((name, str(key))))
+
+    # Returns a buffered message right away, otherwise subscribes
+    def subscribe(self, instance_id, element_id, name, key):
+        key = str(key)
+        message = self._take(name, key)
+        if message is None:
+            self.subscriptions[(name, key)][(instance_id, element_id)] = None
+            self.by_instance[instance_id].add((name, key, element_id))
+        return message
+
+    def unsubscribe(self, instance_id, element_id):
+        for name, key, element in list(self.by_instance.get(instance_id, ())):
+            if element == element_id:
+                self._remove(instance_id, element_id, name, key)
+
+    def cancel_instance(self, instance_id):
+        for name, key, element_id in list(self.by_instance.get(instance_id, ())):
+            self._remove(instance_id, element_id, name, key)
+
+    def _remove(self, instance_id, element_id, name, key):
+        subscribers = self.subscriptions.get((name, key))
+        if subscribers is not None:
+            subscribers.pop((instance_id, element_id), None)
+            if not subscribers:
+                del self.subscriptions[(name, key)]
+        entries = self.by_instance.get(instance_id)
+        if entries is not None:
+            entries.discard((name, key, element_id))
+            if not entries:
+                del self.by_instance[instance_id]
+
+    # Oldest subscriber takes the message, without one it is buffered
+    # unless buffer is False
+    async def correlate(self, name, key, variables=None, buffer=True):
+        key = str(key)
+        message = {
+            "message_name": name,
+            "correlation_key": key,
+            "variables": variables or {},
+            "received": datetime.now(),
+        }
+        while self.subscriptions.get((name, key)):
+            instance_id, element_id = next(iter(self.subscriptions[(name, key)]))
+            self._remove(instance_id, element_id, name, key)
+            if await self.handler(instance_id, element_id, message):
+                _count("correlated")
+                return {
+                    "status": "correlated",
+                    "instance_id": instance_id,
+                    "element_id": element_id,
+                }
+        if not buffer:
+            return {"status": "not_waiting"}
+        return self._buffer(message)
+
+    def _buffer(self, message):
+        name, key = message["message_name"], message["correlation_key"]
+        if self.buffered >= self.capacity:
+            logger.warning("Message buffer full, rejected message %s/%s", name, key)
+            _count("rejected")
+            return {"status": "rejected", "message": "Message buffer full"}
+        message["expires"] = message["received"] + timedelta(seconds=self.ttl)
+        message_id = db_connector.add_message(message)
+        if message_id is None:
+            _count("rejected")
+            return {"status": "rejected", "message": "Message not saved"}
+        message["id"] = message_id
+        if not self.shared:
+            self.buffer[(name, key)].append(message)
+        self.buffered += 1
+        _count("buffered")
+        return {"status": "buffered", "message_id": message_id}
+
+    def _take(self, name, key):
+        if self.shared:
+            message = db_connector.find_message(name, key, self.taken)
+            if message is not None:
+                self.taken.add(message["id"])
+                self.buffered = max(self.buffered - 1, 0)
+        else:
+            message = None
+            queue = self.buffer.get((name, key))
+            now = datetime.now()
+            while queue and message is None:
+                candidate = queue.popleft()
+                self.buffered -= 1
+                if candidate["expires"] > now:
+                    message = candidate
+                else:
+                    self._expire(candidate)
+            if queue is not None and not queue:
+                del self.buffer[(name, key)]
+        return message
+
+    def _expire(self, message):
+        logger.warning(
+            "Message %s/%s received %s expired without a subscriber",
+            message["message_name"],
+            message["correlation_key"],
+            message["received"],
+        )
+        _count("expired")
+        self.event_sink.consume(message["id"])
+
+    # Buffered messages of a previous run
+    def load(self):
+        messages = db_connector.get_messages()
+        if self.shared:
+            self.buffered = len(messages)
+        else:
+            self.buffer.clear()
+            for message in messages:
+                key = (message["message_name"], message["correlation_key"])
+                self.buffer[key].append(message)
+            self.buffered = len(messages)
+        logger.info("%d buffered messages loaded", len(messages))
+        return len(messages)
+
+    async def sweep(self):
+        now = datetime.now()
+        if not self.shared:
+            for key, queue in list(self.buffer.items()):
+                while queue and queue[0]["expires"] <= now:
+                    self._expire(queue.popleft())
+                    self.buffered -= 1
+                if not queue:
+                    del self.buffer[key]
+            return
+        messages = db_connector.get_messages()
+        self.taken &= {m["id"] for m in messages}
+        expired = [m for m in messages if m["expires"] <= now]
+        for message in expired:
+            if message["id"] not in self.taken:
+                self._expire(message)
+                self.taken.add(message["id"])
+        self.buffered = len(messages) - len(expired)
+        for message in messages:
+            key = (message["message_name"], message["correlation_key"])
+            if message["id"] in self.taken or not self.subscriptions.get(key):
+                continue
+            instance_id, element_id = next(iter(self.subscriptions[key]))
+            self._remove(instance_id, element_id, *key)
+            self.taken.add(message["id"])
+            if not await self.handler(instance_id, element_id, message):
+                self.taken.discard(message["id"])
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self.sweep()
+
+
+config = getattr(env, "MESSAGES", {})
+default_correlator = MessageCorrelator(
+    ttl=config.get("ttl", 86400),
+    capacity=config.get("capacity", 10000),
+    sweep_interval=config.get("sweep_interval", 60),
+    shared=default_cluster.enabled,
+)
+default_metrics.gauge(
+    "bpmn_message_subscriptions",
+    "Instances waiting for a message",
+    lambda: len(default_correlator),
+)
+default_metrics.gauge(
+    "bpmn_buffered_messages",
+    "Messages waiting for a subscriber",
+    lambda: default_correlator.buffered,
+)
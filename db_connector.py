@@ -1,5 +1,6 @@
 from pony.orm import *
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import defaultdict
 import env
 import os
 import logging
@@ -19,9 +20,11 @@ class Event(DB.Entity):
     timestamp = Required(datetime, precision=6)
     pending = Required(StrArray)
     activity_variables = Required(Json)
+    composite_index(instance_id, timestamp)
 
     def to_dict(self):
         return {
+            "id": self.id,
             "model_name": self.model_name,
             "instance_id": self.instance_id,
             "activity_id": self.activity_id,
@@ -36,6 +39,79 @@ class RunningInstance(DB.Entity):
     instance_id = Required(str, unique=True)
 
 
+# Partition of instance ids run by one worker process until expires
+class Lease(DB.Entity):
+    partition = PrimaryKey(int)
+    owner = Required(str)
+    url = Required(str)
+    expires = Required(datetime, precision=6)
+
+
+# Armed timer event of an instance, written with the event log so it
+# commits together with the snapshot of the step that armed it
+class Timer(DB.Entity):
+    timer_id = PrimaryKey(str)
+    instance_id = Required(str, index=True)
+    element_id = Required(str)
+    due = Required(datetime, precision=6, index=True)
+    repeat = Required(int)
+    interval = Required(float)
+
+    def to_dict(self):
+        return {
+            "timer_id": self.timer_id,
+            "instance_id": self.instance_id,
+            "element_id": self.element_id,
+            "due": self.due,
+            "repeat": self.repeat,
+            "interval": self.interval,
+        }
+
+
+# Message no instance was waiting for, kept until an instance subscribes
+# to its name and correlation key or it expires
+class BufferedMessage(DB.Entity):
+    message_name = Required(str)
+    correlation_key = Required(str)
+    variables = Required(Json)
+    received = Required(datetime, precision=6)
+    expires = Required(datetime, precision=6, index=True)
+    composite_index(message_name, correlation_key)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "message_name": self.message_name,
+            "correlation_key": self.correlation_key,
+            "variables": self.variables,
+            "received": self.received,
+            "expires": self.expires,
+        }
+
+
+# Latest state of an instance, overwritten on every flush of the event log
+class Snapshot(DB.Entity):
+    instance_id = PrimaryKey(str)
+    model_name = Required(str)
+    process = Required(str)
+    timestamp = Required(datetime, precision=6)
+    pending = Required(StrArray)
+    tokens = Required(Json)
+    variables = Required(Json)
+    state = Optional(str)
+
+    def to_dict(self):
+        return {
+            "instance_id": self.instance_id,
+            "model_path": self.model_name,
+            "process": self.process,
+            "pending": self.pending,
+            "tokens": self.tokens,
+            "variables": self.variables,
+            "state": self.state,
+        }
+
+
 def setup_db():
     try:
         if not os.path.isdir("database"):
@@ -67,7 +143,7 @@ def add_event(
             activity_variables=activity_variables,
         )
         commit()  # Explicitly committing the changes
-        logger.info(f"Event added for instance_id={instance_id}")
+        logger.debug("Event added for instance_id=%s", instance_id)
         return {"status": "success"}
     except Exception as e:
         rollback()  # Reverting any changes due to the error
@@ -75,43 +151,104 @@ def add_event(
         return {"status": "error", "message": str(e)}
 
 
-@db_session
-def get_all_events():
-    logger.info("Fetching all events")
-    return select(e for e in Event)[:]
+# Upserts timers by id, None deletes the timer
+def _save_timers(timers):
+    existing = {
+        t.timer_id: t for t in Timer.select(lambda t: t.timer_id in timers.keys())
+    }
+    for timer_id, timer in timers.items():
+        if timer is None:
+            if timer_id in existing:
+                existing[timer_id].delete()
+        elif timer_id in existing:
+            existing[timer_id].set(**timer)
+        else:
+            Timer(**timer)
 
 
 @db_session
-def add_running_instance(instance_id):
+def add_events(
+    events,
+    snapshots=None,
+    timers=None,
+    dropped_timers=None,
+    consumed_messages=None,
+    running=None,
+):
     try:
-        RunningInstance(instance_id=instance_id, running=True)
-        commit()
-        logger.info(f"Running instance added with instance_id={instance_id}")
+        for event in events:
+            Event(**event)
+        if consumed_messages:
+            consumed = list(consumed_messages)
+            BufferedMessage.select(lambda m: m.id in consumed).delete(bulk=True)
+        if dropped_timers:
+            Timer.select(lambda t: t.instance_id in dropped_timers).delete(bulk=True)
+        if timers:
+            _save_timers(timers)
+        if snapshots:
+            existing = {
+                s.instance_id: s
+                for s in Snapshot.select(lambda s: s.instance_id in snapshots.keys())
+            }
+            for instance_id, snapshot in snapshots.items():
+                if instance_id in existing:
+                    existing[instance_id].set(**snapshot)
+                else:
+                    Snapshot(**snapshot)
+        if running:
+            existing = {
+                r.instance_id: r
+                for r in RunningInstance.select(
+                    lambda r: r.instance_id in running.keys()
+                )
+            }
+            for instance_id, is_running in running.items():
+                if instance_id in existing:
+                    existing[instance_id].running = is_running
+                else:
+                    RunningInstance(instance_id=instance_id, running=is_running)
+        commit()  # One transaction for the whole batch
+        logger.debug("%d events added", len(events))
         return {"status": "success"}
     except Exception as e:
         rollback()
-        logger.error(
-            f"Error adding running instance with instance_id={instance_id}: {e}"
-        )
-        return {"status": "error", "message": str(e)}
+        logger.error(f"Error adding batch of {len(events)} events: {e}")
+        # The sink decides what to retry, the error must reach it
+        raise
 
 
 @db_session
-def finish_running_instance(instance):
-    try:
-        finished_instance = RunningInstance.get(instance_id=instance)
-        if finished_instance:
-            finished_instance.running = False
-            commit()
-            logger.info(f"Running instance finished with instance_id={instance}")
-            return {"status": "success"}
-        else:
-            logger.warning(f"Instance not found with instance_id={instance}")
-            return {"status": "error", "message": "Instance not found"}
-    except Exception as e:
-        rollback()
-        logger.error(f"Error finishing instance with instance_id={instance}: {e}")
-        return {"status": "error", "message": str(e)}
+def get_all_events():
+    logger.info("Fetching all events")
+    return select(e for e in Event)[:]
+
+
+# One page of events in insertion order, after is the id of the last event
+# of the previous page. Filters run in SQL so pages stay cheap on any size.
+@db_session
+def get_events_page(
+    after=None,
+    limit=1000,
+    model_name=None,
+    instance_id=None,
+    activity_id=None,
+    since=None,
+    until=None,
+):
+    query = Event.select()
+    if after is not None:
+        query = query.filter(lambda e: e.id > after)
+    if model_name:
+        query = query.filter(lambda e: e.model_name == model_name)
+    if instance_id:
+        query = query.filter(lambda e: e.instance_id == instance_id)
+    if activity_id:
+        query = query.filter(lambda e: e.activity_id == activity_id)
+    if since:
+        query = query.filter(lambda e: e.timestamp >= since)
+    if until:
+        query = query.filter(lambda e: e.timestamp < until)
+    return [event.to_dict() for event in query.order_by(Event.id)[:limit]]
 
 
 @db_session
@@ -120,6 +257,8 @@ def delete_instance(instance_id):
         instance_to_delete = RunningInstance.get(instance_id=instance_id)
         if instance_to_delete:
             instance_to_delete.delete()
+            Snapshot.select(lambda s: s.instance_id == instance_id).delete(bulk=True)
+            Timer.select(lambda t: t.instance_id == instance_id).delete(bulk=True)
             commit()
             logger.info(f"Instance deleted with instance_id={instance_id}")
             return {"status": "success"}
@@ -134,20 +273,270 @@ def delete_instance(instance_id):
         return {"status": "error", "message": str(e)}
 
 
+def _get_events_by_instance(instance_ids, chunk_size=500):
+    # One query per chunk of instances instead of one query per instance
+    events = defaultdict(list)
+    for i in range(0, len(instance_ids), chunk_size):
+        chunk = instance_ids[i : i + chunk_size]
+        query = Event.select(lambda e: e.instance_id in chunk).order_by(
+            Event.instance_id, Event.timestamp
+        )
+        for event in query:
+            events[event.instance_id].append(event)
+    return events
+
+
+@db_session
+def get_running_instances_snapshots():
+    try:
+        logger.info("Fetching running instances snapshots")
+        data = [
+            snapshot.to_dict()
+            for snapshot in select(
+                s
+                for s in Snapshot
+                for r in RunningInstance
+                if r.running and r.instance_id == s.instance_id
+            )
+        ]
+        # Instances started before snapshots existed are replayed from the log
+        missing = select(
+            r.instance_id
+            for r in RunningInstance
+            if r.running
+            and not exists(s for s in Snapshot if s.instance_id == r.instance_id)
+        )[:]
+        for instance_id, events in _get_events_by_instance(list(missing)).items():
+            data.append(
+                {
+                    "instance_id": instance_id,
+                    "model_path": events[-1].model_name,
+                    "events": [
+                        {
+                            "activity_id": event.activity_id,
+                            "pending": event.pending,
+                            "activity_variables": event.activity_variables,
+                        }
+                        for event in events
+                    ],
+                }
+            )
+        logger.info(f"{len(data)} running instances snapshots fetched")
+        return data
+    except Exception as e:
+        logger.error(f"Error fetching running instances snapshots: {e}")
+        return []
+
+
+# Timers due in (after, until], the timer service loads them a window at
+# a time instead of keeping every timer in memory
+@db_session
+def get_timers(after, until):
+    try:
+        query = Timer.select(lambda t: t.due <= until)
+        if after is not None:
+            query = query.filter(lambda t: t.due > after)
+        return [t.to_dict() for t in query]
+    except Exception as e:
+        logger.error(f"Error fetching timers due until {until}: {e}")
+        return []
+
+
+@db_session
+def get_timer(timer_id):
+    try:
+        timer = Timer.get(timer_id=timer_id)
+        return timer.to_dict() if timer else None
+    except Exception as e:
+        logger.error(f"Error fetching timer_id={timer_id}: {e}")
+        return None
+
+
+# Persisted timers of many instances, one query per chunk of instances
+@db_session
+def get_timers_for(instance_ids, chunk_size=500):
+    try:
+        timers = []
+        for i in range(0, len(instance_ids), chunk_size):
+            chunk = instance_ids[i : i + chunk_size]
+            timers.extend(
+                t.to_dict() for t in Timer.select(lambda t: t.instance_id in chunk)
+            )
+        return timers
+    except Exception as e:
+        logger.error(f"Error fetching timers of {len(instance_ids)} instances: {e}")
+        return None
+
+
+@db_session
+def add_message(message):
+    try:
+        buffered = BufferedMessage(**message)
+        commit()
+        return buffered.id
+    except Exception as e:
+        rollback()
+        logger.error(f"Error buffering message {message['message_name']}: {e}")
+        return None
+
+
+# Buffered messages oldest first, expired ones included
+@db_session
+def get_messages():
+    try:
+        return [m.to_dict() for m in BufferedMessage.select().order_by(lambda m: m.id)]
+    except Exception as e:
+        logger.error(f"Error fetching buffered messages: {e}")
+        return []
+
+
+# Oldest unexpired message for a subscription, skipping messages already
+# taken whose deletion is not written yet
+@db_session
+def find_message(message_name, correlation_key, exclude=()):
+    try:
+        now = datetime.now()
+        query = BufferedMessage.select(
+            lambda m: m.message_name == message_name
+            and m.correlation_key == correlation_key
+            and m.expires > now
+        )
+        for message in query.order_by(lambda m: m.id):
+            if message.id not in exclude:
+                return message.to_dict()
+        return None
+    except Exception as e:
+        logger.error(f"Error fetching message {message_name}/{correlation_key}: {e}")
+        return None
+
+
+@db_session
+def delete_messages(ids):
+    try:
+        BufferedMessage.select(lambda m: m.id in ids).delete(bulk=True)
+        commit()
+    except Exception as e:
+        rollback()
+        logger.error(f"Error deleting buffered messages: {e}")
+
+
+@db_session
+def get_snapshot(instance_id):
+    try:
+        snapshot = Snapshot.get(instance_id=instance_id)
+        if not snapshot:
+            return None
+        running = RunningInstance.get(instance_id=instance_id)
+        return {**snapshot.to_dict(), "running": bool(running and running.running)}
+    except Exception as e:
+        logger.error(f"Error fetching snapshot for instance_id={instance_id}: {e}")
+        return None
+
+
+@db_session
+def get_snapshots(instance_ids):
+    # Snapshots of many instances in two queries, by instance_id
+    try:
+        running = set(
+            select(
+                r.instance_id
+                for r in RunningInstance
+                if r.instance_id in instance_ids and r.running
+            )
+        )
+        return {
+            s.instance_id: {**s.to_dict(), "running": s.instance_id in running}
+            for s in Snapshot.select(lambda s: s.instance_id in instance_ids)
+        }
+    except Exception as e:
+        logger.error(f"Error fetching snapshots of {len(instance_ids)} instances: {e}")
+        return {}
+
+
+def acquire_leases(owner, url, partitions, ttl, only_expired=False):
+    # Takes new, expired or own leases, returns partitions held by owner or
+    # None when the leases could not be written
+    try:
+        return _acquire_leases(owner, url, partitions, ttl, only_expired)
+    except Exception as e:
+        logger.error(f"Error acquiring leases for {owner}: {e}")
+        return None
+
+
+# Read again and retried if another worker changed the same leases meanwhile
+@db_session(retry=2)
+def _acquire_leases(owner, url, partitions, ttl, only_expired):
+    now = datetime.now()
+    expires = now + timedelta(seconds=ttl)
+    existing = {
+        lease.partition: lease
+        for lease in Lease.select(lambda l: l.partition in partitions)
+    }
+    held = []
+    for partition in partitions:
+        lease = existing.get(partition)
+        if lease is None:
+            if only_expired:
+                continue
+            Lease(partition=partition, owner=owner, url=url, expires=expires)
+        elif lease.owner == owner or lease.expires < now:
+            lease.set(owner=owner, url=url, expires=expires)
+        else:
+            continue
+        held.append(partition)
+    commit()
+    return held
+
+
+@db_session
+def get_leases():
+    try:
+        return {
+            lease.partition: {
+                "owner": lease.owner,
+                "url": lease.url,
+                "expired": lease.expires < datetime.now(),
+            }
+            for lease in Lease.select()
+        }
+    except Exception as e:
+        logger.error(f"Error fetching leases: {e}")
+        return None
+
+
+@db_session
+def release_leases(owner, partitions=None):
+    # Expired instead of deleted so other workers take the partitions over
+    try:
+        leases = Lease.select(lambda l: l.owner == owner)
+        if partitions is not None:
+            leases = leases.filter(lambda l: l.partition in partitions)
+        for lease in leases:
+            lease.expires = datetime.now()
+        commit()
+        logger.info(f"Leases of {owner} released")
+        return {"status": "success"}
+    except Exception as e:
+        rollback()
+        logger.error(f"Error releasing leases of {owner}: {e}")
+        return {"status": "error", "message": str(e)}
+
+
 @db_session
 def get_running_instances_log():
     try:
         log = []
         logger.info("Fetching running instances log")
         running_instances = RunningInstance.select()[:]
+        events_by_instance = _get_events_by_instance(
+            [instance.instance_id for instance in running_instances]
+        )
         for instance in running_instances:
             instance_dict = {}
             instance_dict[instance.instance_id] = {}
-            events = Event.select(
-                lambda e: e.instance_id == instance.instance_id
-            ).order_by(Event.timestamp)[:]
             events_list = []
-            for event in events:
+            model_path = None
+            for event in events_by_instance.get(instance.instance_id, []):
                 model_path = event.model_name
                 event_dict = {
                     "activity_id": event.activity_id,
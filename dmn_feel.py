@@ -0,0 +1,202 @@
+import re
+
+# Subset of FEEL used in decision table cells: "-", literals, comparisons,
+# ranges like [1..10], comma separated lists and not(...)
+
+NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+COMPARISON = re.compile(r"^(<=|>=|<|>|=|!=)\s*(.+)$")
+RANGE = re.compile(r"^([\[\]\(])\s*(.+?)\s*\.\.\s*(.+?)\s*([\[\]\)])$")
+INF = float("inf")
+
+
+def parse_literal(text):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        return text[1:-1]
+    if NUMBER.match(text):
+        return float(text) if "." in text else int(text)
+    if text in ("true", "false"):
+        return text == "true"
+    if text == "null":
+        return None
+    # Unquoted text is compared as is
+    return text
+
+
+def number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str) and NUMBER.match(value.strip()):
+        return float(value)
+    return None
+
+
+def key(value):
+    # Hash key under which equal cell literals and input values meet,
+    # form data arrives as strings so "5" matches 5 and "true" matches true
+    if isinstance(value, bool):
+        return ("bool", value)
+    if isinstance(value, str):
+        if value in ("true", "false"):
+            return ("bool", value == "true")
+        n = number(value)
+        return ("num", n) if n is not None else value
+    if isinstance(value, (int, float)):
+        return ("num", float(value))
+    return value
+
+
+def split(text):
+    parts, depth, quoted, current = [], 0, False, ""
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char in "[(":
+            depth += 1
+        elif not quoted and char in "])":
+            depth -= 1
+        elif char == "," and not quoted and depth <= 0:
+            parts.append(current)
+            current = ""
+            continue
+        current += char
+    parts.append(current)
+    return [p.strip() for p in parts if p.strip()]
+
+
+class UnaryTest:
+    def __init__(self, text):
+        self.text = text
+        self.any = False
+        self.values = []
+        self.keys = set()
+        self.negated = False
+        # (low, low_closed, high, high_closed)
+        self.intervals = []
+        self.predicate = None
+
+    def __repr__(self):
+        return f"UnaryTest({self.text})"
+
+    @property
+    def indexable(self):
+        return self.predicate is None
+
+    def test(self, value):
+        if self.any:
+            return True
+        if self.predicate:
+            return self.predicate(value)
+        return self._test(value) != self.negated
+
+    def _test(self, value):
+        try:
+            if key(value) in self.keys:
+                return True
+        except TypeError:
+            pass
+        n = number(value)
+        if n is None:
+            return False
+        for low, low_closed, high, high_closed in self.intervals:
+            if (low < n or (low_closed and low == n)) and (
+                n < high or (high_closed and high == n)
+            ):
+                return True
+        return False
+
+
+def parse_unary_tests(text):
+    test = UnaryTest(text)
+    text = (text or "").strip()
+    if text in ("", "-"):
+        test.any = True
+        return test
+
+    if text.startswith("not(") and text.endswith(")"):
+        inner = parse_unary_tests(text[4:-1])
+        if inner.any or inner.predicate:
+            test.predicate = lambda value: not inner.test(value)
+        else:
+            test.values, test.keys = inner.values, inner.keys
+            test.intervals = inner.intervals
+            test.negated = True
+        return test
+
+    for part in split(text):
+        match = COMPARISON.match(part)
+        if match:
+            op, literal = match.groups()
+            n = number(parse_literal(literal))
+            if op in ("=", "!=") or n is None:
+                # Not a numeric bound, evaluated per rule
+                test.predicate = _fallback(text)
+                return test
+            if op == "<":
+                test.intervals.append((-INF, False, n, False))
+            elif op == "<=":
+                test.intervals.append((-INF, False, n, True))
+            elif op == ">":
+                test.intervals.append((n, False, INF, False))
+            else:
+                test.intervals.append((n, True, INF, False))
+            continue
+        match = RANGE.match(part)
+        if match:
+            start, low, high, end = match.groups()
+            low, high = number(parse_literal(low)), number(parse_literal(high))
+            if low is None or high is None:
+                test.predicate = _fallback(text)
+                return test
+            test.intervals.append((low, start == "[", high, end == "]"))
+            continue
+        test.values.append(parse_literal(part))
+    test.keys = {key(v) for v in test.values}
+    return test
+
+
+def _fallback(text):
+    # Non numeric comparisons, eg. < "b" or != "x", per value
+    tests = []
+    for part in split(text):
+        match = COMPARISON.match(part)
+        range_match = RANGE.match(part)
+        if match:
+            op, literal = match.groups()
+            tests.append((op, parse_literal(literal)))
+        elif range_match:
+            start, low, high, end = range_match.groups()
+            bounds = (parse_literal(low), start == "[", parse_literal(high), end == "]")
+            tests.append(("..", bounds))
+        else:
+            tests.append(("=", parse_literal(part)))
+
+    def predicate(value):
+        for op, literal in tests:
+            try:
+                if op == "..":
+                    low, low_closed, high, high_closed = literal
+                    if (low < value or (low_closed and low == value)) and (
+                        value < high or (high_closed and high == value)
+                    ):
+                        return True
+                    continue
+                if op == "=" and key(value) == key(literal):
+                    return True
+                if op == "!=" and key(value) != key(literal):
+                    return True
+                if op == "<" and value < literal:
+                    return True
+                if op == "<=" and value <= literal:
+                    return True
+                if op == ">" and value > literal:
+                    return True
+                if op == ">=" and value >= literal:
+                    return True
+            except TypeError:
+                continue
+        return False
+
+    return predicate
@@ -1,13 +1,44 @@
+import asyncio
 import xml.etree.ElementTree as ET
 from dmn_types import *
-from collections import deque
-from copy import deepcopy
+from collections import OrderedDict, defaultdict, deque
+from engine_log import InstanceLog, default_sample
+
+
+class DecisionCache:
+    # LRU of decision outputs keyed by the decision and the values of its
+    # input columns
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return MISSING
+
+    def put(self, key, output):
+        self.entries[key] = output
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def copy_output(output):
+    if isinstance(output, list):
+        return [dict(o) for o in output]
+    return dict(output) if output is not None else None
 
 
 class DmnModel:
-    def __init__(self, model_path):
+    def __init__(self, model_path, cache_size=1024):
         self.model_path = model_path
         self.decisions = {}
+        self.cache = DecisionCache(cache_size)
 
         model_tree = ET.parse(self.model_path)
         model_root = model_tree.getroot()
@@ -16,6 +47,107 @@ class DmnModel:
             d = DMN_MAPPINGS["dmn:decision"]()
             d.parse(decision)
             self.decisions[d._id] = d
+        self.order = self.topological_order()
+        # Decisions evaluated for each decision, its requirements first
+        self.requirements = {_id: self.requirement_order(_id) for _id in self.decisions}
+
+    def topological_order(self):
+        # Required decisions first, otherwise in document order
+        remaining = {
+            _id: {r for r in d.required_decisions if r in self.decisions}
+            for _id, d in self.decisions.items()
+        }
+        order = []
+        while remaining:
+            ready = [_id for _id, required in remaining.items() if not required]
+            if not ready:
+                raise ValueError(
+                    f"Cyclic decision requirements in {self.model_path}: {list(remaining)}"
+                )
+            for _id in ready:
+                order.append(_id)
+                del remaining[_id]
+            for required in remaining.values():
+                required.difference_update(ready)
+        return tuple(order)
+
+    def requirement_order(self, decision_id):
+        needed, stack = set(), [decision_id]
+        while stack:
+            _id = stack.pop()
+            if _id in needed or _id not in self.decisions:
+                continue
+            needed.add(_id)
+            stack.extend(self.decisions[_id].required_decisions)
+        return tuple(_id for _id in self.order if _id in needed)
+
+    # Cache key of the decision for variables, None for unhashable inputs,
+    # eg. lists, which are not cached
+    def _key(self, decision, variables):
+        # Type is part of the key, "5" and 5 do not match the same cells
+        key = (decision._id,) + tuple(
+            (type(v), v)
+            for v in (
+                variables.get(column, MISSING)
+                for column in decision.decision_table.input_variables
+            )
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def evaluate(self, decision_id, variables):
+        decision = self.decisions[decision_id]
+        key = self._key(decision, variables)
+        if key is None:
+            return decision.run(variables)
+        output = self.cache.get(key)
+        if output is MISSING:
+            output = decision.run(variables)
+            self.cache.put(key, output)
+        return copy_output(output)
+
+    # Rows found in the cache are not evaluated again, the misses are
+    # evaluated together and rows with the same inputs only once
+    def evaluate_many(self, decision_id, rows):
+        decision = self.decisions[decision_id]
+        keys = [self._key(decision, row) for row in rows]
+        outputs = [MISSING if key is None else self.cache.get(key) for key in keys]
+        missed = {}
+        for i, output in enumerate(outputs):
+            if output is MISSING:
+                missed.setdefault(i if keys[i] is None else keys[i], []).append(i)
+        if missed:
+            groups = list(missed.values())
+            evaluated = decision.evaluate_many([rows[group[0]] for group in groups])
+            for group, output in zip(groups, evaluated):
+                for i in group:
+                    outputs[i] = output
+                if keys[group[0]] is not None:
+                    self.cache.put(keys[group[0]], output)
+        return [copy_output(output) for output in outputs]
+
+    # Output of decision_id, required decisions add their outputs as inputs
+    def decide(self, decision_id, variables):
+        output = None
+        for _id in self.requirements[decision_id]:
+            output = self.evaluate(_id, variables)
+            if _id != decision_id:
+                variables = {**self.decisions[_id].variables(output), **variables}
+        return output
+
+    def decide_many(self, decision_id, rows):
+        outputs = []
+        for _id in self.requirements[decision_id]:
+            outputs = self.evaluate_many(_id, rows)
+            if _id != decision_id:
+                rows = [
+                    {**self.decisions[_id].variables(output), **row}
+                    for output, row in zip(outputs, rows)
+                ]
+        return outputs
 
     async def create_instance(self, _id, bpmn_input_variables):
         instance = DmnInstance(_id, bpmn_input_variables, model=self)
@@ -28,42 +160,60 @@ class DmnInstance:
         self.bpmn_input_variables = bpmn_input_variables
         self.model = model
         self.decisions = model.decisions
-        self.decisions_queue = deque(self.sort_required_decision_list())
-
-        print("Final Decision queue : ", self.decisions_queue)
-
-    def sort_required_decision_list(self):
-        helper_list = []
-        for current, _ in self.model.decisions.items():
-            helper_list.append(current)
-            list_copy = deepcopy(helper_list)
-            if not self.decisions[current].required_decisions:
-                helper_list.remove(current)
-                helper_list.insert(0, current)
-                continue
-            for pos, dec in enumerate(list_copy):
-                # Current is required for decisions in helper list
-                if current in self.decisions[dec].required_decisions:
-                    # Current is already in good position
-                    if helper_list.index(current) < helper_list.index(dec):
-                        continue
-                    # Put current before decision it is required for
-                    else:
-                        helper_list.remove(current)
-                        helper_list.insert(pos, current)
-                if dec in self.decisions[current].required_decisions:
-                    # Current is before its required decision...
-                    # I don't think this case is possible, but additional testing is needed
-                    if helper_list.index(current) < helper_list.index(dec):
-                        print("Intervention needed")
-        return helper_list
+        self.decisions_queue = deque(model.order)
+
+        InstanceLog(_id, default_sample).debug(
+            "decision queue %s", self.decisions_queue
+        )
 
     async def run(self):
-        decisions_queue = deepcopy(self.decisions_queue)
-        input_variables = deepcopy(self.bpmn_input_variables)
-        while decisions_queue:
-            current_decision = decisions_queue.popleft()
-            current_decision = self.decisions[current_decision]
-            output = current_decision.run(input_variables)
-            input_variables = {**output, **input_variables}
+        output = None
+        input_variables = dict(self.bpmn_input_variables)
+        for current_decision in self.decisions_queue:
+            output = self.model.evaluate(current_decision, input_variables)
+            input_variables = {
+                **self.decisions[current_decision].variables(output),
+                **input_variables,
+            }
         return output
+
+
+class DecisionBatcher:
+    # Business rule tasks of instances stepped in the same scheduler batch
+    # wait on a future, requests for the same decision are then evaluated
+    # together once the batch has yielded
+    def __init__(self):
+        self.pending = defaultdict(list)
+
+    def decide(self, model, decision_id, variables):
+        loop = asyncio.get_running_loop()
+        if not self.pending:
+            loop.call_soon(self.flush)
+        future = loop.create_future()
+        self.pending[(model, decision_id)].append((variables, future))
+        return future
+
+    def flush(self):
+        pending, self.pending = self.pending, defaultdict(list)
+        for (model, decision_id), requests in pending.items():
+            rows = [variables for variables, _ in requests]
+            try:
+                outputs = model.decide_many(decision_id, rows)
+            except Exception:
+                # Hit policy violations fail only the rows causing them
+                outputs = []
+                for row in rows:
+                    try:
+                        outputs.append(model.decide(decision_id, row))
+                    except Exception as e:
+                        outputs.append(e)
+            for (_, future), output in zip(requests, outputs):
+                if future.done():
+                    continue
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
+
+
+default_decision_batcher = DecisionBatcher()
@@ -1,5 +1,31 @@
+from bisect import bisect_left
+from collections import defaultdict
+from dmn_feel import INF, key, number, parse_literal, parse_unary_tests, split
+
+try:
+    import numpy as np
+except ImportError:
+    # Batches fall back to evaluating row by row on the bitsets
+    np = None
+
 NS = {"dmn": "https://www.omg.org/spec/DMN/20191111/MODEL/"}
 
+HIT_POLICIES = (
+    "UNIQUE",
+    "FIRST",
+    "PRIORITY",
+    "ANY",
+    "COLLECT",
+    "RULE ORDER",
+    "OUTPUT ORDER",
+)
+AGGREGATIONS = ("SUM", "MIN", "MAX", "COUNT")
+# Smaller batches are not worth building the match matrix for
+BATCH_MIN = 32
+# Cells of the rows x rules match matrix evaluated at once
+BATCH_CELLS = 4_000_000
+MISSING = object()
+
 DMN_MAPPINGS = {}
 
 
@@ -40,24 +66,228 @@ class Decision(DmnObject):
     def run(self, variables):
         return self.decision_table.run(variables)
 
+    def evaluate_many(self, rows):
+        return self.decision_table.evaluate_many(rows)
+
+    def variables(self, output):
+        return self.decision_table.variables(output)
+
+
+def rule_list(mask):
+    rules = []
+    while mask:
+        bit = mask & -mask
+        rules.append(bit.bit_length() - 1)
+        mask ^= bit
+    return rules
+
+
+def words(size):
+    return (size + 63) // 64 or 1
+
+
+def packed(mask, size):
+    # Bitset as a row of the match matrix, 64 rules per uint64 word
+    return np.frombuffer(mask.to_bytes(8 * words(size), "little"), dtype="<u8")
+
+
+def unpacked(row):
+    return int.from_bytes(row.tobytes(), "little")
+
+
+def _float(value):
+    n = number(value) if value is not MISSING else None
+    return float("nan") if n is None else float(n)
+
+
+class ColumnIndex:
+    # Rule sets of one input column as bitsets (bit n is rule n): rules
+    # matching anything, rules per equal value, rules per interval region,
+    # not(...) rules per excluded value and rules whose cell can only be
+    # checked with a predicate
+    def __init__(self, tests):
+        self.any = 0
+        self.equal = defaultdict(int)
+        self.negated = 0
+        self.not_equal = defaultdict(int)
+        self.predicates = {}
+        self.predicate_rules = 0
+        self.points = []
+        self.regions = []
+        self._packed = None
+        intervals = []
+        for rule, test in enumerate(tests):
+            bit = 1 << rule
+            if test.any:
+                self.any |= bit
+            elif not test.indexable or (test.negated and test.intervals):
+                self.predicates[rule] = test
+                self.predicate_rules |= bit
+            elif test.negated:
+                self.negated |= bit
+                for k in test.keys:
+                    self.not_equal[k] |= bit
+            else:
+                for k in test.keys:
+                    self.equal[k] |= bit
+                for interval in test.intervals:
+                    intervals.append((interval, bit, len(test.intervals) > 1))
+        if intervals:
+            self._build_regions(intervals)
+
+    def _build_regions(self, intervals):
+        # Region 2i+1 is the point self.points[i], even regions are the gaps
+        self.points = sorted(
+            {p for (low, _, high, _), _, _ in intervals for p in (low, high)}
+            - {INF, -INF}
+        )
+        starts = defaultdict(int)
+        ends = defaultdict(int)
+        regions = [0] * (2 * len(self.points) + 1)
+        for (low, low_closed, high, high_closed), bit, multiple in intervals:
+            if low == -INF:
+                first = 0
+            else:
+                first = 2 * bisect_left(self.points, low) + (1 if low_closed else 2)
+            if high == INF:
+                last = len(regions) - 1
+            else:
+                last = 2 * bisect_left(self.points, high) + (1 if high_closed else 0)
+            if first > last:
+                continue
+            if multiple:
+                # Intervals of one rule could overlap, mark them one by one
+                for region in range(first, last + 1):
+                    regions[region] |= bit
+            else:
+                starts[first] |= bit
+                ends[last] |= bit
+        current = 0
+        for region in range(len(regions)):
+            current |= starts[region]
+            regions[region] |= current
+            current &= ~ends[region]
+        self.regions = regions
+
+    def region(self, n):
+        i = bisect_left(self.points, n)
+        if i < len(self.points) and self.points[i] == n:
+            return 2 * i + 1
+        return 2 * i
+
+    def match(self, value, candidates):
+        mask = self.any
+        try:
+            k = key(value)
+            mask |= self.equal.get(k, 0)
+            mask |= self.negated & ~self.not_equal.get(k, 0)
+        except TypeError:
+            # Unhashable values, eg. lists, never equal a cell literal
+            mask |= self.negated
+        if self.regions:
+            n = number(value)
+            if n is not None:
+                mask |= self.regions[self.region(n)]
+        # Predicates only run for rules which are still candidates
+        pending = candidates & self.predicate_rules
+        while pending:
+            bit = pending & -pending
+            if self.predicates[bit.bit_length() - 1].test(value):
+                mask |= bit
+            pending ^= bit
+        return mask
+
+    def _build_packed(self, size):
+        # Buckets are the cell literals of the column, then any other value,
+        # then a missing column
+        buckets = {k: i for i, k in enumerate(set(self.equal) | set(self.not_equal))}
+        masks = [
+            self.any
+            | self.equal.get(k, 0)
+            | (self.negated & ~self.not_equal.get(k, 0))
+            for k in buckets
+        ]
+        masks.append(self.any | self.negated)
+        masks.append(self.any)
+        equal = np.array([packed(m, size) for m in masks])
+        # Last region row is for values which are not numbers
+        regions = np.array([packed(m, size) for m in self.regions + [0]])
+        points = np.array(self.points, dtype=float)
+        predicates = packed(self.predicate_rules, size)
+        self._packed = (buckets, equal, points, regions, predicates)
+        return self._packed
+
+    def _bucket(self, buckets, value):
+        if value is MISSING:
+            return len(buckets) + 1
+        try:
+            return buckets.get(key(value), len(buckets))
+        except TypeError:
+            return len(buckets)
+
+    # Match matrix of the column for many values, one packed bitset per
+    # row. Predicate rules are left set for present values and checked by
+    # the table once all columns are combined.
+    def match_many(self, values, size):
+        buckets, equal, points, regions, predicates = (
+            self._packed or self._build_packed(size)
+        )
+        ids = np.fromiter(
+            (self._bucket(buckets, v) for v in values), dtype=np.intp, count=len(values)
+        )
+        matched = equal[ids]
+        if self.regions:
+            numbers = np.fromiter((_float(v) for v in values), float, len(values))
+            i = np.searchsorted(points, numbers)
+            region = 2 * i
+            if len(points):
+                region += points[np.minimum(i, len(points) - 1)] == numbers
+            region[np.isnan(numbers)] = len(self.regions)
+            matched |= regions[region]
+        if self.predicates:
+            present = ids != len(buckets) + 1
+            matched |= predicates * present[:, None]
+        return matched
+
 
 class DecisionTable(DmnObject):
     def __init__(self):
         self.hit_policy = None
+        self.aggregation = None
         self.input_variables = []
         self.output_names = []
+        self.output_values = {}
         self.rules = []
+        self.rule_ids = []
+        # Compiled at parse time
+        self.columns = []
+        self.outputs = []
+        self.all_rules = 0
+        self.match_order = []
+        self.priority_order = []
+        self.priority_rank = []
 
     def parse(self, element):
         super(DecisionTable, self).parse(element)
         self.hit_policy = (
             element.attrib["hitPolicy"] if "hitPolicy" in element.attrib else "UNIQUE"
         )
+        if self.hit_policy not in HIT_POLICIES:
+            raise ValueError(f"Unknown hit policy {self.hit_policy} in {self._id}")
+        self.aggregation = element.attrib.get("aggregation")
+        if self.aggregation and self.aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {self.aggregation} in {self._id}")
         # The input expression determines the input value of a column
         for input_expression in element.findall(".//dmn:inputExpression", NS):
             self.input_variables.append(input_expression.find("dmn:text", NS).text)
         for output in element.findall("dmn:output", NS):
             self.output_names.append(output.attrib["name"])
+            # Allowed output values, in order of priority
+            values = output.find("dmn:outputValues/dmn:text", NS)
+            if values is not None and values.text:
+                self.output_values[output.attrib["name"]] = [
+                    key(parse_literal(v)) for v in split(values.text)
+                ]
         for rule in element.findall("dmn:rule", NS):
             rule_dict = {"input": {}, "output": {}}
             for position, input_entry in enumerate(rule.findall("dmn:inputEntry", NS)):
@@ -71,36 +301,216 @@ class DecisionTable(DmnObject):
                     "dmn:text", NS
                 ).text
             self.rules.append(rule_dict)
+            self.rule_ids.append(rule.attrib.get("id"))
+        self.compile(element)
 
-    @staticmethod
-    def check_rule(rule, variables):
-        check_list = []
-        for column in rule:
-            if not rule[column]:
-                check_list.append(True)
-                continue
+    def compile(self, element):
+        entries = [
+            [e.find("dmn:text", NS).text for e in rule.findall("dmn:inputEntry", NS)]
+            for rule in element.findall("dmn:rule", NS)
+        ]
+        self.columns = [
+            ColumnIndex([parse_unary_tests(rule[position]) for rule in entries])
+            for position in range(len(self.input_variables))
+        ]
+        self.outputs = [
+            {
+                name: parse_literal(value) if value is not None else None
+                for name, value in rule["output"].items()
+            }
+            for rule in self.rules
+        ]
+        self.all_rules = (1 << len(self.rules)) - 1
+        # Columns needing predicates go last, when fewer candidates are left
+        self.match_order = sorted(
+            zip(self.input_variables, self.columns),
+            key=lambda c: len(c[1].predicates),
+        )
+        # Rules sorted by the output value lists, ties keep the rule order
+        self.priority_order = sorted(range(len(self.rules)), key=self.priority)
+        self.priority_rank = [0] * len(self.rules)
+        for position, rule in enumerate(self.priority_order):
+            self.priority_rank[rule] = position
+
+    def priority(self, rule):
+        ranks = []
+        for name in self.output_names:
+            values = self.output_values.get(name, [])
             try:
-                variables[column]
-            except KeyError:
-                check_list.append(False)
+                ranks.append(values.index(key(self.outputs[rule].get(name))))
+            except (ValueError, TypeError):
+                ranks.append(len(values))
+        return ranks
+
+    # Bitset of rules matching variables, near O(columns) for indexed cells
+    def match(self, variables):
+        candidates = self.all_rules
+        for column, index in self.match_order:
+            if column in variables:
+                candidates &= index.match(variables[column], candidates)
+            else:
+                candidates &= index.any
+            if not candidates:
+                break
+        return candidates
+
+    def unique_hit_policy_run(self, rules):
+        if len(rules) > 1:
+            raise ValueError(
+                f"Hit policy UNIQUE violated in {self._id}, rules "
+                f"{[self.rule_ids[r] for r in rules]} match"
+            )
+        if rules:
+            return dict(self.outputs[rules[0]])
+
+    def first_hit_policy_run(self, rules):
+        if rules:
+            return dict(self.outputs[rules[0]])
+
+    def priority_hit_policy_run(self, rules):
+        if rules:
+            return dict(self.outputs[min(rules, key=self.priority_rank.__getitem__)])
+
+    def any_hit_policy_run(self, rules):
+        outputs = [self.outputs[r] for r in rules]
+        if any(output != outputs[0] for output in outputs[1:]):
+            raise ValueError(
+                f"Hit policy ANY violated in {self._id}, rules "
+                f"{[self.rule_ids[r] for r in rules]} have different outputs"
+            )
+        if outputs:
+            return dict(outputs[0])
+
+    def collect_hit_policy_run(self, rules):
+        if not self.aggregation:
+            return [dict(self.outputs[r]) for r in rules]
+        output = {}
+        for name in self.output_names:
+            values = [self.outputs[r].get(name) for r in rules]
+            values = [v for v in values if v is not None]
+            if self.aggregation == "COUNT":
+                output[name] = len({key(v) for v in values})
                 continue
-            if rule[column] == variables[column]:
-                check_list.append(True)
+            values = [number(v) for v in values]
+            values = [v for v in values if v is not None]
+            if not values:
+                output[name] = None
+            elif self.aggregation == "SUM":
+                output[name] = sum(values)
+            elif self.aggregation == "MIN":
+                output[name] = min(values)
             else:
-                check_list.append(False)
-        return all(check_list)
+                output[name] = max(values)
+        return output
 
-    def unique_hit_policy_run(self, variables):
-        pass
+    def rule_order_hit_policy_run(self, rules):
+        return [dict(self.outputs[r]) for r in rules]
 
-    def first_hit_policy_run(self, variables):
-        for rule in self.rules:
-            if self.check_rule(rule["input"], variables):
-                return rule["output"]
+    def output_order_hit_policy_run(self, rules):
+        rules = sorted(rules, key=self.priority_rank.__getitem__)
+        return [dict(self.outputs[r]) for r in rules]
 
-    def run(self, variables):
+    # Output of the matched rules, in rule order, under the hit policy
+    def hit(self, rules):
         if self.hit_policy == "UNIQUE":
-            output = self.unique_hit_policy_run(variables)
+            return self.unique_hit_policy_run(rules)
         if self.hit_policy == "FIRST":
-            output = self.first_hit_policy_run(variables)
+            return self.first_hit_policy_run(rules)
+        if self.hit_policy == "PRIORITY":
+            return self.priority_hit_policy_run(rules)
+        if self.hit_policy == "ANY":
+            return self.any_hit_policy_run(rules)
+        if self.hit_policy == "COLLECT":
+            return self.collect_hit_policy_run(rules)
+        if self.hit_policy == "RULE ORDER":
+            return self.rule_order_hit_policy_run(rules)
+        return self.output_order_hit_policy_run(rules)
+
+    def run(self, variables):
+        matched = self.match(variables)
+        if self.hit_policy == "FIRST":
+            # Lowest set bit is the first matching rule
+            return self.first_hit_policy_run(rule_list(matched & -matched))
+        return self.hit(rule_list(matched))
+
+    # Output as process variables, multiple hits give a list per output name
+    def variables(self, output):
+        if output is None:
+            return {}
+        if isinstance(output, list):
+            return {name: [o.get(name) for o in output] for name in self.output_names}
         return output
+
+    # Match matrix of many rows, built column by column from the indexes
+    def match_many(self, rows):
+        size = len(self.rules)
+        matched = np.full((len(rows), words(size)), ~np.uint64(0))
+        for column, index in self.match_order:
+            values = [row.get(column, MISSING) for row in rows]
+            matched &= index.match_many(values, size)
+        # Predicates run once per distinct value of the rows where the rule
+        # is still a candidate
+        for column, index in self.match_order:
+            if not index.predicates:
+                continue
+            groups, values = self._groups([row.get(column, MISSING) for row in rows])
+            for rule, test in index.predicates.items():
+                word, bit = divmod(rule, 64)
+                bit = np.uint64(1 << bit)
+                candidates = (matched[:, word] & bit) != 0
+                failed = [
+                    g
+                    for g in np.unique(groups[candidates]).tolist()
+                    if not test.test(values[g])
+                ]
+                if failed:
+                    matched[candidates & np.isin(groups, failed), word] &= ~bit
+        return matched
+
+    @staticmethod
+    def _groups(values):
+        ids, groups, representatives = {}, [], []
+        for value in values:
+            try:
+                # Type is part of the key, 1 and True must not share a result
+                group = ids.setdefault((type(value), value), len(representatives))
+            except TypeError:
+                group = len(representatives)
+            if group == len(representatives):
+                representatives.append(value)
+            groups.append(group)
+        return np.array(groups, dtype=np.intp), representatives
+
+    def _evaluate_batch(self, rows):
+        matched = self.match_many(rows)
+        nonzero = matched != 0
+        hits = nonzero.any(axis=1)
+        if self.hit_policy == "UNIQUE":
+            several = (nonzero.sum(axis=1) > 1) | (
+                (matched & (matched - np.uint64(1))) != 0
+            ).any(axis=1)
+            if several.any():
+                row = matched[int(np.argmax(several))]
+                self.unique_hit_policy_run(rule_list(unpacked(row)))
+        if self.hit_policy not in ("UNIQUE", "FIRST"):
+            return [self.hit(rule_list(unpacked(row))) for row in matched]
+        # First matching rule from the lowest set bit of the first nonzero word
+        word = nonzero.argmax(axis=1)
+        lowest = matched[np.arange(len(rows)), word]
+        lowest &= ~lowest + np.uint64(1)
+        lowest[lowest == 0] = 1
+        first = word * 64 + np.log2(lowest.astype(float)).astype(int)
+        return [
+            dict(self.outputs[rule]) if hit else None
+            for rule, hit in zip(first.tolist(), hits.tolist())
+        ]
+
+    def evaluate_many(self, rows):
+        rows = list(rows)
+        if np is None or len(rows) < BATCH_MIN or not self.rules:
+            return [self.run(row) for row in rows]
+        results = []
+        step = max(1, BATCH_CELLS // len(self.rules))
+        for start in range(0, len(rows), step):
+            results.extend(self._evaluate_batch(rows[start : start + step]))
+        return results
@@ -0,0 +1,94 @@
+import json
+import logging
+import sys
+import zlib
+import env
+
+logger = logging.getLogger("bpmn")
+
+# Record attributes set by the engine, printed by both formatters
+FIELDS = ("instance_id", "element")
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s - %(levelname)s - %(context)s%(message)s")
+
+    def format(self, record):
+        instance_id = getattr(record, "instance_id", None)
+        element = getattr(record, "element", None)
+        record.context = f"[{instance_id}] " if instance_id else ""
+        if element:
+            record.context += f"({element}) "
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per record for log shippers
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class InstanceLog:
+    # Log records of one instance. Messages are %-style and only formatted
+    # when a record is emitted, callers guard expensive arguments with
+    # enabled(). Sampling keeps debug and info records of a stable share of
+    # instances, chosen by instance id, warnings and errors always pass.
+    __slots__ = ("instance_id", "sampled")
+
+    def __init__(self, instance_id, sample=1.0):
+        self.instance_id = instance_id
+        self.sampled = sample >= 1 or (
+            zlib.crc32(str(instance_id).encode()) % 10000 < sample * 10000
+        )
+
+    def enabled(self, level):
+        return (self.sampled or level >= logging.WARNING) and logger.isEnabledFor(
+            level
+        )
+
+    def log(self, level, msg, *args, element=None):
+        if self.enabled(level):
+            logger.log(
+                level,
+                msg,
+                *args,
+                extra={"instance_id": self.instance_id, "element": element},
+            )
+
+    def debug(self, msg, *args, element=None):
+        self.log(logging.DEBUG, msg, *args, element=element)
+
+    def info(self, msg, *args, element=None):
+        self.log(logging.INFO, msg, *args, element=element)
+
+    def warning(self, msg, *args, element=None):
+        self.log(logging.WARNING, msg, *args, element=element)
+
+    def error(self, msg, *args, element=None):
+        self.log(logging.ERROR, msg, *args, element=element)
+
+
+def configure(level="INFO", format="text", stream=None):
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if format == "json" else TextFormatter())
+    logger.handlers = [handler]
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+
+
+config = getattr(env, "LOGGING", {})
+configure(level=config.get("level", "INFO"), format=config.get("format", "text"))
+default_sample = config.get("sample", 1.0)
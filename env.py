@@ -18,3 +18,46 @@ DS = {
     "pdf": {"type": "http-connector", "url": os.getenv("PDF_CONNECTOR_URL")},
 }
 BUGSNAG = {"api_key": os.getenv("BUGSNAG")}
+EVENT_LOG = {
+    "mode": os.getenv("EVENT_LOG_MODE", "group"),
+    "max_batch": int(os.getenv("EVENT_LOG_MAX_BATCH", 500)),
+    "max_buffer": int(os.getenv("EVENT_LOG_MAX_BUFFER", 10000)),
+    "flush_interval": float(os.getenv("EVENT_LOG_FLUSH_INTERVAL", 0.05)),
+}
+HTTP_CONNECTOR = {
+    "timeout": float(os.getenv("HTTP_CONNECTOR_TIMEOUT", 30)),
+    "connect_timeout": float(os.getenv("HTTP_CONNECTOR_CONNECT_TIMEOUT", 5)),
+    "limit": int(os.getenv("HTTP_CONNECTOR_LIMIT", 100)),
+    "retries": int(os.getenv("HTTP_CONNECTOR_RETRIES", 2)),
+}
+CLUSTER = {
+    "workers": int(os.getenv("WORKERS", 1)),
+    "worker": int(os.getenv("WORKER_INDEX", 0)),
+    "url": os.getenv("WORKER_URL", ""),
+    "partitions": int(os.getenv("PARTITIONS", 64)),
+    "lease_ttl": float(os.getenv("LEASE_TTL", 30)),
+}
+INSTANCE_CACHE = {
+    "capacity": int(os.getenv("INSTANCE_CACHE_CAPACITY", 0)) or None,
+}
+SEARCH_INDEX = {
+    "capacity": int(os.getenv("SEARCH_INDEX_CAPACITY", 100000)) or None,
+}
+METRICS = {
+    "enabled": os.getenv("METRICS_ENABLED", "true").lower() == "true",
+    "profiling": os.getenv("PROFILING_ENABLED", "false").lower() == "true",
+    "profile_interval": float(os.getenv("PROFILE_INTERVAL", 0.005)),
+}
+LOGGING = {
+    "level": os.getenv("LOG_LEVEL", "INFO"),
+    "format": os.getenv("LOG_FORMAT", "text"),
+    "sample": float(os.getenv("LOG_SAMPLE", 1.0)),
+}
+TIMERS = {
+    "horizon": float(os.getenv("TIMER_HORIZON", 3600)),
+}
+MESSAGES = {
+    "ttl": float(os.getenv("MESSAGE_TTL", 86400)),
+    "capacity": int(os.getenv("MESSAGE_BUFFER_CAPACITY", 10000)),
+    "sweep_interval": float(os.getenv("MESSAGE_SWEEP_INTERVAL", 60)),
+}
@@ -11,3 +11,46 @@ DS = {
     "sendgrid": {"type": "http-connector", "url": "http://0.0.0.0:8081"},
     "pdf": {"type": "http-connector", "url": "http://0.0.0.0:8083"},
 }
+EVENT_LOG = {
+    "mode": "group",  # sync, group or async
+    "max_batch": 500,
+    "max_buffer": 10000,
+    "flush_interval": 0.05,
+}
+HTTP_CONNECTOR = {
+    "timeout": 30,  # seconds, whole request
+    "connect_timeout": 5,
+    "limit": 100,  # concurrent requests per datasource
+    "retries": 2,
+}
+CLUSTER = {
+    "workers": 1,  # worker processes sharing the database
+    "worker": 0,  # index of this worker
+    "url": "http://localhost:8080",  # where other workers reach this one
+    "partitions": 64,
+    "lease_ttl": 30,  # seconds until a dead worker's partitions are taken over
+}
+INSTANCE_CACHE = {
+    "capacity": None,  # instances kept in memory, None for no limit
+}
+SEARCH_INDEX = {
+    "capacity": 100000,  # instances searchable by variables, None for no limit
+}
+METRICS = {
+    "enabled": True,  # Prometheus metrics on GET /metrics
+    "profiling": False,  # sampling profiler on GET /metrics/profile
+    "profile_interval": 0.005,  # seconds between stack samples
+}
+LOGGING = {
+    "level": "INFO",  # DEBUG logs every step of every instance
+    "format": "text",  # or "json", one object per record
+    "sample": 1.0,  # share of instances whose debug and info records are kept
+}
+TIMERS = {
+    "horizon": 3600,  # seconds of due timers kept in memory, the rest in the db
+}
+MESSAGES = {
+    "ttl": 86400,  # seconds a message without a waiting instance is kept
+    "capacity": 10000,  # buffered messages, further ones are rejected
+    "sweep_interval": 60,  # seconds between expiry checks
+}
@@ -0,0 +1,342 @@
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import db_connector
+import env
+from engine_log import logger
+from metrics import default_metrics
+
+write_seconds = default_metrics.histogram(
+    "event_log_write_seconds", "Time to commit one batch of events and snapshots"
+)
+events_written = default_metrics.counter(
+    "event_log_events_total", "Events written to the database"
+)
+write_errors = default_metrics.counter(
+    "event_log_write_errors_total", "Instances whose writes the database rejected"
+)
+
+SYNC = "sync"  # every step commits before the engine continues
+GROUP = "group"  # steps of a scheduler batch share one commit
+ASYNC = "async"  # write-behind, flushed by size or time window
+
+
+class EventSink:
+    # Write-behind buffer for the event log. Writes run in a single worker
+    # thread so multi-row transactions never block the event loop and stay
+    # ordered. A batch the database rejects is written again one instance
+    # at a time, only the instance with the bad row loses its writes and is
+    # reported to on_error. In sync mode every step awaits its commit and
+    # its own error is raised to the step.
+    def __init__(
+        self,
+        mode=GROUP,
+        max_batch=500,
+        max_buffer=10000,
+        flush_interval=0.05,
+        writer=None,
+    ):
+        if mode not in (SYNC, GROUP, ASYNC):
+            raise ValueError(f"Unknown event log mode '{mode}'")
+        self.mode = mode
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_interval
+        self.writer = writer or db_connector.add_events
+        self.buffer = []
+        # Only the latest snapshot of each instance is kept until the flush
+        self.snapshots = {}
+        # Snapshots handed to the writer thread and not committed yet
+        self.writing = {}
+        # Timer upserts by id (None deletes) and instances whose timers go
+        self.timers = {}
+        self.dropped_timers = set()
+        # Buffered messages taken by a step, by id, deleted with its writes
+        self.consumed = {}
+        # Running flag per instance, set when it starts and ends
+        self.running = {}
+        # Called with (instance_id, error) for writes the database rejected
+        self.on_error = None
+        self.written = 0
+        self.batches = 0
+        self.write_time = 0.0
+        self.backpressure_hits = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._loop = None
+        self._lock = None
+        self._timer = None
+
+    @property
+    def backpressure(self):
+        return len(self.buffer) >= self.max_buffer
+
+    @property
+    def dirty(self):
+        return bool(
+            self.buffer
+            or self.snapshots
+            or self.timers
+            or self.dropped_timers
+            or self.consumed
+            or self.running
+        )
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "buffered": len(self.buffer),
+            "written": self.written,
+            "batches": self.batches,
+            "write_time": self.write_time,
+            "backpressure": self.backpressure,
+            "backpressure_hits": self.backpressure_hits,
+        }
+
+    def persisted(self, instance_id):
+        return instance_id not in self.snapshots and instance_id not in self.writing
+
+    # Returns False when the buffer is over capacity, callers should drain().
+    # Event None writes the snapshot only.
+    def add(self, event, snapshot=None):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        snapshots = {snapshot["instance_id"]: snapshot} if snapshot else {}
+        events = [event] if event is not None else []
+        if loop is None:
+            self._write(events, snapshots, self._take_rows(), apart=False)
+            return True
+
+        self._bind(loop)
+        self.buffer.extend(events)
+        self.snapshots.update(snapshots)
+        # Group mode relies on the timer too, blocking steps run outside batches
+        self._start_timer()
+        if self.backpressure:
+            self.backpressure_hits += 1
+            return False
+        return True
+
+    # Timer changes commit with the events of the same batch
+    def timer(self, timer_id, timer=None, instance_id=None):
+        if instance_id is not None:
+            self.dropped_timers.add(instance_id)
+            self.timers = {
+                k: v
+                for k, v in self.timers.items()
+                if v is None or v["instance_id"] != instance_id
+            }
+        else:
+            self.timers[timer_id] = timer
+        self._changed()
+
+    # A message taken by a step is deleted with the event of that step,
+    # one without instance (expired) right away
+    def consume(self, message_id, instance_id=None):
+        self.consumed[message_id] = instance_id
+        if instance_id is None:
+            self._changed()
+
+    def set_running(self, instance_id, running):
+        self.running[instance_id] = running
+        self._changed()
+
+    def _changed(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            self._write([], {}, self._take_rows(), apart=False)
+            return
+        self._bind(loop)
+        self._start_timer()
+
+    # Commit point called by the scheduler after every batch
+    async def checkpoint(self):
+        if self.mode == GROUP:
+            await self.flush()
+        elif self.mode == ASYNC:
+            await self.drain()
+
+    # Called by the scheduler after every step
+    async def commit(self, instance_id):
+        if self.mode == SYNC:
+            await self.flush(instance_id)
+
+    async def drain(self):
+        if self.backpressure:
+            await self.flush()
+
+    # Returns once everything added so far is written, including a batch
+    # another flush is writing. A write error of instance_id is raised
+    # instead of being reported to on_error.
+    async def flush(self, instance_id=None):
+        self._bind(asyncio.get_running_loop())
+        if not self.dirty and not self._lock.locked():
+            return
+        error = None
+        async with self._lock:
+            while self.dirty:
+                batch = self.buffer[: self.max_batch]
+                del self.buffer[: self.max_batch]
+                # Instances with events left for the next batch keep their
+                # snapshot and rows back, they must not commit ahead
+                later = {event["instance_id"] for event in self.buffer}
+                snapshots = self.snapshots
+                self.snapshots = {i: s for i, s in snapshots.items() if i in later}
+                snapshots = {i: s for i, s in snapshots.items() if i not in later}
+                self.writing = snapshots
+                try:
+                    failed = await self._loop.run_in_executor(
+                        self._executor,
+                        self._write,
+                        batch,
+                        snapshots,
+                        self._take_rows(later),
+                    )
+                finally:
+                    self.writing = {}
+                error = failed.pop(instance_id, error)
+                for failed_id, failure in failed.items():
+                    if self.on_error:
+                        self.on_error(failed_id, failure)
+        if error is not None:
+            raise error
+
+    async def close(self):
+        await self.flush()
+        if self._timer:
+            self._timer.cancel()
+
+    # Rows written with the next batch, only the kinds that have any.
+    # Messages and running flags of instances in later, whose events are
+    # left for the next batch, wait for them.
+    def _take_rows(self, later=()):
+        consumed, running = self.consumed, self.running
+        self.consumed, self.running = {}, {}
+        if later:
+            self.consumed = {m: i for m, i in consumed.items() if i in later}
+            consumed = {m: i for m, i in consumed.items() if i not in later}
+            self.running = {i: r for i, r in running.items() if i in later}
+            running = {i: r for i, r in running.items() if i not in later}
+        rows = {
+            "timers": self.timers,
+            "dropped_timers": self.dropped_timers,
+            "consumed_messages": consumed,
+            "running": running,
+        }
+        self.timers = {}
+        self.dropped_timers = set()
+        return {kind: value for kind, value in rows.items() if value}
+
+    # Returns {instance_id: error} of the instances whose writes failed,
+    # without apart the error is raised to the caller
+    def _write(self, batch, snapshots, rows, apart=True):
+        started = time.perf_counter()
+        failed = {}
+        try:
+            self.writer(batch, snapshots, **rows)
+            written = len(batch)
+        except Exception:
+            if not apart:
+                raise
+            failed, written = self._write_apart(batch, snapshots, rows)
+        elapsed = time.perf_counter() - started
+        self.write_time += elapsed
+        if default_metrics.enabled:
+            write_seconds.observe(elapsed)
+            events_written.inc(written)
+        self.written += written
+        self.batches += 1
+        return failed
+
+    # Writes a rejected batch again one instance at a time
+    def _write_apart(self, batch, snapshots, rows):
+        groups = defaultdict(
+            lambda: {"batch": [], "snapshots": {}, "rows": defaultdict(dict)}
+        )
+        for event in batch:
+            groups[event["instance_id"]]["batch"].append(event)
+        for instance_id, snapshot in snapshots.items():
+            groups[instance_id]["snapshots"][instance_id] = snapshot
+        for timer_id, timer in rows.get("timers", {}).items():
+            instance_id = timer_id.rsplit("/", 1)[0]
+            groups[instance_id]["rows"]["timers"][timer_id] = timer
+        for instance_id in rows.get("dropped_timers", ()):
+            groups[instance_id]["rows"]["dropped_timers"][instance_id] = None
+        for message_id, instance_id in rows.get("consumed_messages", {}).items():
+            groups[instance_id]["rows"]["consumed_messages"][message_id] = instance_id
+        for instance_id, running in rows.get("running", {}).items():
+            groups[instance_id]["rows"]["running"][instance_id] = running
+
+        failed = {}
+        written = 0
+        for instance_id, group in groups.items():
+            group_rows = dict(group["rows"])
+            if "dropped_timers" in group_rows:
+                group_rows["dropped_timers"] = set(group_rows["dropped_timers"])
+            try:
+                self.writer(group["batch"], group["snapshots"], **group_rows)
+                written += len(group["batch"])
+            except Exception as e:
+                logger.error(
+                    "Dropped %d events of instance %s, write failed: %r",
+                    len(group["batch"]),
+                    instance_id,
+                    e,
+                )
+                if default_metrics.enabled:
+                    write_errors.inc()
+                failed[instance_id] = e
+                # An instance that ended must not be resumed from its last
+                # snapshot, its running flag is written on its own
+                running = group_rows.get("running", {})
+                if running and not any(running.values()):
+                    try:
+                        self.writer([], {}, running=running)
+                    except Exception as e:
+                        logger.error(
+                            "Running flag of instance %s not written: %r",
+                            instance_id,
+                            e,
+                        )
+        return failed, written
+
+    def _bind(self, loop):
+        # Lock and timer belong to the loop the engine currently runs on
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._timer = None
+
+    def _start_timer(self):
+        if self._timer is None or self._timer.done():
+            self._timer = self._loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self.dirty:
+            if len(self.buffer) < self.max_batch:
+                await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+config = getattr(env, "EVENT_LOG", {})
+default_event_sink = EventSink(
+    mode=config.get("mode", GROUP),
+    max_batch=config.get("max_batch", 500),
+    max_buffer=config.get("max_buffer", 10000),
+    flush_interval=config.get("flush_interval", 0.05),
+)
+default_metrics.gauge(
+    "event_log_buffered",
+    "Events waiting to be written",
+    lambda: len(default_event_sink.buffer),
+)
+default_metrics.gauge(
+    "event_log_backpressure_hits",
+    "Times the event buffer was over capacity",
+    lambda: default_event_sink.backpressure_hits,
+)
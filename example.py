@@ -1,5 +1,6 @@
 import asyncio
 from bpmn_model import BpmnModel, UserFormMessage
+from event_sink import default_event_sink
 import random
 import sys
 
@@ -12,7 +13,7 @@ async def get_workload():
     return [await m.create_instance(str(i + 1), {}) for i in range(NUM_INSTANCES)]
 
 
-async def simulate_user(q):
+async def simulate_user(instance):
     WAIT = 1
 
     def auto(text):
@@ -33,35 +34,35 @@ async def simulate_user(q):
             else {}
         )
 
-    q.put_nowait(UserFormMessage("t_wrong", "null"))  # Wrong message
+    instance.send(UserFormMessage("t_wrong", "null"))  # Wrong message
     await asyncio.sleep(WAIT)
 
     a = random.randint(1, 2)
     default = f"option={a}"
     data = ask(f"Form input: [{default}]")
     
-    q.put_nowait(UserFormMessage("t0", data if data != "" else default))
+    instance.send(UserFormMessage("t0", data if data != "" else default))
     await asyncio.sleep(WAIT)
 
-    q.put_nowait(UserFormMessage("tup", ask("Form input [tup]: ")))
+    instance.send(UserFormMessage("tup", ask("Form input [tup]: ")))
     await asyncio.sleep(WAIT)
 
-    q.put_nowait(UserFormMessage("t_wrong", "null"))  # Wrong message
+    instance.send(UserFormMessage("t_wrong", "null"))  # Wrong message
     await asyncio.sleep(WAIT)
 
-    q.put_nowait(UserFormMessage("tdown", ask("Form input [tdown]: ")))
+    instance.send(UserFormMessage("tdown", ask("Form input [tdown]: ")))
     await asyncio.sleep(WAIT)
 
-    q.put_nowait(UserFormMessage("t_wrong", "null"))  # Wrong message
+    instance.send(UserFormMessage("t_wrong", "null"))  # Wrong message
     await asyncio.sleep(WAIT)
 
-    q.put_nowait(UserFormMessage("tup2", ask("Form input [tup2]: ")))
+    instance.send(UserFormMessage("tup2", ask("Form input [tup2]: ")))
     await asyncio.sleep(WAIT)
 
-    q.put_nowait(UserFormMessage("t_wrong", "null"))  # Wrong message
+    instance.send(UserFormMessage("t_wrong", "null"))  # Wrong message
     await asyncio.sleep(WAIT)
 
-    q.put_nowait(UserFormMessage("tdown2", ask("Form input [tdown2]: ")))
+    instance.send(UserFormMessage("tdown2", ask("Form input [tdown2]: ")))
     await asyncio.sleep(WAIT)
 
 
@@ -70,7 +71,8 @@ def run_serial():
         instances = await get_workload()
         for i, p in enumerate(instances):
             print(f"Running process {i+1}\n-----------------")
-            await asyncio.gather(simulate_user(p.in_queue), p.run())
+            await asyncio.gather(simulate_user(p), p.run())
+        await default_event_sink.close()
 
     asyncio.run(serial())
 
@@ -78,9 +80,10 @@ def run_serial():
 def run_parallel():
     async def parallel():
         instances = await get_workload()
-        users = [simulate_user(i.in_queue) for i in instances]
+        users = [simulate_user(i) for i in instances]
         processes = [p.run() for p in instances]
         await asyncio.gather(*users, *processes)
+        await default_event_sink.close()
 
     print(f"Running processes\n-----------------")
     asyncio.run(parallel())
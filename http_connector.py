@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+import aiohttp
+import env
+from metrics import default_metrics
+
+request_seconds = default_metrics.histogram(
+    "http_request_seconds",
+    "Service task HTTP requests including retries, by pool and status",
+)
+
+
+class HttpResponse:
+    # Mirrors the parts of requests.Response the service tasks rely on
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+# Query parameters as requests encoded them: None values are left out, lists
+# repeat the key and other values are sent as str. aiohttp rejects None and
+# bool values.
+def query_params(params):
+    if not isinstance(params, dict):
+        return params
+    query = []
+    for key, value in params.items():
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            if item is not None:
+                query.append((key, str(item)))
+    return query
+
+
+class HttpConnector:
+    # One pooled aiohttp session per datasource from env.DS, requests to
+    # other hosts share the "default" pool
+    def __init__(
+        self,
+        datasources=None,
+        timeout=30,
+        connect_timeout=5,
+        limit=100,
+        retries=2,
+        backoff=0.2,
+    ):
+        self.datasources = datasources if datasources is not None else {}
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.limit = limit
+        self.retries = retries
+        self.backoff = backoff
+        self._loop = None
+        self._sessions = {}
+        self._semaphores = {}
+
+    def pool(self, url, datasource=None):
+        if datasource in self.datasources:
+            return datasource
+        for key, ds in self.datasources.items():
+            if ds.get("url") and url.startswith(ds["url"]):
+                return key
+        return "default"
+
+    def session(self, pool):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Sessions can not be shared between event loops
+            self._loop = loop
+            self._sessions = {}
+            self._semaphores = {}
+        if pool not in self._sessions:
+            self._sessions[pool] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(
+                    total=self.timeout, connect=self.connect_timeout
+                ),
+            )
+            self._semaphores[pool] = asyncio.Semaphore(self.limit)
+        return self._sessions[pool], self._semaphores[pool]
+
+    async def request(
+        self, method, url, params=None, data=None, datasource=None, headers=None
+    ):
+        pool = self.pool(url, datasource)
+        if not default_metrics.enabled:
+            return await self._request(pool, method, url, params, data, headers)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._request(pool, method, url, params, data, headers)
+            status = str(response.status_code)
+            return response
+        finally:
+            request_seconds.observe(
+                time.perf_counter() - started, pool=pool, status=status
+            )
+
+    async def _request(self, pool, method, url, params, data, headers):
+        session, semaphore = self.session(pool)
+        params = query_params(params)
+        attempt = 0
+        while True:
+            try:
+                async with semaphore:
+                    async with session.request(
+                        method, url, params=params, json=data, headers=headers
+                    ) as response:
+                        text = await response.text()
+                # Only idempotent requests are retried on server errors
+                if response.status < 500 or method != "GET":
+                    return HttpResponse(response.status, text)
+                error = Exception(text)
+            except aiohttp.ClientConnectorError as e:
+                # Request never reached the service, safe to retry any method
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if method != "GET":
+                    raise
+                error = e
+            attempt += 1
+            if attempt > self.retries:
+                raise error
+            await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+        self._semaphores = {}
+
+
+config = getattr(env, "HTTP_CONNECTOR", {})
+default_http_connector = HttpConnector(
+    datasources=getattr(env, "DS", {}),
+    timeout=config.get("timeout", 30),
+    connect_timeout=config.get("connect_timeout", 5),
+    limit=config.get("limit", 100),
+    retries=config.get("retries", 2),
+)
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import env
+from metrics import default_metrics
+
+
+class InstanceCache:
+    # Instances resident in memory in least recently used order. Over
+    # capacity, finished instances are dropped first, then running ones
+    # which only wait for a user and whose latest snapshot is written.
+    # Evicted instances are hydrated from their snapshot on demand.
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.instances = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __contains__(self, instance_id):
+        return instance_id in self.instances
+
+    def add(self, instance):
+        self.instances[instance._id] = instance
+        self.instances.move_to_end(instance._id)
+        if self.capacity and len(self.instances) > self.capacity:
+            # Down to 90% so the scan is not repeated for every new instance
+            self.evict(len(self.instances) - int(self.capacity * 0.9))
+
+    def touch(self, instance):
+        if instance._id in self.instances:
+            self.instances.move_to_end(instance._id)
+
+    def discard(self, instance):
+        self.instances.pop(instance._id, None)
+
+    def evict(self, count):
+        finished = []
+        idle = []
+        for instance in self.instances.values():
+            if len(finished) >= count:
+                break
+            if instance.state in ("finished", "failed"):
+                finished.append(instance)
+            elif len(idle) < count and instance.idle():
+                idle.append(instance)
+        for instance in (finished + idle)[:count]:
+            if instance.state == "running":
+                instance.model.evicted.add(instance._id)
+            instance.unload()
+            self.evicted += 1
+
+
+config = getattr(env, "INSTANCE_CACHE", {})
+default_instance_cache = InstanceCache(capacity=config.get("capacity"))
+default_metrics.gauge(
+    "bpmn_resident_instances",
+    "Instances kept in memory",
+    lambda: len(default_instance_cache),
+)
+default_metrics.gauge(
+    "bpmn_evicted_instances",
+    "Instances unloaded to stay within the cache capacity",
+    lambda: default_instance_cache.evicted,
+)
@@ -0,0 +1,181 @@
+import asyncio
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as Samples
+import env
+
+# Upper bounds in seconds, from a fast step to a user task waiting for days
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+    3600,
+    86400,
+)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    text = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + text + "}"
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield self.name, key, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # Per label set: count per bucket (last one is +Inf), sum
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for key, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(bound)
+                yield self.name + "_bucket", key + (("le", le),), cumulative
+            yield self.name + "_sum", key, total
+            yield self.name + "_count", key, cumulative
+
+
+class Gauge:
+    kind = "gauge"
+
+    # Read when scraped, collect returns a number or {label pairs: value}
+    def __init__(self, name, help, collect):
+        self.name = name
+        self.help = help
+        self.collect = collect
+
+    def samples(self):
+        value = self.collect()
+        if isinstance(value, dict):
+            for key, v in value.items():
+                yield self.name, key, v
+        else:
+            yield self.name, (), value
+
+
+class Metrics:
+    # Registry of engine metrics rendered in the Prometheus text format on
+    # GET /metrics. Modules register their own metrics on import and check
+    # enabled before timing anything, disabled metrics cost one attribute
+    # lookup per hook.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics.setdefault(metric.name, metric)
+        return self.metrics[metric.name]
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, collect):
+        return self._register(Gauge(name, help, collect))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    # Samples the stack of the event loop thread from a background thread,
+    # the result is in collapsed stack format for flame graph tools. Runs
+    # only while a profile is requested.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = asyncio.Lock()
+
+    def _sample(self, thread_id, seconds, interval):
+        stacks = Samples()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return stacks
+
+    async def profile(self, seconds, interval=None):
+        async with self._lock:
+            thread_id = threading.get_ident()
+            stacks = await asyncio.get_running_loop().run_in_executor(
+                None, self._sample, thread_id, seconds, interval or self.interval
+            )
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+config = getattr(env, "METRICS", {})
+default_metrics = Metrics(enabled=config.get("enabled", True))
+default_profiler = (
+    Profiler(interval=config.get("profile_interval", 0.005))
+    if config.get("profiling")
+    else None
+)
@@ -0,0 +1,116 @@
+import os
+import hashlib
+from collections import defaultdict
+from bpmn_model import BpmnModel
+from dmn_model import DmnModel
+from engine_log import logger
+
+
+class ModelRegistry:
+    # Parses every model file once and keeps it until the file changes.
+    # Files are checked by mtime and size first, content hash decides if a
+    # changed file really needs to be parsed again. DMN files next to the
+    # BPMN files are loaded for business rule tasks.
+    def __init__(self, directory="models"):
+        self.directory = directory
+        self.models = {}
+        self.dmn_models = {}
+        self.processes = defaultdict(list)
+        self.decisions = {}
+        self._stamps = {}
+
+    def __contains__(self, model_path):
+        return model_path in self.models
+
+    def __getitem__(self, model_path):
+        return self.models[model_path]
+
+    def _stat(self, model_path):
+        stat = os.stat(os.path.join(self.directory, model_path))
+        return stat.st_mtime_ns, stat.st_size
+
+    def _hash(self, model_path):
+        with open(os.path.join(self.directory, model_path), "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _load(self, model_path):
+        stat = self._stat(model_path)
+        stamp = self._stamps.get(model_path)
+        if stamp and stamp[0] == stat:
+            return False
+        digest = self._hash(model_path)
+        self._stamps[model_path] = (stat, digest)
+        if stamp and stamp[1] == digest:
+            return False
+        if model_path.endswith(".dmn"):
+            self.dmn_models[model_path] = DmnModel(
+                os.path.join(self.directory, model_path)
+            )
+            return True
+        model = BpmnModel(model_path)
+        if model_path in self.models:
+            # Running instances stay on the version they were started with
+            model.instances = self.models[model_path].instances
+            model.evicted = self.models[model_path].evicted
+        self.models[model_path] = model
+        return True
+
+    def _try_load(self, model_path):
+        # A broken file is skipped, the version loaded before stays in use
+        try:
+            return self._load(model_path)
+        except Exception as e:
+            logger.error(f"Error loading model {model_path}: {e}")
+            return False
+
+    def refresh(self):
+        files = {
+            f for f in os.listdir(self.directory) if f.endswith((".bpmn", ".dmn"))
+        }
+        changed = False
+        for models in (self.models, self.dmn_models):
+            for model_path in list(models):
+                if model_path not in files:
+                    del models[model_path]
+                    del self._stamps[model_path]
+                    changed = True
+        for model_path in sorted(files):
+            changed = self._try_load(model_path) or changed
+        if changed:
+            self._reindex()
+        return self.models
+
+    def get(self, model_path):
+        path = os.path.join(self.directory, model_path)
+        if not model_path.endswith(".bpmn") or not os.path.isfile(path):
+            return None
+        if self._try_load(model_path):
+            self._reindex()
+        return self.models.get(model_path)
+
+    def resolve(self, process_id, caller=None):
+        # Deployment bound call activities prefer processes of other models
+        paths = self.processes.get(process_id, [])
+        for model_path in paths:
+            if model_path != caller:
+                return self.models[model_path]
+        return self.models[paths[0]] if paths else None
+
+    def decision_model(self, decision_id):
+        return self.decisions.get(decision_id)
+
+    def _reindex(self):
+        self.processes = defaultdict(list)
+        for model_path, model in self.models.items():
+            for process_id in model.process_elements:
+                self.processes[process_id].append(model_path)
+        self.decisions = {}
+        for model_path in sorted(self.dmn_models, reverse=True):
+            # First file in name order wins for duplicate decision ids
+            for decision_id in self.dmn_models[model_path].decisions:
+                self.decisions[decision_id] = self.dmn_models[model_path]
+        for model in self.models.values():
+            model.handle_deployment_subprocesses(self)
+
+
+default_registry = ModelRegistry()
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import deque, defaultdict
+from event_sink import default_event_sink
+from metrics import default_metrics
+
+step_seconds = default_metrics.histogram(
+    "bpmn_step_seconds", "Time to execute an element, by element type"
+)
+user_task_wait_seconds = default_metrics.histogram(
+    "bpmn_user_task_wait_seconds", "Time a user task waited for its form, by task"
+)
+
+
+class Scheduler:
+    # Central ready-queue of (instance, node, message) work items. Instances
+    # waiting on a UserTask are parked in self.waiting and cost nothing until
+    # a message for that task is delivered.
+    def __init__(self, batch_size=100, event_sink=default_event_sink):
+        self.batch_size = batch_size
+        self.event_sink = event_sink
+        self.ready = deque()
+        self.waiting = {}
+        self.waiting_by_instance = defaultdict(set)
+        self.waiting_since = {}
+        self._running = set()
+        self._wakeup = None
+        self._task = None
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+        self._wakeup.set()
+
+    def schedule(self, instance, node, message=None):
+        self.ready.append((instance, node, message))
+        self._ensure_running()
+
+    def wait(self, instance, task_id, node):
+        key = (instance._id, task_id)
+        self.waiting[key] = (instance, node)
+        self.waiting_by_instance[instance._id].add(key)
+        if default_metrics.enabled:
+            self.waiting_since.setdefault(key, time.monotonic())
+
+    def cancel(self, instance):
+        for key in self.waiting_by_instance.pop(instance._id, ()):
+            self.waiting.pop(key, None)
+            self.waiting_since.pop(key, None)
+
+    # Activity cancelled while waiting, e.g. by an interrupting timer
+    def withdraw(self, instance, task_id):
+        key = (instance._id, task_id)
+        self.waiting.pop(key, None)
+        self.waiting_by_instance[instance._id].discard(key)
+        self.waiting_since.pop(key, None)
+
+    def deliver(self, instance_id, message):
+        key = (instance_id, message.task_id)
+        entry = self.waiting.pop(key, None)
+        if entry is None:
+            return False
+        self.waiting_by_instance[instance_id].discard(key)
+        since = self.waiting_since.pop(key, None)
+        if since is not None:
+            user_task_wait_seconds.observe(
+                time.monotonic() - since, task=message.task_id
+            )
+        instance, node = entry
+        self.schedule(instance, node, message)
+        return True
+
+    async def _loop(self):
+        while True:
+            if not self.ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            for _ in range(min(self.batch_size, len(self.ready))):
+                instance, node, message = self.ready.popleft()
+                if instance.graph.nodes[node].blocking:
+                    # Remote calls and subprocesses must not hold up the batch
+                    task = asyncio.create_task(self._step(instance, node, message))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+                else:
+                    await self._step(instance, node, message)
+
+            # Group commit of the batch, or wait out backpressure
+            await self.event_sink.checkpoint()
+            # Let request handlers run between batches
+            await asyncio.sleep(0)
+
+    async def _step(self, instance, node, message):
+        started = time.perf_counter() if default_metrics.enabled else None
+        try:
+            next_nodes = await instance.step(node, message)
+            # Sync mode commits every step before the engine continues
+            await self.event_sink.commit(instance._id)
+            for next_node in next_nodes:
+                self.schedule(instance, next_node)
+        except Exception as e:
+            self.cancel(instance)
+            instance.fail(e)
+        if started is not None:
+            step_seconds.observe(
+                time.perf_counter() - started,
+                element=type(instance.graph.nodes[node]).__name__,
+            )
+
+
+default_scheduler = Scheduler()
+default_metrics.gauge(
+    "bpmn_ready_steps",
+    "Steps queued in the scheduler",
+    lambda: len(default_scheduler.ready),
+)
+default_metrics.gauge(
+    "bpmn_running_steps",
+    "Blocking steps in progress, service tasks and call activities",
+    lambda: len(default_scheduler._running),
+)
+default_metrics.gauge(
+    "bpmn_waiting_user_tasks",
+    "User tasks waiting for a form",
+    lambda: len(default_scheduler.waiting),
+)
@@ -0,0 +1,95 @@
+from collections import OrderedDict, defaultdict
+import env
+
+# Length of the substrings indexed per variable value
+GRAM = 3
+
+
+def grams(text):
+    return {text[i : i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+class SearchIndex:
+    # Inverted index over string variables of instances for GET /instance.
+    # Per lowercased variable name it maps each 3 character substring of
+    # the lowercased value to the instance ids containing it, queries only
+    # check the instances found in the smallest of those sets. Over capacity
+    # the least recently updated instances are dropped from the index.
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.values = OrderedDict()
+        self.keys = defaultdict(set)
+        self.grams = defaultdict(set)
+
+    def __contains__(self, instance_id):
+        return instance_id in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(list(self.values))
+
+    def update(self, instance_id, variables):
+        values = self.values.setdefault(instance_id, {})
+        self.values.move_to_end(instance_id)
+        current = {
+            k.lower(): v.lower() for k, v in variables.items() if isinstance(v, str)
+        }
+        for k in list(values):
+            if current.get(k) != values[k]:
+                self._remove(instance_id, k, values.pop(k))
+        for k, value in current.items():
+            if k not in values:
+                values[k] = value
+                self.keys[k].add(instance_id)
+                for gram in grams(value):
+                    self.grams[(k, gram)].add(instance_id)
+        while self.capacity and len(self.values) > self.capacity:
+            self.remove(next(iter(self.values)))
+
+    def remove(self, instance_id):
+        for k, value in self.values.pop(instance_id, {}).items():
+            self._remove(instance_id, k, value)
+
+    def _remove(self, instance_id, k, value):
+        self.keys[k].discard(instance_id)
+        if not self.keys[k]:
+            del self.keys[k]
+        for gram in grams(value):
+            ids = self.grams.get((k, gram))
+            if ids is not None:
+                ids.discard(instance_id)
+                if not ids:
+                    del self.grams[(k, gram)]
+
+    # Instances with a variable whose name contains att and whose value
+    # contains value, an empty att matches any variable
+    def match(self, att, value, within=None):
+        ids = set()
+        for k in [k for k in self.keys if att in k]:
+            candidates = [self.grams.get((k, g), set()) for g in grams(value)]
+            if candidates:
+                candidates = min(candidates, key=len)
+            else:
+                # Values shorter than a gram are checked on every instance
+                candidates = self.keys[k]
+            if within is not None and len(within) < len(candidates):
+                candidates = within
+            ids.update(
+                _id for _id in candidates if value in self.values.get(_id, {}).get(k, "")
+            )
+        return ids
+
+    def search(self, queries):
+        ids = None
+        # Longer values are more selective, later terms only check their ids
+        for att, value in sorted(queries, key=lambda q: -len(q[1])):
+            ids = self.match(att, value, ids)
+            if not ids:
+                break
+        return ids or set()
+
+
+config = getattr(env, "SEARCH_INDEX", {})
+default_search_index = SearchIndex(capacity=config.get("capacity"))
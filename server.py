@@ -7,11 +7,27 @@ import env
 from aiohttp import web
 from uuid import uuid4
 import asyncio
-from bpmn_model import BpmnModel, UserFormMessage, get_model_for_instance
+from bpmn_model import (
+    UserFormMessage,
+    MessageReceived,
+    get_model_for_instance,
+    snapshot_json,
+    snapshot_state,
+)
+from event_sink import default_event_sink
+from http_connector import default_http_connector
+from model_registry import default_registry as model_registry
+from search_index import default_search_index as search_index
+from cluster import default_cluster as cluster
+from change_feed import default_change_feed as change_feed
+from metrics import default_metrics, default_profiler
+from engine_log import logger
+from timers import default_timer_service as timers
+from correlation import default_correlator as correlator
 import aiohttp_cors
 import db_connector
-from functools import reduce
 from datetime import datetime
+from utils.encoding import dumps
 
 
 # Setup database
@@ -20,58 +36,207 @@ routes = web.RouteTableDef()
 
 # uuid4 = lambda: 2  # hardcoded for easy testing
 
-models = {}
-for file in os.listdir("models"):
-    if file.endswith(".bpmn"):
-        m = BpmnModel(file)
-        models[file] = m
+models = model_registry.refresh()
+
+# Seconds between keep-alive comments on an idle /feed
+FEED_HEARTBEAT = 15
+
+# Events per page of GET /events
+EVENTS_PAGE = 1000
+EVENTS_PAGE_MAX = 10000
 
 
 async def run_as_server(app):
     app["bpmn_models"] = models
-    log = db_connector.get_running_instances_log()
-    for l in log:
-        for key, data in l.items():
-            if data["model_path"] in app["bpmn_models"]:
-                instance = await app["bpmn_models"][data["model_path"]].create_instance(
-                    key, {}
-                )
+    cluster.refresh()
+    await restore_instances(app)
+    timers.handler = fire_timer
+    timers.load()
+    app["timers"] = asyncio.create_task(timers.maintain())
+    correlator.handler = deliver_message
+    correlator.load()
+    app["messages"] = asyncio.create_task(correlator.maintain())
+    if cluster.enabled:
+        app["cluster"] = asyncio.create_task(
+            cluster.maintain(lambda gained, lost: partitions_changed(app, gained, lost))
+        )
+
+
+async def restore_instances(app, partitions=None):
+    # Latest snapshot of every running instance, fetched in bulk, other
+    # workers restore the instances of their partitions
+    restored = []
+    for data in db_connector.get_running_instances_snapshots():
+        _id = data["instance_id"]
+        if not cluster.owns(_id) or get_model_for_instance(_id):
+            continue
+        if partitions is not None and cluster.partition(_id) not in partitions:
+            continue
+        if data["model_path"] in app["bpmn_models"]:
+            restored.append(data)
+    # Their persisted timers in bulk too, not one query per timer
+    timers.preload([data["instance_id"] for data in restored])
+    try:
+        for data in restored:
+            model = app["bpmn_models"][data["model_path"]]
+            instance = await model.create_instance(
+                data["instance_id"], {}, data.get("process")
+            )
+            if "events" in data:
                 instance = await instance.run_from_log(data["events"])
-                asyncio.create_task(instance.run())
+            else:
+                instance.restore(data)
+            instance.start()
+    finally:
+        timers.preloaded = {}
 
 
-# Get all models
-# Model.search
-from types import SimpleNamespace
+# Instance from memory, or hydrated from its snapshot if it was evicted.
+# Instances of another worker's partitions are never loaded here.
+async def load_instance(instance_id):
+    m = get_model_for_instance(instance_id)
+    if m and instance_id in m.instances:
+        return m.instances[instance_id]
+    if not cluster.owns(instance_id):
+        return None
+    data = db_connector.get_snapshot(instance_id)
+    model = model_registry.get(data["model_path"]) if data else None
+    if not model:
+        return None
+    instance = await model.create_instance(instance_id, {}, data["process"])
+    instance.restore(data)
+    if data["running"]:
+        instance.start()
+    else:
+        instance.state = snapshot_state(data)
+    return instance
+
+
+# Resident instances by id, the others as (model, snapshot) read in one
+# query off the event loop, for read-only listings
+async def read_instances(instance_ids):
+    resident, missing = {}, []
+    for _id in instance_ids:
+        m = get_model_for_instance(_id)
+        if m and _id in m.instances:
+            resident[_id] = m.instances[_id]
+        else:
+            missing.append(_id)
+    stored = {}
+    if missing:
+        loop = asyncio.get_running_loop()
+        snapshots = await loop.run_in_executor(
+            None, db_connector.get_snapshots, missing
+        )
+        for _id, data in snapshots.items():
+            model = model_registry.get(data["model_path"])
+            if model:
+                stored[_id] = (model, data)
+    return resident, stored
+
+
+async def fire_timer(timer):
+    instance = await load_instance(timer.instance_id)
+    if instance:
+        instance.timer_fired(timer)
+
+
+async def deliver_message(instance_id, element_id, message):
+    instance = await load_instance(instance_id)
+    return bool(instance) and instance.send(MessageReceived(element_id, message))
+
+
+async def partitions_changed(app, gained, lost):
+    if lost:
+        for model in app["bpmn_models"].values():
+            for _id, instance in list(model.instances.items()):
+                if cluster.partition(_id) in lost:
+                    instance.release()
+            model.evicted = {
+                _id for _id in model.evicted if cluster.partition(_id) not in lost
+            }
+        # Evicted instances of those partitions are searched on their owner
+        for _id in search_index:
+            if cluster.partition(_id) in lost:
+                search_index.remove(_id)
+    if gained:
+        # Taken over from a worker whose leases expired
+        await restore_instances(app, gained)
+        timers.load()
+
+
+async def leave_cluster(app):
+    for task in ("timers", "messages"):
+        if task in app:
+            app[task].cancel()
+    if "cluster" in app:
+        app["cluster"].cancel()
+    cluster.release()
+
+
+# Requests for instances of another worker's partition are answered by
+# that worker
+async def forward(request, instance_id, data=None):
+    url = cluster.owner_url(instance_id)
+    if not url or request.headers.get("X-Forwarded-Worker"):
+        return web.json_response(
+            {"status": "error", "message": "Instance owner unavailable"}, status=503
+        )
+    response = await default_http_connector.request(
+        request.method,
+        url.rstrip("/") + request.rel_url.path,
+        params=dict(request.rel_url.query),
+        data=data,
+        headers={"X-Forwarded-Worker": cluster.owner},
+    )
+    return web.Response(
+        text=response.text,
+        status=response.status_code,
+        content_type="application/json",
+    )
 
 
+async def flush_event_log(app):
+    await default_event_sink.close()
+
+
+async def close_http_connector(app):
+    await default_http_connector.close()
+
+
+# Get all models
+# Model.search
 @routes.get("/model")
 async def get_models(request):
-    models = {}
-    for file in os.listdir("models"):
-        if file.endswith(".bpmn"):
-            m = BpmnModel(file)
-            models[file] = m
-
-    running_instance_logs = db_connector.get_running_instances_log()
-
-    instance_to_model_mapping = {}
-    for log_entry in running_instance_logs:
-        for instance_id, details in log_entry.items():
-            instance_to_model_mapping[instance_id] = details
-
-    for model in models.values():
-        for instance_id, details in instance_to_model_mapping.items():
-            if details["model_path"] == model.model_path:
-                instance_object = SimpleNamespace(
-                    _id=instance_id, events=details["events"]
-                )
-                model.instances[instance_id] = instance_object
-
-    data = [m.to_json() for m in models.values()]
+    # Only new or changed model files get parsed
+    models = model_registry.refresh()
+    data = [model.to_json() for model in models.values()]
     return web.json_response({"status": "ok", "results": data})
 
 
+# JSON of a model shared by all of its instances, compact instance views
+# reference it by model_path
+@routes.get("/model/{model_name}/document")
+async def get_model_document(request):
+    model = model_registry.get(request.match_info.get("model_name"))
+    if not model:
+        raise aiohttp.web.HTTPNotFound
+    _, body, etag = model.document()
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == f'"{etag}"':
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=body, content_type="application/json", headers=headers)
+
+
+# ?fields=id,state,... limits instance JSON to those keys, ?view=compact
+# references the model by model_path, ?view=full embeds it
+def instance_view(params, compact):
+    fields = [f for f in params.get("fields", "").split(",") if f] or None
+    if params.get("view"):
+        compact = params["view"] == "compact"
+    return {"fields": fields, "compact": compact}
+
+
 @routes.get("/model/{model_name}")
 async def get_model(request):
     model_name = request.match_info.get("model_name")
@@ -83,10 +248,12 @@ async def get_model(request):
 # Creates new process instance
 @routes.post("/model/{model_name}/instance")
 async def handle_new_instance(request):
-    _id = str(uuid4())
-    model = request.match_info.get("model_name")
-    instance = await app["bpmn_models"][model].create_instance(_id, {})
-    asyncio.create_task(instance.run())
+    _id = cluster.new_instance_id()
+    model = model_registry.get(request.match_info.get("model_name"))
+    if not model:
+        raise aiohttp.web.HTTPNotFound
+    instance = await model.create_instance(_id, {})
+    instance.start()
     return web.json_response({"id": _id})
 
 
@@ -95,12 +262,63 @@ async def handle_form(request):
     post = await request.json()
     instance_id = request.match_info.get("instance_id")
     task_id = request.match_info.get("task_id")
-    m = get_model_for_instance(instance_id)
-    m.instances[instance_id].in_queue.put_nowait(UserFormMessage(task_id, post))
+    if not cluster.owns(instance_id):
+        return await forward(request, instance_id, post)
+    instance = await load_instance(instance_id)
+    if not instance:
+        raise aiohttp.web.HTTPNotFound
+    if not instance.send(UserFormMessage(task_id, post)):
+        return web.json_response(
+            {"status": "error", "message": f"Task {task_id} is not pending"},
+            status=409,
+        )
 
     return web.json_response({"status": "OK"})
 
 
+# Message for the instance waiting on its name and correlation key, kept
+# until one does if none is waiting yet
+@routes.post("/message")
+async def correlate_message(request):
+    post = await request.json()
+    name = post.get("name")
+    key = post.get("correlation_key")
+    if not name or key is None:
+        return web.json_response(
+            {"status": "error", "message": "name and correlation_key are required"},
+            status=400,
+        )
+    forwarded = request.headers.get("X-Forwarded-Worker")
+    if cluster.enabled and not forwarded and not correlator.waiting(name, key):
+        # Subscriptions live with their instances, other workers are asked
+        # before the message is buffered
+        result = await correlate_elsewhere(post)
+        if result:
+            return web.json_response(result)
+    result = await correlator.correlate(
+        name, key, post.get("variables"), buffer=not forwarded
+    )
+    status = {"correlated": 200, "buffered": 202, "rejected": 503}
+    return web.json_response(result, status=status.get(result["status"], 200))
+
+
+async def correlate_elsewhere(post):
+    for url in set(cluster.owners.values()) - {cluster.url}:
+        try:
+            response = await default_http_connector.request(
+                "POST",
+                url.rstrip("/") + "/message",
+                data=post,
+                headers={"X-Forwarded-Worker": cluster.owner},
+            )
+        except Exception as e:
+            logger.warning("Worker %s unavailable for message: %r", url, e)
+            continue
+        if response.status_code == 200 and response.json()["status"] == "correlated":
+            return response.json()
+    return None
+
+
 @routes.get("/instance")
 async def search_instance(request):
     params = request.rel_url.query
@@ -121,45 +339,111 @@ async def search_instance(request):
     except:
         return web.json_response({"error": "invalid_query"}, status=400)
 
-    result_ids = []
-    for att, value in queries:
-        ids = []
-        for m in models.values():
-            for _id, instance in m.instances.items():
-                search_atts = []
-                if not att:
-                    search_atts = list(instance.variables.keys())
-                else:
-                    for key in instance.variables.keys():
-                        if not att or att in key.lower():
-                            search_atts.append(key)
-                search_atts = filter(
-                    lambda x: isinstance(instance.variables[x], str), search_atts
-                )
-
-                for search_att in search_atts:
-                    if search_att and value in instance.variables[search_att].lower():
-                        # data.append(instance.to_json())
-                        ids.append(_id)
-        result_ids.append(set(ids))
+    try:
+        limit = min(int(params.get("limit", 100)), 1000)
+        offset = int(params.get("offset", 0))
+    except ValueError:
+        return web.json_response({"error": "invalid_query"}, status=400)
 
-    ids = reduce(lambda a, x: a.intersection(x), result_ids[:-1], result_ids[0])
+    # Sorted so pages stay stable between requests
+    ids = sorted(search_index.search(queries))
+    page = ids[offset : offset + limit]
 
+    # Listings are compact unless asked otherwise, the model is the same
+    # document for many instances
+    view = instance_view(params, compact=True)
+    resident, stored = await read_instances(page)
     data = []
-    for _id in ids:
-        data.append(get_model_for_instance(_id).instances[_id].to_json())
+    for _id in page:
+        if _id in resident:
+            data.append(resident[_id].to_json(**view))
+        elif _id in stored:
+            data.append(snapshot_json(*stored[_id], **view))
+
+    return web.json_response(
+        {
+            "status": "ok",
+            "results": data,
+            "total": len(ids),
+            "next": offset + limit if offset + limit < len(ids) else None,
+        },
+        dumps=dumps,
+    )
 
-    return web.json_response({"status": "ok", "results": data})
+
+# Server-sent events with instance deltas, id, model, state, pending and
+# the changed variables. ?instance= and ?model= take comma separated ids,
+# ?interval= is how long changes are coalesced before they are sent.
+@routes.get("/feed")
+async def instance_feed(request):
+    params = request.rel_url.query
+    try:
+        interval = float(params.get("interval", 0.1))
+    except ValueError:
+        return web.json_response({"error": "invalid_query"}, status=400)
+    instances = [i for i in params.get("instance", "").split(",") if i]
+    models = [m for m in params.get("model", "").split(",") if m]
+    subscriber = change_feed.subscribe(instances, models)
+
+    # Current state of watched instances first, only deltas follow
+    resident, stored = await read_instances(instances)
+    for instance_id in instances:
+        if instance_id in resident:
+            instance = resident[instance_id]
+            subscriber.push(
+                {
+                    "id": instance_id,
+                    "model": instance.model.model_path,
+                    "state": instance.state,
+                    "pending": instance.graph.ids(instance.pending),
+                    "variables": instance.variables,
+                }
+            )
+        elif instance_id in stored:
+            model, data = stored[instance_id]
+            subscriber.push(
+                {
+                    "id": instance_id,
+                    "model": model.model_path,
+                    "state": snapshot_state(data),
+                    "pending": data["pending"],
+                    "variables": data["variables"],
+                }
+            )
+
+    response = web.StreamResponse(
+        headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+    )
+    await response.prepare(request)
+    try:
+        while True:
+            # Only the wait for a change times out, an interval longer than
+            # the heartbeat must not cut off the coalescing
+            try:
+                await asyncio.wait_for(subscriber.ready.wait(), FEED_HEARTBEAT)
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+                continue
+            deltas = await subscriber.next(interval)
+            await response.write(
+                "".join(f"data: {dumps(delta)}\n\n" for delta in deltas).encode()
+            )
+    except ConnectionResetError:
+        pass
+    finally:
+        change_feed.unsubscribe(subscriber)
+    return response
 
 
 @routes.get("/instance/{instance_id}/task/{task_id}")
 async def handle_task_info(request):
     instance_id = request.match_info.get("instance_id")
     task_id = request.match_info.get("task_id")
-    m = get_model_for_instance(instance_id)
-    if not m:
+    if not cluster.owns(instance_id):
+        return await forward(request, instance_id)
+    instance = await load_instance(instance_id)
+    if not instance:
         raise aiohttp.web.HTTPNotFound
-    instance = m.instances[instance_id]
     task = instance.model.elements[task_id]
 
     return web.json_response(task.get_info())
@@ -168,18 +452,33 @@ async def handle_task_info(request):
 @routes.get("/instance/{instance_id}")
 async def handle_instance_info(request):
     instance_id = request.match_info.get("instance_id")
-    m = get_model_for_instance(instance_id)
-    if not m:
+    if not cluster.owns(instance_id):
+        return await forward(request, instance_id)
+    instance = await load_instance(instance_id)
+    if not instance:
         raise aiohttp.web.HTTPNotFound
-    instance = m.instances[instance_id].to_json()
+    view = instance_view(request.rel_url.query, compact=False)
+    instance = instance.to_json(**view)
 
-    return web.json_response(instance)
+    return web.json_response(instance, dumps=dumps)
 
 
 @routes.delete("/instance/{instance_id}")
 async def delete_instance(request):
     instance_id = request.match_info.get("instance_id")
+    if not cluster.owns(instance_id):
+        return await forward(request, instance_id)
+    m = get_model_for_instance(instance_id)
+    if m and instance_id in m.instances:
+        # Stopped first, its pending writes go before its rows are deleted
+        m.instances[instance_id].release()
+        await default_event_sink.flush()
+    for model in model_registry.models.values():
+        model.evicted.discard(instance_id)
     response = db_connector.delete_instance(instance_id)
+    timers.forget(instance_id)
+    correlator.cancel_instance(instance_id)
+    search_index.remove(instance_id)
     if response["status"] == "success":
         return web.json_response(
             {"status": "ok", "message": "Instance deleted successfully."}
@@ -190,16 +489,97 @@ async def delete_instance(request):
         )
 
 
+# Prometheus scrape endpoint
+@routes.get("/metrics")
+async def get_metrics(request):
+    if not default_metrics.enabled:
+        raise aiohttp.web.HTTPNotFound
+    return web.Response(
+        body=default_metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+# Samples the event loop for ?seconds= and returns collapsed stacks, only
+# when profiling is enabled in env.METRICS
+@routes.get("/metrics/profile")
+async def get_profile(request):
+    if default_profiler is None:
+        raise aiohttp.web.HTTPNotFound
+    try:
+        seconds = min(float(request.rel_url.query.get("seconds", 10)), 300)
+    except ValueError:
+        return web.json_response({"error": "invalid_query"}, status=400)
+    stacks = await default_profiler.profile(seconds)
+    return web.Response(text=stacks, content_type="text/plain")
+
+
+def events_filters(params):
+    filters = {
+        "model_name": params.get("model"),
+        "instance_id": params.get("instance"),
+        "activity_id": params.get("activity"),
+    }
+    for key in ("since", "until"):
+        if params.get(key):
+            filters[key] = datetime.fromisoformat(params[key])
+    return filters
+
+
+# Events page by page, ?after=<id of the last event> continues from the
+# previous page. With ?format=ndjson all matching events are streamed one
+# JSON object per line, fetched from the database a page at a time.
 @routes.get("/events")
 async def get_all_events(request):
+    params = request.rel_url.query
     try:
-        events = db_connector.get_all_events()
-        data = [event.to_dict() for event in events]
-        return web.json_response({"status": "ok", "results": data})
+        filters = events_filters(params)
+        after = int(params["after"]) if params.get("after") else None
+        limit = min(int(params.get("limit", EVENTS_PAGE)), EVENTS_PAGE_MAX)
+    except ValueError:
+        return web.json_response({"error": "invalid_query"}, status=400)
+
+    ndjson = params.get("format") == "ndjson" or "application/x-ndjson" in (
+        request.headers.get("Accept", "")
+    )
+    if ndjson:
+        return await stream_events(request, after, filters)
+
+    try:
+        data = await events_page(after, limit, filters)
+        next_cursor = data[-1]["id"] if len(data) == limit else None
+        return web.json_response(
+            {"status": "ok", "results": data, "next": next_cursor}, dumps=dumps
+        )
     except Exception as e:
         return web.json_response({"status": "error", "message": str(e)})
 
 
+# The query runs off the event loop, a page can be large
+async def events_page(after, limit, filters):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, lambda: db_connector.get_events_page(after, limit, **filters)
+    )
+
+
+async def stream_events(request, after, filters):
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    while True:
+        page = await events_page(after, EVENTS_PAGE, filters)
+        if page:
+            await response.write(
+                "".join(dumps(event) + "\n" for event in page).encode()
+            )
+            after = page[-1]["id"]
+        if len(page) < EVENTS_PAGE:
+            break
+    await response.write_eof()
+    return response
+
+
 app = None
 
 project_root = os.path.dirname(os.path.abspath(__file__))
@@ -225,6 +605,9 @@ def run():
     global app
     app = web.Application(middlewares=[bugsnag_middleware])
     app.on_startup.append(run_as_server)
+    app.on_cleanup.append(flush_event_log)
+    app.on_cleanup.append(close_http_connector)
+    app.on_cleanup.append(leave_cluster)
     app.add_routes(routes)
 
     cors = aiohttp_cors.setup(
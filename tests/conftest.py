@@ -0,0 +1,115 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS))
+# The engine reads ./models and the server creates ./database, both go to a
+# scratch directory holding the test models
+WORKDIR = tempfile.mkdtemp(prefix="bpmn-tests-")
+shutil.copytree(os.path.join(TESTS, "models"), os.path.join(WORKDIR, "models"))
+os.chdir(WORKDIR)
+
+import db_connector  # noqa: E402
+from pony.orm import db_session  # noqa: E402
+
+DATABASE = os.path.join(WORKDIR, "database.sqlite")
+db_connector.DB.bind(provider="sqlite", filename=DATABASE, create_db=True)
+db_connector.DB.generate_mapping(create_tables=True)
+
+
+# In-memory engine state, what a restarted process starts without
+def forget_instances():
+    from bpmn_model import instance_models
+    from correlation import default_correlator
+    from event_sink import default_event_sink
+    from instance_cache import default_instance_cache
+    from scheduler import default_scheduler
+    from timers import default_timer_service
+
+    default_scheduler.ready.clear()
+    default_scheduler.waiting.clear()
+    default_scheduler.waiting_by_instance.clear()
+    default_timer_service.timers.clear()
+    default_timer_service.by_instance.clear()
+    default_timer_service.heap.clear()
+    default_timer_service.loaded_until = None
+    default_correlator.subscriptions.clear()
+    default_correlator.by_instance.clear()
+    default_correlator.buffer.clear()
+    default_correlator.buffered = 0
+    default_correlator.taken.clear()
+    default_instance_cache.instances.clear()
+    default_event_sink.buffer.clear()
+    default_event_sink.snapshots.clear()
+    instance_models.clear()
+
+
+def load_registry():
+    from model_registry import ModelRegistry
+
+    registry = ModelRegistry("models")
+    registry.refresh()
+    return registry
+
+
+@pytest.fixture(autouse=True)
+def db():
+    yield db_connector
+    with db_session:
+        for entity in db_connector.DB.entities.values():
+            entity.select().delete(bulk=True)
+    forget_instances()
+
+
+@pytest.fixture
+def registry():
+    return load_registry()
+
+
+# Drops every instance from memory and returns the models of a new process
+@pytest.fixture
+def restart():
+    def restart():
+        forget_instances()
+        return load_registry()
+
+    return restart
+
+
+# Activities logged for an instance, in order
+@db_session
+def activities(instance_id):
+    return [
+        e.activity_id
+        for e in db_connector.Event.select(lambda e: e.instance_id == instance_id)
+        .order_by(db_connector.Event.id)
+    ]
+
+
+def logged(instance_id):
+    return len(activities(instance_id))
+
+
+@db_session
+def running(instance_id):
+    row = db_connector.RunningInstance.get(instance_id=instance_id)
+    return row.running if row else None
+
+
+# Elements of an instance with a persisted timer
+@db_session
+def persisted(instance_id):
+    return sorted(
+        t.element_id
+        for t in db_connector.Timer.select(lambda t: t.instance_id == instance_id)
+    )
+
+
+async def restore(registry):
+    import server
+
+    await server.restore_instances({"bpmn_models": registry.models})
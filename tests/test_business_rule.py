@@ -0,0 +1,45 @@
+import asyncio
+
+from conftest import activities
+from event_sink import default_event_sink
+
+
+async def decide(registry, count, amount=lambda n: n, prefix="r"):
+    model = registry.get("rule.bpmn")
+    instances = [
+        await model.create_instance(f"{prefix}{n}", {"amount": amount(n)})
+        for n in range(count)
+    ]
+    await asyncio.wait_for(
+        asyncio.gather(*(i.start() for i in instances), return_exceptions=True), 2
+    )
+    await default_event_sink.flush()
+    return instances
+
+
+def test_business_rule_tasks_map_decision_results(registry):
+    [low, high] = asyncio.run(decide(registry, 2, lambda n: 5 + 50 * n))
+    assert low.state == high.state == "finished"
+    assert low.variables == {
+        "amount": 5,
+        "size_result": "low",
+        "sizes": ["low"],
+        "grade": "C",
+    }
+    # Required decisions run first, their outputs feed the decision
+    assert high.variables["size_result"] == "high"
+    assert high.variables["sizes"] == ["low", "high"]
+    assert high.variables["grade"] == "A"
+    assert activities("r0") == ["S", "Size", "Sizes", "Grade", "E"]
+
+
+def test_instances_deciding_together_share_the_cache(registry):
+    instances = asyncio.run(decide(registry, 40, lambda n: n % 2))
+    assert {i.state for i in instances} == {"finished"}
+    assert {i.variables["grade"] for i in instances} == {"C"}
+    # Two distinct inputs for each of the two policies decisions
+    cache = registry.decision_model("unique").cache
+    assert len(cache.entries) == 4
+    misses = cache.misses
+    asyncio.run(decide(registry, 40, lambda n: n % 2, prefix="again"))
+    assert cache.misses == misses
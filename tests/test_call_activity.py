@@ -0,0 +1,37 @@
+import asyncio
+
+from bpmn_model import get_model_for_instance
+from bpmn_types import CallActivity
+from conftest import activities
+from event_sink import default_event_sink
+
+
+def test_call_activity_maps_variables_in_and_out(registry):
+    async def run():
+        parent = await registry.get("parent.bpmn").create_instance(
+            "parent", {"x": 7, "name": "Ana", "secret": "s"}
+        )
+        await asyncio.wait_for(parent.start(), 2)
+        await default_event_sink.flush()
+        return parent
+
+    parent = asyncio.run(run())
+    assert parent.state == "finished"
+    [child_id] = parent.children
+    child = get_model_for_instance(child_id).instances[child_id]
+    # Only the mapped variables reach the child, expressions are evaluated
+    assert child.parent == "parent"
+    assert child.variables == {"child_x": 7, "label": "7-Ana"}
+    # Only the mapped outputs come back, missing sources are skipped
+    assert parent.variables == {"x": 7, "name": "Ana", "secret": "s", "y": 7}
+    assert activities(child_id) == ["CS", "Work", "CE"]
+    assert activities("parent")[-1] == "E"
+
+
+def test_call_activity_without_mappings_passes_nothing():
+    call = CallActivity()
+    assert call.input_variables({"x": 1}) == {}
+    variables = {"x": 1}
+    assert call.output_variables({"x": 2, "y": 3}, variables) == {"x": 1}
+    call.in_mappings = [(None, None)]
+    assert call.input_variables({"x": 1}) == {"x": 1}
@@ -0,0 +1,55 @@
+from pony.orm import db_session
+
+import db_connector
+from cluster import Cluster
+
+
+def worker(index):
+    url = f"http://127.0.0.1:{8000 + index}"
+    return Cluster(workers=2, worker=index, url=url, partitions=4, lease_ttl=30)
+
+
+def test_workers_take_their_preferred_partitions():
+    first, second = worker(0), worker(1)
+    assert first.refresh() == ({0, 2}, set())
+    assert second.refresh() == ({1, 3}, set())
+    assert first.refresh() == (set(), set())
+    assert first.owns("a") != second.owns("a")
+
+
+def test_partitions_move_back_when_their_worker_returns():
+    first, second = worker(0), worker(1)
+    first.refresh()
+    second.refresh()
+    # Crashed, its leases expire
+    db_connector.release_leases(second.owner)
+    assert first.refresh() == ({1, 3}, set())
+
+    second = worker(1)
+    assert second.refresh() == (set(), set())
+    assert first.refresh() == (set(), {1, 3})
+    assert second.refresh() == ({1, 3}, set())
+    assert first.owned == {0, 2}
+
+
+def test_failed_renewal_only_drops_partitions_taken_by_others(monkeypatch):
+    first = worker(0)
+    first.refresh()
+    with db_session:
+        db_connector.Lease[2].owner = "worker-1"
+    monkeypatch.setattr(db_connector, "acquire_leases", lambda *args, **kw: None)
+    assert first.refresh() == (set(), {2})
+    assert first.owned == {0}
+
+
+def test_partitions_are_dropped_when_their_leases_expire_unrenewed(monkeypatch):
+    first = worker(0)
+    first.refresh()
+    monkeypatch.setattr(db_connector, "acquire_leases", lambda *args, **kw: None)
+    monkeypatch.setattr(db_connector, "get_leases", lambda: None)
+    # Database unreachable, the leases are still valid
+    assert first.refresh() == (set(), set())
+    assert first.owned == {0, 2}
+    first.expires[2] -= first.lease_ttl
+    assert first.refresh() == (set(), {2})
+    assert first.owned == {0}
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import db_connector
+from correlation import default_correlator
+from event_sink import ASYNC, GROUP, SYNC, default_event_sink
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    calls = []
+
+    def writer(batch, snapshots, **rows):
+        calls.append((batch, rows))
+        return db_connector.add_events(batch, snapshots, **rows)
+
+    monkeypatch.setattr(default_event_sink, "writer", writer)
+    return calls
+
+
+def test_message_reaches_waiting_instance_by_key(registry):
+    async def run():
+        model = registry.get("msg.bpmn")
+        first = await model.create_instance("a", {"order_id": 1})
+        second = await model.create_instance("b", {"order_id": 2})
+        first.start()
+        second.start()
+        await asyncio.sleep(0.05)
+        assert default_correlator.waiting("order_paid", 2)
+
+        result = await default_correlator.correlate("order_paid", 2, {"amount": 5})
+        await asyncio.sleep(0.05)
+        assert result["status"] == "correlated"
+        assert result["instance_id"] == "b"
+        assert second.variables["amount"] == 5
+        assert second.graph.ids(second.tokens) == ["Ship"]
+        assert first.graph.ids(first.tokens) == ["Paid"]
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("mode", [SYNC, GROUP, ASYNC])
+def test_buffered_message_is_deleted_with_its_step(registry, writes, mode, monkeypatch):
+    monkeypatch.setattr(default_event_sink, "mode", mode)
+
+    async def run():
+        result = await default_correlator.correlate("order_paid", 7, {"amount": 3})
+        assert result["status"] == "buffered"
+        instance = await registry.get("msg.bpmn").create_instance("i", {"order_id": 7})
+        instance.start()
+        await asyncio.sleep(0.1)
+        await default_event_sink.flush()
+        assert instance.variables["amount"] == 3
+        return result["message_id"]
+
+    message_id = asyncio.run(run())
+    assert db_connector.get_messages() == []
+    deleting = [
+        batch
+        for batch, rows in writes
+        if message_id in rows.get("consumed_messages", {})
+    ]
+    assert len(deleting) == 1
+    assert ("i", "Paid") in {(e["instance_id"], e["activity_id"]) for e in deleting[0]}
+
+
+def test_message_stays_buffered_until_its_step_is_written(registry, writes):
+    async def run():
+        await default_correlator.correlate("order_paid", 7)
+        instance = await registry.get("msg.bpmn").create_instance("i", {"order_id": 7})
+        # Taken by the subscription, its step is not written yet
+        assert instance.receive(instance.graph.index["Paid"]) is not None
+        assert len(db_connector.get_messages()) == 1
+
+    asyncio.run(run())
+    # Restart loads it again
+    assert default_correlator.load() == 1
+
+
+def test_expired_message_is_deleted(writes, monkeypatch):
+    monkeypatch.setattr(default_correlator, "ttl", 0)
+
+    async def run():
+        await default_correlator.correlate("order_paid", 9)
+        await default_correlator.sweep()
+        await default_event_sink.flush()
+
+    asyncio.run(run())
+    assert db_connector.get_messages() == []
+    assert default_correlator.buffered == 0
@@ -0,0 +1,74 @@
+import pytest
+
+from dmn_model import DmnModel
+from dmn_types import BATCH_MIN
+
+
+@pytest.fixture
+def model():
+    return DmnModel("models/policies.dmn")
+
+
+@pytest.mark.parametrize(
+    "decision, amount, output",
+    [
+        ("unique", 5, {"size": "low"}),
+        ("unique", 15, {"size": "high"}),
+        ("first", 15, {"size": "high"}),
+        ("first", 5, {"size": "low"}),
+        ("priority", 15, {"size": "high"}),
+        ("priority", 5, {"size": "low"}),
+        ("any", 15, {"size": "ok"}),
+        ("sum", 15, {"size": 11}),
+        ("sum", 5, {"size": 1}),
+        ("rule_order", 15, [{"size": "low"}, {"size": "high"}]),
+        ("output_order", 15, [{"size": "high"}, {"size": "low"}]),
+        ("output_order", -1, []),
+    ],
+)
+def test_hit_policies(model, decision, amount, output):
+    assert model.decide(decision, {"amount": amount}) == output
+
+
+def test_unique_without_a_match(model):
+    assert model.decide("unique", {"amount": None}) is None
+
+
+def test_batch_matches_single_evaluation(model):
+    # Without a cache, single outputs do not come from the batch
+    single = DmnModel("models/policies.dmn", cache_size=0)
+    rows = [{"amount": n % 20} for n in range(BATCH_MIN * 2)]
+    for decision in model.decisions:
+        assert model.decide_many(decision, rows) == [
+            single.decide(decision, row) for row in rows
+        ]
+
+
+def test_batch_uses_the_decision_cache(model):
+    rows = [{"amount": n} for n in range(BATCH_MIN)] + [{"amount": [1]}]
+    first = model.decide_many("unique", rows)
+    assert model.cache.misses == BATCH_MIN
+    assert model.decide_many("unique", rows) == first
+    assert model.cache.hits == BATCH_MIN
+    assert model.decide("unique", {"amount": 3}) == first[3]
+    assert model.cache.hits == BATCH_MIN + 1
+    # Outputs are copies, a caller changing one does not change the cache
+    first[3]["size"] = "changed"
+    assert model.decide("unique", {"amount": 3}) != first[3]
+
+
+def test_batch_evaluates_repeated_rows_once(model, monkeypatch):
+    decision = model.decisions["unique"]
+    evaluated = []
+    evaluate_many = decision.evaluate_many
+
+    def spy(rows):
+        evaluated.extend(rows)
+        return evaluate_many(rows)
+
+    monkeypatch.setattr(decision, "evaluate_many", spy)
+    rows = [{"amount": n % 2} for n in range(BATCH_MIN)] + [{"amount": [1]}] * 2
+    outputs = model.decide_many("unique", rows)
+    assert outputs[:2] == [{"size": "low"}, {"size": "low"}]
+    # Unhashable rows are not merged, they are evaluated one by one
+    assert evaluated == [{"amount": 0}, {"amount": 1}, {"amount": [1]}, {"amount": [1]}]
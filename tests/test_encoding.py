@@ -0,0 +1,45 @@
+import json
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+from utils import encoding
+
+np = pytest.importorskip("numpy")
+
+VALUES = {
+    "when": datetime(2026, 1, 2, 3, 4, 5, 6),
+    "utc": datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+    "day": date(2026, 1, 2),
+    "keys": {1: "int", None: "none", 1.5: "float"},
+    "count": np.int64(5),
+    "share": np.float64(2.5),
+    "sizes": np.array([1, 2]),
+    "price": Decimal("1.10"),
+}
+
+EXPECTED = {
+    "when": "2026-01-02T03:04:05.000006",
+    "utc": "2026-01-02T03:04:05+00:00",
+    "day": "2026-01-02",
+    "keys": {"1": "int", "null": "none", "1.5": "float"},
+    "count": 5,
+    "share": 2.5,
+    "sizes": [1, 2],
+    "price": "1.10",
+}
+
+
+def test_json_fallback_matches_orjson(monkeypatch):
+    pytest.importorskip("orjson")
+    fast = encoding.dumps(VALUES)
+    monkeypatch.setattr(encoding, "orjson", None)
+    slow = encoding.dumps(VALUES)
+    assert json.loads(fast) == json.loads(slow) == EXPECTED
+    assert " " not in slow
+
+
+def test_json_fallback(monkeypatch):
+    monkeypatch.setattr(encoding, "orjson", None)
+    assert json.loads(encoding.dumps(VALUES)) == EXPECTED
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+from datetime import datetime
+
+import pytest
+
+from conftest import logged, running
+from event_sink import ASYNC, GROUP, SYNC, EventSink
+
+
+def event(instance_id, variables=None):
+    return {
+        "model_name": "form.bpmn",
+        "instance_id": instance_id,
+        "activity_id": "Review",
+        "timestamp": datetime.now(),
+        "pending": [],
+        "activity_variables": variables or {},
+    }
+
+
+@pytest.mark.parametrize("mode", [GROUP, ASYNC])
+def test_bad_row_only_drops_its_instance(mode):
+    sink = EventSink(mode=mode)
+    failed = []
+    sink.on_error = lambda instance_id, error: failed.append(instance_id)
+
+    async def run():
+        sink.set_running("good", True)
+        sink.set_running("bad", True)
+        sink.add(event("good"))
+        sink.add(event("bad", {"when": object()}))
+        sink.add(event("good"))
+        sink.set_running("bad", False)
+        await sink.flush()
+
+    asyncio.run(run())
+    assert failed == ["bad"]
+    assert logged("good") == 2
+    assert logged("bad") == 0
+    assert running("good") is True
+    # Ended instances still get their flag, they must not be resumed
+    assert running("bad") is False
+    assert not sink.dirty
+
+
+def test_sync_mode_raises_to_the_step():
+    sink = EventSink(mode=SYNC)
+
+    async def run():
+        sink.add(event("good"))
+        await sink.commit("good")
+        sink.add(event("bad", {"when": object()}))
+        with pytest.raises(TypeError):
+            await sink.commit("bad")
+
+    asyncio.run(run())
+    assert logged("good") == 1
+    assert logged("bad") == 0
+
+
+def test_sync_writes_run_off_the_event_loop():
+    threads = []
+    sink = EventSink(
+        mode=SYNC,
+        writer=lambda batch, snapshots, **rows: threads.append(
+            threading.current_thread()
+        ),
+    )
+
+    async def run():
+        sink.add(event("a"))
+        assert threads == []
+        await sink.commit("a")
+        assert len(threads) == 1
+
+    asyncio.run(run())
+    assert threads[0] is not threading.main_thread()
+
+
+def test_running_flag_written_with_the_batch():
+    sink = EventSink(mode=GROUP)
+
+    async def run():
+        sink.set_running("a", True)
+        sink.add(event("a"))
+        await sink.flush()
+        sink.set_running("a", False)
+        await sink.flush()
+
+    asyncio.run(run())
+    assert running("a") is False
+    assert sink.batches == 2
+
+
+def test_instance_with_rejected_writes_fails(registry):
+    async def run():
+        model = registry.get("form.bpmn")
+        instance = await model.create_instance("bad", {"x": object()})
+        other = await model.create_instance("good", {})
+        finished = instance.start()
+        other.start()
+        with pytest.raises(TypeError):
+            await asyncio.wait_for(finished, 2)
+        return instance, other
+
+    instance, other = asyncio.run(run())
+    assert instance.state == "failed"
+    assert other.state == "running"
+    assert logged("good") == 1
+
+
+def test_consumed_message_waits_for_the_batch_of_its_step():
+    calls = []
+    sink = EventSink(
+        mode=GROUP,
+        max_batch=1,
+        writer=lambda batch, snapshots, **rows: calls.append((batch, rows)),
+    )
+
+    async def run():
+        sink.add(event("other"))
+        sink.consume(1, "taker")
+        sink.add(event("taker"))
+        await sink.flush()
+
+    asyncio.run(run())
+    assert [[e["instance_id"] for e in batch] for batch, rows in calls] == [
+        ["other"],
+        ["taker"],
+    ]
+    assert "consumed_messages" not in calls[0][1]
+    assert calls[1][1]["consumed_messages"] == {1: "taker"}
+
+
+def test_snapshot_waits_for_the_last_event_of_its_instance():
+    calls = []
+    sink = EventSink(
+        mode=GROUP,
+        max_batch=2,
+        writer=lambda batch, snapshots, **rows: calls.append((batch, snapshots, rows)),
+    )
+
+    async def run():
+        sink.set_running("a", True)
+        for _ in range(3):
+            sink.add(event("a"))
+        sink.add(None, {"instance_id": "a"})
+        await sink.flush()
+
+    asyncio.run(run())
+    assert [len(batch) for batch, snapshots, rows in calls] == [2, 1]
+    assert calls[0][1] == {} and calls[0][2] == {}
+    assert list(calls[1][1]) == ["a"]
+    assert calls[1][2] == {"running": {"a": True}}
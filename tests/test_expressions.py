@@ -0,0 +1,64 @@
+import os
+import shutil
+
+import pytest
+
+from model_registry import ModelRegistry
+from utils.expressions import compile_condition
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def check(condition, **variables):
+    return compile_condition(condition)(variables)
+
+
+def test_and_binds_tighter_than_or():
+    assert check("${a} == 1 or ${b} == 1 and ${c} == 1", a=1, b=0, c=0)
+    assert not check("(${a} == 1 or ${b} == 1) and ${c} == 1", a=1, b=0, c=0)
+    assert check("not ${a} == 1 or ${b} == 1", a=2, b=0)
+
+
+def test_symbolic_operators():
+    assert check("${a} == 1 && ${b} == 2", a=1, b=2)
+    assert not check("${a} == 1 && ${b} == 2", a=1, b=3)
+    assert check("${a} == 1 || ${b} == 2", a=0, b=2)
+    assert check("!${done}", done=False)
+    assert check("!(${a} != 1)", a=1)
+
+
+def test_form_strings_are_coerced():
+    assert check("${points} >= 50", points="50")
+    assert check("${points} < 50.5", points="50")
+    assert not check("${points} > 10", points="many")
+    assert check("${points} != 10", points="many")
+    assert check("${approved} == true", approved="True")
+    assert check("status == 'approved'", status="approved")
+    assert check("${order.total} > 100", order={"total": 120})
+    assert not check("${order.total} > 100", order={})
+
+
+def test_legacy_key_value_conditions():
+    assert check("status:approved", status="approved")
+    assert not check("status:approved", status="rejected")
+    assert not check("status:approved")
+    # Keys the expression grammar does not accept still use the old form
+    assert check("kandidat-odobren:true", **{"kandidat-odobren": "true"})
+    assert check("ime prezime:Ana", **{"ime prezime": "Ana"})
+    assert check("${a} == 'x:y'", a="x:y")
+
+
+def test_invalid_conditions_are_rejected():
+    with pytest.raises(ValueError):
+        compile_condition("${a} ==")
+    with pytest.raises(ValueError):
+        compile_condition("(${a} == 1")
+    assert compile_condition("  ") is None
+
+
+def test_broken_model_does_not_stop_the_others(tmp_path):
+    shutil.copy(os.path.join(TESTS, "models", "form.bpmn"), tmp_path)
+    (tmp_path / "broken.bpmn").write_text("<definitions")
+    registry = ModelRegistry(str(tmp_path))
+    assert list(registry.refresh()) == ["form.bpmn"]
+    assert registry.get("broken.bpmn") is None
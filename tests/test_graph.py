@@ -0,0 +1,71 @@
+import asyncio
+
+from bpmn_model import TokenTable, UserFormMessage
+from conftest import restore
+from event_sink import default_event_sink
+
+
+def test_graph_counts_incoming_flows_of_joins(registry):
+    graph = registry.get("parallel.bpmn").graphs["P"]
+    index = graph.index
+    assert graph.ids(graph.start) == ["S"]
+    assert graph.in_degree[index["Join"]] == 2
+    assert graph.in_degree[index["Fork"]] == 1
+    assert sorted(graph.ids(t for t, _ in graph.outgoing[index["Fork"]])) == [
+        "A",
+        "B",
+    ]
+    assert graph.ids(t for t, _ in graph.outgoing[index["Join"]]) == ["E"]
+
+
+def test_join_consumes_one_token_per_incoming_flow():
+    tokens = TokenTable([0])
+    for _ in range(3):
+        tokens.add(5)
+    assert list(tokens) == [0, 5]
+    # A loop brought a third token, it waits for the next round
+    tokens.complete(5, consumed=2)
+    assert 5 not in tokens
+    assert tokens.count(5) == 1
+    tokens.complete(0)
+    assert len(tokens) == 0
+    assert tokens.arrived == {5: 1}
+
+
+def test_instances_share_the_graph_not_the_tokens(registry):
+    async def run():
+        model = registry.get("parallel.bpmn")
+        first = await model.create_instance("j1", {})
+        second = await model.create_instance("j2", {})
+        done = first.start()
+        second.start()
+        await asyncio.sleep(0.05)
+        first.scheduler.deliver("j1", UserFormMessage("B", {}))
+        await asyncio.wait_for(done, 1)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.graph is second.graph
+    assert first.state == "finished"
+    assert second.graph.ids(second.tokens) == ["B", "Join"]
+    assert second.tokens.count(second.graph.index["Join"]) == 1
+
+
+def test_join_arrivals_survive_a_restart(registry, restart):
+    async def before():
+        instance = await registry.get("parallel.bpmn").create_instance("j", {})
+        instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+
+    async def after(registry):
+        await restore(registry)
+        instance = registry.get("parallel.bpmn").instances["j"]
+        assert instance.tokens.count(instance.graph.index["Join"]) == 1
+        done = instance.finished
+        instance.scheduler.deliver("j", UserFormMessage("B", {}))
+        await asyncio.wait_for(done, 1)
+        return instance
+
+    asyncio.run(before())
+    assert asyncio.run(after(restart())).state == "finished"
@@ -0,0 +1,42 @@
+import asyncio
+
+from aiohttp import web
+
+from http_connector import HttpConnector, query_params
+
+
+def test_query_params_are_encoded_like_requests():
+    assert query_params(
+        {"q": "a", "page": 2, "all": True, "skip": None, "ids": [1, None, 2]}
+    ) == [("q", "a"), ("page", "2"), ("all", "True"), ("ids", "1"), ("ids", "2")]
+    assert query_params(None) is None
+    assert query_params("q=a") == "q=a"
+
+
+def test_request_with_none_and_bool_params():
+    async def echo(request):
+        return web.json_response({"query": list(request.query.items())})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/echo", echo)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        connector = HttpConnector()
+        try:
+            response = await connector.request(
+                "GET",
+                f"http://127.0.0.1:{port}/echo",
+                params={"active": False, "missing": None, "n": 1},
+            )
+        finally:
+            await connector.close()
+            await runner.cleanup()
+        return response
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.json()["query"] == [["active", "False"], ["n", "1"]]
@@ -0,0 +1,170 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+import db_connector
+from bpmn_model import UserFormMessage, instances_total
+from conftest import logged
+from event_sink import default_event_sink
+from instance_cache import default_instance_cache
+from search_index import SearchIndex
+
+
+def started():
+    return instances_total.values.get((("state", "started"),), 0)
+
+
+def test_idle_instance_is_evicted_and_hydrated(registry):
+    import server
+
+    async def run():
+        model = registry.get("form.bpmn")
+        instance = await model.create_instance("i", {"name": "Ana"})
+        instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+        assert instance.idle()
+        count = started()
+
+        default_instance_cache.evict(1)
+        assert "i" not in model.instances
+        assert "i" not in default_instance_cache
+
+        restored = await server.load_instance("i")
+        assert restored is not instance
+        assert restored.state == "running"
+        assert restored.variables == {"name": "Ana"}
+        # Resumed, not started again
+        assert started() == count
+        restored.scheduler.deliver("i", UserFormMessage("Review", {}))
+        await asyncio.sleep(0.05)
+        assert restored.graph.ids(restored.tokens) == ["Approve"]
+
+    asyncio.run(run())
+
+
+def test_failed_instance_is_not_run_again(registry):
+    import server
+
+    async def run():
+        model = registry.get("fail.bpmn")
+        instance = await model.create_instance("f", {})
+        with pytest.raises(Exception, match="not deployed"):
+            await asyncio.wait_for(instance.start(), 2)
+        await default_event_sink.flush()
+        steps = logged("f")
+        count = started()
+
+        default_instance_cache.evict(1)
+        assert "f" not in model.instances
+        assert db_connector.get_snapshot("f")["running"] is False
+
+        restored = await server.load_instance("f")
+        await asyncio.sleep(0.05)
+        assert restored.state == "failed"
+        assert restored.graph.ids(restored.tokens) == ["Decide"]
+        assert logged("f") == steps
+        assert started() == count
+
+    asyncio.run(run())
+
+
+def test_search_lists_evicted_instances_without_loading_them(registry):
+    import server
+
+    async def run():
+        model = registry.get("form.bpmn")
+        instance = await model.create_instance("s", {"name": "Ana"})
+        instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+        count = started()
+        default_instance_cache.evict(1)
+
+        request = make_mocked_request("GET", "/instances/search?q=name:ana")
+        response = await server.search_instance(request)
+        [result] = json.loads(response.body)["results"]
+        assert result["id"] == "s"
+        assert result["state"] == "running"
+        assert result["pending"] == ["Review"]
+        assert result["variables"] == {"name": "Ana"}
+        assert "s" not in model.instances
+        assert started() == count
+
+    asyncio.run(run())
+
+
+def test_instances_of_other_workers_are_not_loaded(registry, monkeypatch):
+    import server
+
+    async def run():
+        model = registry.get("form.bpmn")
+        instance = await model.create_instance("o", {})
+        instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+        default_instance_cache.evict(1)
+
+        monkeypatch.setattr(server.cluster, "owns", lambda instance_id: False)
+        assert await server.load_instance("o") is None
+        assert "o" not in model.instances
+
+    asyncio.run(run())
+
+
+def test_search_index_is_bounded():
+    index = SearchIndex(capacity=2)
+    index.update("a", {"name": "Ana"})
+    index.update("b", {"name": "Ante"})
+    index.update("a", {"name": "Ana"})
+    index.update("c", {"name": "Anabel"})
+    assert len(index) == 2
+    assert index.search([("name", "an")]) == {"a", "c"}
+    index.remove("a")
+    assert index.search([("name", "an")]) == {"c"}
+    assert not index.grams.get(("name", "ana")) - {"c"}
+
+
+def test_deleted_instance_stops_running(registry):
+    import server
+
+    async def run():
+        model = registry.get("form.bpmn")
+        instance = await model.create_instance("d", {})
+        instance.start()
+        await asyncio.sleep(0.05)
+
+        request = make_mocked_request(
+            "DELETE", "/instance/d", match_info={"instance_id": "d"}
+        )
+        response = await server.delete_instance(request)
+        assert response.status == 200
+        assert "d" not in model.instances
+        assert not instance.scheduler.deliver("d", UserFormMessage("Review", {}))
+        assert db_connector.get_snapshot("d") is None
+        assert await server.load_instance("d") is None
+
+    asyncio.run(run())
+
+
+def test_model_listing_keeps_evicted_instances(registry, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "model_registry", registry)
+
+    async def run():
+        model = registry.get("form.bpmn")
+        for _id in ("l1", "l2"):
+            instance = await model.create_instance(_id, {})
+            instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+        default_instance_cache.evict(1)
+        assert len(model.instances) == 1
+
+        response = await server.get_models(make_mocked_request("GET", "/model"))
+        return json.loads(response.body)["results"]
+
+    [listing] = [m for m in asyncio.run(run()) if m["model_path"] == "form.bpmn"]
+    assert sorted(listing["instances"]) == ["l1", "l2"]
@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime
+
+from pony.orm import db_session
+
+import db_connector
+from bpmn_model import UserFormMessage
+from conftest import restore
+from event_sink import default_event_sink
+
+
+def test_running_instance_is_restored_from_its_snapshot(registry, restart):
+    async def before():
+        model = registry.get("form.bpmn")
+        instance = await model.create_instance("i", {"name": "Ana"})
+        instance.start()
+        await asyncio.sleep(0.05)
+        instance.scheduler.deliver("i", UserFormMessage("Review", {}))
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+
+    async def after(registry):
+        await restore(registry)
+        instance = registry.get("form.bpmn").instances["i"]
+        assert instance.restored
+        assert instance.graph.ids(instance.tokens) == ["Approve"]
+        assert instance.variables == {"name": "Ana"}
+        instance.scheduler.deliver("i", UserFormMessage("Approve", {}))
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+        return instance
+
+    asyncio.run(before())
+    instance = asyncio.run(after(restart()))
+    assert instance.state == "finished"
+    assert db_connector.get_snapshot("i")["running"] is False
+    assert db_connector.get_running_instances_snapshots() == []
+
+
+def test_instance_without_snapshot_is_replayed_from_the_log(restart):
+    with db_session:
+        db_connector.RunningInstance(instance_id="old", running=True)
+        for activity_id, pending, variables in [
+            ("S", ["Review"], {"name": "Ana"}),
+            ("Review", ["Approve"], {"approved": False}),
+        ]:
+            db_connector.Event(
+                model_name="form.bpmn",
+                instance_id="old",
+                activity_id=activity_id,
+                timestamp=datetime.now(),
+                pending=pending,
+                activity_variables=variables,
+            )
+
+    async def run(registry):
+        await restore(registry)
+        return registry.get("form.bpmn").instances["old"]
+
+    instance = asyncio.run(run(restart()))
+    assert instance.state == "running"
+    assert instance.graph.ids(instance.tokens) == ["Approve"]
+    assert instance.variables == {"name": "Ana", "approved": False}
+
+
+def test_finished_instances_are_not_restored(registry, restart):
+    async def before():
+        model = registry.get("form.bpmn")
+        instance = await model.create_instance("done", {})
+        finished = instance.start()
+        await asyncio.sleep(0.05)
+        for task in ("Review", "Approve"):
+            instance.scheduler.deliver("done", UserFormMessage(task, {}))
+            await asyncio.sleep(0.02)
+        await asyncio.wait_for(finished, 2)
+        await default_event_sink.flush()
+
+    async def after(registry):
+        await restore(registry)
+        return registry.get("form.bpmn").instances
+
+    asyncio.run(before())
+    assert asyncio.run(after(restart())) == {}
@@ -0,0 +1,49 @@
+import asyncio
+
+from bpmn_model import UserFormMessage
+from conftest import activities
+from event_sink import default_event_sink
+from scheduler import default_scheduler
+
+
+def test_join_waits_for_every_branch(registry):
+    async def run():
+        instance = await registry.get("parallel.bpmn").create_instance("p", {})
+        finished = instance.start()
+        await asyncio.sleep(0.05)
+        # A went through, the join waits for the user task
+        assert sorted(instance.graph.ids(instance.tokens)) == ["B", "Join"]
+        assert ("p", "B") in default_scheduler.waiting
+        instance.scheduler.deliver("p", UserFormMessage("B", {}))
+        await asyncio.wait_for(finished, 1)
+        await default_event_sink.flush()
+        return instance
+
+    instance = asyncio.run(run())
+    assert instance.state == "finished"
+    log = activities("p")
+    assert log.index("Join", log.index("B")) < log.index("E")
+    assert log.count("E") == 1
+    assert ("p", "B") not in default_scheduler.waiting
+
+
+def test_many_instances_share_the_ready_queue(registry):
+    async def run():
+        model = registry.get("parallel.bpmn")
+        instances = [await model.create_instance(f"p{n}", {}) for n in range(250)]
+        finished = [instance.start() for instance in instances]
+        # Batches of steps, each followed by a group commit
+        for _ in range(100):
+            if not default_scheduler.ready:
+                break
+            await asyncio.sleep(0.02)
+        assert len(default_scheduler.waiting) == 250
+        for n in range(250):
+            default_scheduler.deliver(f"p{n}", UserFormMessage("B", {}))
+        await asyncio.wait_for(asyncio.gather(*finished), 5)
+        return instances
+
+    instances = asyncio.run(run())
+    assert {instance.state for instance in instances} == {"finished"}
+    assert not default_scheduler.ready
+    assert not default_scheduler.waiting
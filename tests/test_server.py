@@ -0,0 +1,159 @@
+import asyncio
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from bpmn_model import UserFormMessage
+from change_feed import ChangeFeed
+from event_sink import default_event_sink
+from instance_cache import default_instance_cache
+
+
+# Requests against the server routes, without its startup
+def request(handler):
+    import server
+
+    async def run():
+        app = web.Application()
+        app.add_routes(server.routes)
+        async with TestClient(TestServer(app)) as client:
+            return await handler(client)
+
+    return asyncio.run(run())
+
+
+async def form_instances(registry, count):
+    model = registry.get("form.bpmn")
+    for i in range(count):
+        instance = await model.create_instance(f"e{i}", {"name": f"n{i}"})
+        instance.start()
+    await asyncio.sleep(0.05)
+    await default_event_sink.flush()
+
+
+def test_events_are_paged(registry):
+    async def run(client):
+        await form_instances(registry, 3)
+        response = await client.get("/events", params={"limit": 2})
+        first = await response.json()
+        response = await client.get(
+            "/events", params={"limit": 2, "after": first["next"]}
+        )
+        second = await response.json()
+        return first, second
+
+    first, second = request(run)
+    assert len(first["results"]) == 2
+    assert len(second["results"]) == 1
+    assert second["next"] is None
+    ids = [e["instance_id"] for e in first["results"] + second["results"]]
+    assert sorted(ids) == ["e0", "e1", "e2"]
+
+
+def test_events_are_streamed_as_ndjson(registry, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "EVENTS_PAGE", 2)
+
+    async def run(client):
+        await form_instances(registry, 3)
+        response = await client.get("/events", params={"format": "ndjson"})
+        assert response.headers["Content-Type"] == "application/x-ndjson"
+        return await response.text()
+
+    lines = request(run).splitlines()
+    events = [json.loads(line) for line in lines]
+    assert [e["instance_id"] for e in events] == ["e0", "e1", "e2"]
+    assert all(isinstance(e["timestamp"], str) for e in events)
+
+
+# Next count events of a /feed response, keep-alive comments are skipped
+async def feed_events(response, count):
+    async def read():
+        events = []
+        while len(events) < count:
+            line = await response.content.readline()
+            if line.startswith(b"data: "):
+                events.append(json.loads(line[len(b"data: ") :]))
+        return events
+
+    return await asyncio.wait_for(read(), 2)
+
+
+def test_feed_sends_current_state_then_deltas(registry, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "FEED_HEARTBEAT", 0.05)
+
+    async def run(client):
+        model = registry.get("form.bpmn")
+        watched = await model.create_instance("w", {"name": "Ana"})
+        other = await model.create_instance("o", {})
+        watched.start()
+        other.start()
+        await asyncio.sleep(0.05)
+
+        response = await client.get(
+            "/feed", params={"instance": "w,unknown", "interval": "0.01"}
+        )
+        assert response.headers["Content-Type"] == "text/event-stream"
+        [current] = await feed_events(response, 1)
+
+        other.send(UserFormMessage("Review", {}))
+        watched.send(UserFormMessage("Review", {}))
+        [delta] = await feed_events(response, 1)
+        response.close()
+        return current, delta
+
+    current, delta = request(run)
+    assert current == {
+        "id": "w",
+        "model": "form.bpmn",
+        "state": "running",
+        "pending": ["Review"],
+        "variables": {"name": "Ana"},
+    }
+    # Only the watched instance, its changes within the interval coalesced
+    assert delta["id"] == "w"
+    assert delta["pending"] == ["Approve"]
+
+
+def test_feed_sends_evicted_instances_from_their_snapshot(registry, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "FEED_HEARTBEAT", 0.05)
+
+    async def run(client):
+        instance = await registry.get("form.bpmn").create_instance("ev", {"a": 1})
+        instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+        default_instance_cache.evict(1)
+
+        # Default interval, longer than the heartbeat
+        response = await client.get("/feed", params={"instance": "ev"})
+        [current] = await feed_events(response, 1)
+        response.close()
+        return current
+
+    current = request(run)
+    assert current["state"] == "running"
+    assert current["pending"] == ["Review"]
+    assert current["variables"] == {"a": 1}
+    assert "ev" not in registry.get("form.bpmn").instances
+
+
+def test_subscriber_coalesces_deltas_per_instance():
+    feed = ChangeFeed()
+
+    async def run():
+        subscriber = feed.subscribe(models=["form.bpmn"])
+        feed.publish({"id": "a", "model": "form.bpmn", "variables": {"x": 1}})
+        feed.publish({"id": "b", "model": "other.bpmn"})
+        feed.publish({"id": "a", "model": "form.bpmn", "variables": {"y": 2}})
+        return await subscriber.next(0)
+
+    assert asyncio.run(run()) == [
+        {"id": "a", "model": "form.bpmn", "variables": {"x": 1, "y": 2}}
+    ]
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import db_connector
+from bpmn_model import UserFormMessage
+from conftest import activities, persisted, restore
+from event_sink import default_event_sink
+from timers import default_timer_service
+
+
+def test_catch_event_waits_for_its_timer(registry):
+    async def run():
+        instance = await registry.get("timer.bpmn").create_instance(
+            "t", {"delay": "PT0.2S"}
+        )
+        instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+        assert instance.graph.ids(instance.tokens) == ["Wait"]
+        assert persisted("t") == ["Wait"]
+        await asyncio.sleep(0.3)
+        await default_event_sink.flush()
+        assert instance.graph.ids(instance.tokens) == ["Task"]
+        # Deadline and reminder of the user task replace the fired timer
+        assert persisted("t") == ["Late", "Nag"]
+
+    asyncio.run(run())
+
+
+def test_interrupting_boundary_timer_cancels_the_task(registry):
+    async def run():
+        instance = await registry.get("timer.bpmn").create_instance(
+            "t", {"delay": "PT0S"}
+        )
+        finished = instance.start()
+        await asyncio.wait_for(finished, 3)
+        await default_event_sink.flush()
+        return instance
+
+    instance = asyncio.run(run())
+    assert instance.state == "finished"
+    log = activities("t")
+    # Non-interrupting cycle fired twice before the deadline
+    assert log.count("Remind") == 2
+    assert "Late" in log and "Task" not in log
+    assert persisted("t") == []
+    assert "t/Late" not in default_timer_service
+
+
+def test_completed_task_cancels_its_boundary_timers(registry):
+    async def run():
+        instance = await registry.get("timer.bpmn").create_instance(
+            "t", {"delay": "PT0S"}
+        )
+        finished = instance.start()
+        await asyncio.sleep(0.1)
+        instance.scheduler.deliver("t", UserFormMessage("Task", {}))
+        await asyncio.wait_for(finished, 1)
+        await default_event_sink.flush()
+
+    asyncio.run(run())
+    assert persisted("t") == []
+    assert len(default_timer_service) == 0
+    assert "Late" not in activities("t")
+
+
+def test_timer_due_while_stopped_fires_after_restart(registry, restart, monkeypatch):
+    async def before():
+        instance = await registry.get("timer.bpmn").create_instance(
+            "t", {"delay": "PT0.2S"}
+        )
+        instance.start()
+        await asyncio.sleep(0.05)
+        await default_event_sink.flush()
+
+    async def after(registry):
+        await restore(registry)
+        default_timer_service.load()
+        instance = registry.get("timer.bpmn").instances["t"]
+        await asyncio.sleep(0.1)
+        return instance
+
+    asyncio.run(before())
+    time.sleep(0.3)
+    # Timers of restored instances are read in bulk, not one by one
+    reads = []
+    monkeypatch.setattr(db_connector, "get_timer", reads.append)
+    instance = asyncio.run(after(restart()))
+    assert instance.graph.ids(instance.tokens) == ["Task"]
+    assert reads == []
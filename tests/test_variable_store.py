@@ -0,0 +1,44 @@
+from variable_store import StepVariables
+
+
+def test_changes_are_keys_set_to_a_new_value():
+    variables = {"a": 1, "b": 2, "c": 3}
+    step = StepVariables(variables)
+    step["a"] = 1
+    step["b"] = 20
+    step["d"] = 4
+    step["c"] = 30
+    step["c"] = 3
+    assert step.changes() == {"b": 20, "d": 4}
+    # Writes go through to the instance variables
+    assert variables == {"a": 1, "b": 20, "c": 3, "d": 4}
+
+
+def test_deleted_keys_are_not_changes():
+    variables = {"a": 1}
+    step = StepVariables(variables)
+    del step["a"]
+    step["b"] = None
+    assert "a" not in variables
+    assert step.changes() == {"b": None}
+
+
+def test_values_mutated_in_place_are_not_seen():
+    variables = {"items": [1], "order": {"total": 1}}
+    step = StepVariables(variables)
+    step["items"].append(2)
+    step.get("order")["total"] = 2
+    assert step.changes() == {}
+    # Assigning a new value is seen
+    step["items"] = step["items"] + [3]
+    assert step.changes() == {"items": [1, 2, 3]}
+
+
+def test_parallel_steps_record_their_own_writes():
+    variables = {"a": 1}
+    first, second = StepVariables(variables), StepVariables(variables)
+    first["a"] = 2
+    second["b"] = 3
+    assert first.changes() == {"a": 2}
+    assert second.changes() == {"b": 3}
+    assert dict(first) == dict(second) == {"a": 2, "b": 3}
@@ -0,0 +1,285 @@
+import asyncio
+import heapq
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+import db_connector
+import env
+from cluster import default_cluster
+from event_sink import default_event_sink
+from engine_log import logger
+from metrics import default_metrics
+
+# ISO 8601 durations, months and years are taken as 30 and 365 days
+DURATION = re.compile(
+    r"^P(?:(?P<years>\d+(?:\.\d+)?)Y)?(?:(?P<months>\d+(?:\.\d+)?)M)?"
+    r"(?:(?P<weeks>\d+(?:\.\d+)?)W)?(?:(?P<days>\d+(?:\.\d+)?)D)?"
+    r"(?:T(?:(?P<hours>\d+(?:\.\d+)?)H)?(?:(?P<minutes>\d+(?:\.\d+)?)M)?"
+    r"(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$"
+)
+SECONDS = {
+    "years": 365 * 86400,
+    "months": 30 * 86400,
+    "weeks": 7 * 86400,
+    "days": 86400,
+    "hours": 3600,
+    "minutes": 60,
+    "seconds": 1,
+}
+
+
+def parse_duration(text):
+    match = DURATION.match(text.strip())
+    if not match or text.strip() in ("P", "PT"):
+        raise ValueError(f"Invalid ISO 8601 duration '{text}'")
+    return sum(float(v) * SECONDS[k] for k, v in match.groupdict().items() if v)
+
+
+# Local naive datetime, like the timestamps of the event log
+def parse_date(text):
+    date = datetime.fromisoformat(text.strip())
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date
+
+
+# Repeating intervals R<n>/<duration> or R<n>/<start>/<duration>, no count
+# repeats forever. Returns (first due, repetitions after the first, seconds)
+def parse_cycle(text, now):
+    parts = text.strip().split("/")
+    if len(parts) not in (2, 3) or not parts[0].startswith("R"):
+        raise ValueError(f"Unsupported timer cycle '{text}'")
+    repeat = int(parts[0][1:]) if parts[0][1:] else -1
+    interval = parse_duration(parts[-1])
+    if interval <= 0:
+        raise ValueError(f"Timer cycle '{text}' has no interval")
+    if len(parts) == 3:
+        due = parse_date(parts[1])
+    else:
+        due = now + timedelta(seconds=interval)
+        repeat = repeat - 1 if repeat > 0 else repeat
+    return due, repeat, interval
+
+
+class Timer:
+    __slots__ = ("timer_id", "instance_id", "element_id", "due", "repeat", "interval")
+
+    def __init__(self, instance_id, element_id, due, repeat=0, interval=0.0):
+        self.timer_id = self.key(instance_id, element_id)
+        self.instance_id = instance_id
+        self.element_id = element_id
+        self.due = due
+        self.repeat = repeat
+        self.interval = interval
+
+    def __repr__(self):
+        return f"Timer({self.timer_id} at {self.due.isoformat()})"
+
+    # One armed timer per instance and timer event
+    @staticmethod
+    def key(instance_id, element_id):
+        return f"{instance_id}/{element_id}"
+
+    def to_dict(self):
+        return {
+            "timer_id": self.timer_id,
+            "instance_id": self.instance_id,
+            "element_id": self.element_id,
+            "due": self.due,
+            "repeat": self.repeat,
+            "interval": self.interval,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["instance_id"],
+            data["element_id"],
+            data["due"],
+            data["repeat"],
+            data["interval"],
+        )
+
+    # Next firing of a cycle, None once the repetitions are used up
+    def next(self):
+        if self.repeat == 0:
+            return None
+        return Timer(
+            self.instance_id,
+            self.element_id,
+            self.due + timedelta(seconds=self.interval),
+            self.repeat - 1 if self.repeat > 0 else -1,
+            self.interval,
+        )
+
+
+class TimerService:
+    # Armed timer events in a heap ordered by due time, one task sleeps
+    # until the earliest one. Timers are persisted through the event sink,
+    # in memory only the ones due within the loaded window are kept and the
+    # window moves forward every horizon / 2 seconds, so a restart loads
+    # the next window instead of every timer or instance. Without load()
+    # (no server) every timer stays in memory.
+    def __init__(self, horizon=3600, event_sink=default_event_sink):
+        self.horizon = horizon
+        self.event_sink = event_sink
+        self.timers = {}
+        self.by_instance = defaultdict(set)
+        self.heap = []
+        self.loaded_until = None
+        # Persisted timers by instance, read in bulk for a restore
+        self.preloaded = {}
+        self.fired = 0
+        # Called with each due timer, set by the engine
+        self.handler = None
+        self._sequence = 0
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, timer_id):
+        return timer_id in self.timers
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+        self._wakeup.set()
+
+    def _push(self, timer):
+        self.timers[timer.timer_id] = timer
+        self.by_instance[timer.instance_id].add(timer.timer_id)
+        self._sequence += 1
+        heapq.heappush(self.heap, (timer.due, self._sequence, timer))
+        if self.heap[0][2] is timer:
+            self._ensure_running()
+
+    def _pop(self, timer_id):
+        timer = self.timers.pop(timer_id, None)
+        if timer is not None:
+            ids = self.by_instance[timer.instance_id]
+            ids.discard(timer_id)
+            if not ids:
+                del self.by_instance[timer.instance_id]
+            if len(self.heap) > 2 * len(self.timers) + 1024:
+                # Mostly cancelled entries, e.g. deadlines of finished tasks
+                timers = self.timers
+                self.heap = [e for e in self.heap if timers.get(e[2].timer_id) is e[2]]
+                heapq.heapify(self.heap)
+        return timer
+
+    def arm(self, timer):
+        # Replaces an armed timer of the same element, the old heap entry
+        # goes stale and is skipped
+        self._pop(timer.timer_id)
+        self.event_sink.timer(timer.timer_id, timer.to_dict())
+        if self.loaded_until is None or timer.due <= self.loaded_until:
+            self._push(timer)
+
+    # Arms timer unless it is armed or persisted already, for instances
+    # restored with pending timer events. A persisted timer keeps its due
+    # time, one due while the engine was down fires right away.
+    def ensure(self, timer):
+        if timer.timer_id in self.timers:
+            return
+        preloaded = self.preloaded.get(timer.instance_id)
+        if preloaded is not None:
+            data = preloaded.get(timer.timer_id)
+        else:
+            data = db_connector.get_timer(timer.timer_id)
+        if data is None:
+            self.arm(timer)
+        elif self.loaded_until is None or data["due"] <= self.loaded_until:
+            self._push(Timer.from_dict(data))
+
+    # Reads the persisted timers of instances about to be restored in one
+    # go, ensure() then needs no query per timer. Cleared with preloaded.
+    def preload(self, instance_ids):
+        timers = db_connector.get_timers_for(instance_ids)
+        if timers is None:
+            return  # ensure() falls back to reading each timer
+        self.preloaded = {instance_id: {} for instance_id in instance_ids}
+        for data in timers:
+            self.preloaded[data["instance_id"]][data["timer_id"]] = data
+
+    def cancel(self, timer_id):
+        if self._pop(timer_id) is not None or self.loaded_until is not None:
+            self.event_sink.timer(timer_id, None)
+
+    def cancel_instance(self, instance_id):
+        self.forget(instance_id)
+        self.event_sink.timer(None, instance_id=instance_id)
+
+    # Drops timers from memory only, e.g. when another worker takes over
+    def forget(self, instance_id):
+        for timer_id in list(self.by_instance.get(instance_id, ())):
+            self._pop(timer_id)
+
+    def load(self, after=None):
+        until = datetime.now() + timedelta(seconds=self.horizon)
+        loaded = 0
+        for data in db_connector.get_timers(after, until):
+            if data["timer_id"] in self.timers:
+                continue
+            if not default_cluster.owns(data["instance_id"]):
+                continue
+            self._push(Timer.from_dict(data))
+            loaded += 1
+        self.loaded_until = until
+        logger.info("%d timers loaded, due until %s", loaded, until)
+        return loaded
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(self.horizon / 2)
+            self.load(after=self.loaded_until)
+
+    async def _loop(self):
+        while True:
+            if not self.heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, _, timer = self.heap[0]
+            delay = (due - datetime.now()).total_seconds()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            if self.timers.get(timer.timer_id) is not timer:
+                continue  # Cancelled or replaced
+            await self._fire(timer)
+            if self.fired % 100 == 0:
+                # Many timers due at once must not starve the server
+                await asyncio.sleep(0)
+
+    async def _fire(self, timer):
+        self._pop(timer.timer_id)
+        if not default_cluster.owns(timer.instance_id):
+            return  # Partition taken over, the new owner loads the timer
+        following = timer.next()
+        if following is not None:
+            self.arm(following)
+        else:
+            self.event_sink.timer(timer.timer_id, None)
+        self.fired += 1
+        try:
+            await self.handler(timer)
+        except Exception as e:
+            logger.error("Timer %s failed: %r", timer.timer_id, e)
+
+
+config = getattr(env, "TIMERS", {})
+default_timer_service = TimerService(horizon=config.get("horizon", 3600))
+
+default_metrics.gauge(
+    "bpmn_armed_timers",
+    "Timers due within the loaded window",
+    lambda: len(default_timer_service),
+)
@@ -0,0 +1,28 @@
+import json
+from datetime import date, datetime, time
+
+try:
+    import orjson
+except ImportError:
+    # Standard library encoder, without the whitespace
+    orjson = None
+
+
+# Both encoders write dates as ISO 8601, numpy values as numbers and lists,
+# anything else as its str()
+def _default(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(
+            data,
+            default=_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        ).decode()
+    return json.dumps(data, separators=(",", ":"), default=_default)
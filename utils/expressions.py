@@ -0,0 +1,240 @@
+import re
+from functools import lru_cache
+
+
+class SafeDict(dict):
+    def __missing__(self, key):
+        return "${" + key + "}"
+
+
+# Expressions, eg. "${my_process_variable}" or "Hello ${name}"
+@lru_cache(maxsize=4096)
+def compile_expression(expression):
+    # Check if expression is a string
+    if not isinstance(expression, str):
+        raise TypeError(
+            f"Expected expression to be a string, but got {type(expression)} with value {expression}"
+        )
+
+    # The key used when the whole expression is a single variable
+    key = expression.replace("${", "").replace("}", "")
+    template = expression.replace("${", "{")
+    has_fields = "{" in template or "}" in template
+
+    def evaluate(process_variables):
+        # If the key is in process_variables, return the corresponding value
+        if key in process_variables:
+            return process_variables[key]
+        if not has_fields:
+            return template
+        # If not, try to format the entire expression
+        try:
+            return template.format_map(SafeDict(process_variables))
+        except Exception as e:
+            raise ValueError(
+                f"Failed to format expression '{expression}' with provided variables. Original error: {e}"
+            )
+
+    return evaluate
+
+
+# Sequence flow conditions, either the original "key:value" form or
+# comparisons like "${points} >= 50 and status == 'approved'"
+LEGACY_CONDITION = re.compile(r"^\s*[\w.]+\s*:")
+# Quoted strings and ${...} variables, a ":" outside them marks "key:value"
+QUOTED = re.compile(r"\$\{[^}]*\}|'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+TOKENS = re.compile(
+    r"""\s*(?:
+    (?P<variable>\$\{[^}]*\})
+    |(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    |(?P<compare>==|!=|>=|<=|>|<)
+    |(?P<logic>&&|\|\||!(?!=)|\band\b|\bor\b|\bnot\b)
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?P<number>-?\d+(?:\.\d+)?)
+    |(?P<name>[A-Za-z_][\w.]*)
+    )""",
+    re.VERBOSE,
+)
+KEYWORDS = {"true": True, "false": False, "null": None, "None": None}
+LOGIC = {"&&": "and", "||": "or", "!": "not"}
+
+
+class Condition:
+    def __init__(self, text, evaluate):
+        self.text = text
+        self.evaluate = evaluate
+
+    def __call__(self, variables):
+        return bool(self.evaluate(variables))
+
+    def __repr__(self):
+        return self.text
+
+
+def _lookup(path):
+    keys = path.split(".")
+    if len(keys) == 1:
+        return lambda variables: variables.get(path)
+
+    def get(variables):
+        value = variables
+        for k in keys:
+            if not isinstance(value, dict) or k not in value:
+                return None
+            value = value[k]
+        return value
+
+    return get
+
+
+def _number(value):
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return value
+
+
+def _boolean(value):
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return value
+
+
+def _compare(op, left, right):
+    # Form data arrives as strings, compare them as booleans or numbers
+    if isinstance(left, bool) != isinstance(right, bool):
+        left, right = _boolean(left), _boolean(right)
+    elif isinstance(left, (int, float)) != isinstance(right, (int, float)):
+        left, right = _number(left), _number(right)
+        if left is None or right is None:
+            return op == "!="
+    try:
+        if op == "==":
+            return left == right
+        if op == "!=":
+            return left != right
+        if op == ">":
+            return left > right
+        if op == "<":
+            return left < right
+        if op == ">=":
+            return left >= right
+        return left <= right
+    except TypeError:
+        return False
+
+
+class _Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKENS.match(text, position)
+            if not match or match.end() == position:
+                raise ValueError(f"Invalid condition '{self.text}' at {position}")
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "logic":
+                value = LOGIC.get(value, value)
+            self.tokens.append((kind, value))
+            position = match.end()
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        evaluate = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Invalid condition '{self.text}'")
+        return evaluate
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == ("logic", "or"):
+            self.take()
+            operands.append(self.parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda variables: any(o(variables) for o in operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.peek() == ("logic", "and"):
+            self.take()
+            operands.append(self.parse_not())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda variables: all(o(variables) for o in operands)
+
+    def parse_not(self):
+        if self.peek() == ("logic", "not"):
+            self.take()
+            operand = self.parse_not()
+            return lambda variables: not operand(variables)
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        kind, op = self.peek()
+        if kind != "compare":
+            return left
+        self.take()
+        right = self.parse_operand()
+        return lambda variables: _compare(op, left(variables), right(variables))
+
+    def parse_operand(self):
+        kind, value = self.take()
+        if kind == "open":
+            evaluate = self.parse_or()
+            if self.take()[0] != "close":
+                raise ValueError(f"Missing ')' in condition '{self.text}'")
+            return evaluate
+        if kind == "variable":
+            return _lookup(value[2:-1].strip())
+        if kind == "string":
+            literal = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "number":
+            literal = float(value) if "." in value else int(value)
+        elif kind == "name" and value in KEYWORDS:
+            literal = KEYWORDS[value]
+        elif kind == "name":
+            return _lookup(value)
+        else:
+            raise ValueError(f"Unexpected '{value}' in condition '{self.text}'")
+        return lambda variables: literal
+
+
+def _legacy_condition(condition):
+    key, _, value = condition.partition(":")
+    return Condition(
+        condition,
+        lambda variables: key in variables and variables[key] == value,
+    )
+
+
+@lru_cache(maxsize=4096)
+def compile_condition(condition):
+    if not condition or not condition.strip():
+        return None
+    if LEGACY_CONDITION.match(condition):
+        return _legacy_condition(condition)
+    try:
+        return Condition(condition, _Parser(condition).parse())
+    except ValueError:
+        # Keys like "approved-by:x" or "full name:x" are no identifiers
+        if ":" in QUOTED.sub("", condition):
+            return _legacy_condition(condition)
+        raise
@@ -0,0 +1,49 @@
+from collections.abc import MutableMapping
+
+MISSING = object()
+
+
+class StepVariables(MutableMapping):
+    # Instance variables as seen by one step. Writes go straight through to
+    # the instance, only the value a key had before its first write in this
+    # step is kept, so the step's changes come out at O(changed) without
+    # copying the variables. Concurrent steps of parallel branches each
+    # record their own writes.
+    def __init__(self, variables):
+        self.variables = variables
+        self.before = {}
+
+    def __getitem__(self, key):
+        return self.variables[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.before:
+            self.before[key] = self.variables.get(key, MISSING)
+        self.variables[key] = value
+
+    def __delitem__(self, key):
+        if key not in self.before:
+            self.before[key] = self.variables.get(key, MISSING)
+        del self.variables[key]
+
+    def __iter__(self):
+        return iter(self.variables)
+
+    def __len__(self):
+        return len(self.variables)
+
+    def __contains__(self, key):
+        return key in self.variables
+
+    def get(self, key, default=None):
+        return self.variables.get(key, default)
+
+    # Keys added or set to a different value, values mutated in place are
+    # not seen so tasks assign new values
+    def changes(self):
+        variables = self.variables
+        return {
+            k: variables[k]
+            for k, old in self.before.items()
+            if k in variables and (old is MISSING or old != variables[k])
+        }